@@ -0,0 +1,390 @@
+import asyncio
+from threading import Thread
+
+from aiohttp import web
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+from block import Block
+from blockchain import ChainBuilder, located_transaction_dict
+from broadcast import AsyncBroadcaster, delivered
+from gossip import transaction_key
+from jsonstream import CHUNK_SIZE, ObjectStream, StreamError, write_object
+import metrics
+from transaction import TransactionRecord
+import wire
+from wire import WireError
+
+
+class AsyncNodeServer:
+    """
+    The node endpoints of rest.py on an asyncio stack (aiohttp), selected with
+    --server asyncio.
+
+    Handlers run on the event loop and broadcast with the non-blocking
+    AsyncBroadcaster, so a slow peer holds a coroutine instead of a server
+    thread. Work that blocks or burns CPU (signature checks, chain
+    validation, disk writes, syncing with a peer) is moved to a worker thread
+    so the loop keeps answering meanwhile.
+    """
+    def __init__(self, node, ingest_queue, block_producer):
+        self.node = node
+        self.ingest_queue = ingest_queue
+        self.block_producer = block_producer
+        self.app = web.Application(middlewares=[self.wire_errors], client_max_size=1024 ** 3)
+        self.app.add_routes([
+            web.post('/register', self.register),
+            web.post('/join', self.join),
+            web.post('/transactions/new', self.new_transaction),
+            web.post('/transactions/batch', self.new_transactions),
+            web.post('/receive_block', self.new_block),
+            web.get('/blockchain', self.get_full_chain),
+            web.get('/tip', self.get_tip),
+            web.get('/blocks', self.get_blocks),
+            web.get('/tx/{transaction_id}', self.get_transaction),
+            web.get('/address/{public_key:.+}/history', self.get_address_history),
+            web.post('/sync', self.sync),
+            web.post('/update_blockchain', self.update_blockchain),
+            web.post('/receive_data', self.receive_nodes),
+            web.post('/broadcast_blockchain', self.broadcast_blockchain_endpoint),
+            web.post('/start_test', self.start_test),
+            web.get('/metrics', self.get_metrics),
+        ])
+        self.app.on_startup.append(self.install_broadcaster)
+        self.app.on_cleanup.append(self.close_broadcaster)
+
+    async def install_broadcaster(self, app):
+        self.node.broadcaster = AsyncBroadcaster(asyncio.get_running_loop(), wire_keys=self.node.wire_keys)
+
+    async def close_broadcaster(self, app):
+        await self.node.broadcaster.close_async()
+
+    @web.middleware
+    async def wire_errors(self, request, handler):
+        try:
+            return await handler(request)
+        except WireError as e:
+            # The sender falls back to JSON on 415
+            return web.json_response({'error': str(e)}, status=415)
+
+    async def read_payload(self, request):
+        """
+        Body of the request, in the binary wire format or as JSON.
+        """
+        if request.content_type == wire.CONTENT_TYPE:
+            return wire.decode(await request.read(), self.node.wire_keys())
+        return await request.json()
+
+    async def read_chain(self, request, list_key):
+        """
+        Same as read_chain() in rest.py. Each chunk is parsed and its blocks
+        checked off the loop.
+        """
+        builder = ChainBuilder()
+        if request.content_type == wire.CONTENT_TYPE:
+            fields = await self.read_payload(request)
+            blocks = [Block.from_dict(block_data) for block_data in fields.pop(list_key, [])]
+            valid = await asyncio.to_thread(builder.extend, blocks)
+            return (await asyncio.to_thread(builder.finish) if valid else None), fields
+
+        stream = ObjectStream(list_key)
+
+        def add_chunk(chunk):
+            return builder.extend([Block.from_dict(block_data) for block_data in stream.feed(chunk)])
+
+        async for chunk in request.content.iter_chunked(CHUNK_SIZE):
+            if not await asyncio.to_thread(add_chunk, chunk):
+                return None, {}
+        fields = stream.close()
+        return await asyncio.to_thread(builder.finish), fields
+
+    def wants_binary(self, request):
+        accept = parse_accept_header(request.headers.get('Accept'), MIMEAccept)
+        return accept.best_match(['application/json', wire.CONTENT_TYPE]) == wire.CONTENT_TYPE
+
+    def response_keys(self, request):
+        keys = self.node.wire_keys()
+        return keys if request.headers.get(wire.KEYS_HEADER) == keys.digest.hex() else wire.NO_REGISTRY
+
+    def blocks_response(self, request, view, start, name, extra):
+        if self.wants_binary(request):
+            payload = dict({name: [block.to_dict() for block in view.since(start)]}, **extra)
+            return web.Response(body=wire.encode(payload, self.response_keys(request)), content_type=wire.CONTENT_TYPE)
+        encoded_blocks = self.node.blockchain.encoded_blocks(start, view)
+        return web.Response(text=''.join(write_object(name, encoded_blocks, extra)), content_type='application/json')
+
+    async def register(self, request):
+        node = self.node
+        try:
+            values = await request.json()
+            public_key = values.get('public_key')
+            node_address = values.get('node_address')
+            if not public_key or not node_address:
+                return web.json_response({'message': 'Missing public key or node address'}, status=400)
+
+            # A node started from a keystore slot asks for the id of that slot
+            requested_node_id = values.get('node_id')
+            if requested_node_id is not None and not isinstance(requested_node_id, int):
+                return web.json_response({'message': 'The node id must be an integer'}, status=400)
+
+            # Signing the welcome transfer is blocking work, off the loop
+            assigned_node_id, complete = await asyncio.to_thread(node.register_node, public_key, node_address,
+                                                                 requested_node_id)
+            if assigned_node_id is None:
+                return web.json_response({'message': 'Node already registered or node id not free'}, status=400)
+            print(f"Node {assigned_node_id} registered.")
+
+            # The roster and the chain go out to everyone once, after the last
+            # registration, without holding up the last node's answer
+            if complete:
+                Thread(target=node.publish_network, daemon=True).start()
+
+            return web.json_response({
+                'message': 'New node registered successfully',
+                'node_id': assigned_node_id,
+                'node_address': node_address,
+            })
+        except Exception as e:
+            print(f"Failed to register node: {e}")
+            return web.json_response({'error': 'Internal server error'}, status=500)
+
+    async def join(self, request):
+        try:
+            chain, data = await self.read_chain(request, 'blockchain')
+            if not chain or not await asyncio.to_thread(self.node.join_network, data['nodes'], chain,
+                                                        data['transaction_pool']):
+                return web.json_response({'error': 'Received chain is invalid'}, status=400)
+            # Welcome transfers left in the pool may fill a block
+            self.block_producer.notify()
+            return web.json_response({'message': 'Joined the network', 'tip': self.node.tip()})
+        except StreamError as e:
+            return web.json_response({'error': str(e)}, status=400)
+        except Exception as e:
+            print(f"Failed to join the network: {e}")
+            return web.json_response({'error': 'Internal server error'}, status=500)
+
+    async def new_transaction(self, request):
+        if request.content_type == wire.CONTENT_TYPE:
+            values = await self.read_payload(request)
+        else:
+            try:
+                values = await request.json()
+            except ValueError:
+                values = None
+
+        required_fields = ['sender_address', 'receiver_address', 'type_of_transaction', 'amount', 'message', 'nonce', 'private_key']
+        if not values or any(field not in values for field in required_fields):
+            return web.json_response({'error': 'Missing transaction fields'}, status=400)
+
+        gossip = self.node.gossip
+        key = transaction_key(values) if gossip is not None else None
+        if key is not None and not gossip.first_seen(key):
+            metrics.metrics.inc('gossip_duplicates_total', path='/transactions/new')
+            return web.json_response({'message': 'Transaction already seen'})
+
+        # Validation, pool insertion and minting happen on the ingest worker
+        if not self.ingest_queue.submit(values):
+            if key is not None:
+                gossip.forget(key)
+            return web.json_response({'error': 'Transaction queue full, retry later'}, status=429)
+        if key is not None:
+            gossip.relay('/transactions/new', values)
+        return web.json_response({'message': 'Transaction queued'}, status=202)
+
+    async def new_transactions(self, request):
+        if request.content_type == wire.CONTENT_TYPE:
+            values = await self.read_payload(request)
+        else:
+            try:
+                values = await request.json()
+            except ValueError:
+                values = None
+        transactions = values.get('transactions') if isinstance(values, dict) else None
+
+        required_fields = ['sender_address', 'receiver_address', 'type_of_transaction', 'amount', 'message', 'nonce', 'private_key']
+        if not isinstance(transactions, list) or any(not isinstance(tx, dict) or any(field not in tx for field in required_fields)
+                                                     for tx in transactions):
+            return web.json_response({'error': 'Missing transaction fields'}, status=400)
+        if len(transactions) > self.ingest_queue.queue.maxsize:
+            return web.json_response({'error': 'Batch larger than the transaction queue'}, status=413)
+
+        gossip = self.node.gossip
+        keys = []
+        if gossip is not None:
+            # Only the transactions this node has not seen are queued and passed on
+            unseen = []
+            for transaction in transactions:
+                key = transaction_key(transaction)
+                if gossip.first_seen(key):
+                    keys.append(key)
+                    unseen.append(transaction)
+            metrics.metrics.inc('gossip_duplicates_total', len(transactions) - len(unseen), path='/transactions/batch')
+            transactions = unseen
+
+        # Queued whole or not at all, so a retried batch is never partly duplicated
+        if not self.ingest_queue.submit_many(transactions):
+            for key in keys:
+                gossip.forget(key)
+            return web.json_response({'error': 'Transaction queue full, retry later'}, status=429)
+        if transactions and gossip is not None:
+            gossip.relay('/transactions/batch', dict(values, transactions=transactions))
+        return web.json_response({'message': 'Transactions queued', 'queued': len(transactions)}, status=202)
+
+    async def new_block(self, request):
+        values = await self.read_payload(request)
+        new_block = Block(
+            index=values['index'],
+            transactions=[TransactionRecord.from_dict(tx) for tx in values['transactions']],
+            validator=values['validator'],
+            previous_hash=values['previous_hash'],
+            capacity=self.node.blockchain.block_capacity
+        )
+
+        gossip = self.node.gossip
+        if gossip is not None:
+            if not gossip.first_seen(new_block.current_hash):
+                metrics.metrics.inc('gossip_duplicates_total', path='/receive_block')
+                return web.json_response({'message': 'Block already seen'})
+            # Passed on before validating, a node that is behind and rejects the
+            # block must not cut off the nodes below it; each of them validates too
+            gossip.relay('/receive_block', values)
+
+        def validate_and_add():
+            is_valid, message = self.node.validate_block(new_block)
+            if not is_valid and self.node.catch_up(new_block):
+                if self.node.holds_block(new_block):
+                    return True
+                is_valid, message = self.node.validate_block(new_block)
+            if not is_valid:
+                print(message)
+                return False
+            try:
+                self.node.blockchain.add_block(new_block)
+            except Exception as e:
+                # Another block took the tip after this one was validated
+                print(e)
+                return False
+            return True
+
+        if not await asyncio.to_thread(validate_and_add):
+            return web.json_response({'error': 'Invalid block'}, status=400)
+        # The next validator may be this node, and leftovers may fill a block
+        self.block_producer.notify()
+        return web.json_response({'message': 'Block added and broadcasted'})
+
+    async def get_full_chain(self, request):
+        view = self.node.blockchain.view()
+        return self.blocks_response(request, view, 0, 'chain', {'length': view.height})
+
+    async def get_tip(self, request):
+        return web.json_response(self.node.tip())
+
+    async def get_blocks(self, request):
+        try:
+            start = int(request.query.get('from', 0))
+        except ValueError:
+            start = 0
+        if start < 0:
+            return web.json_response({'error': 'Invalid height'}, status=400)
+        # One view for the blocks and the height, so they agree while blocks keep arriving
+        view = self.node.blockchain.view()
+        return self.blocks_response(request, view, start, 'blocks', {'height': view.height})
+
+    async def get_transaction(self, request):
+        try:
+            transaction_id = bytes.fromhex(request.match_info['transaction_id'])
+        except ValueError:
+            return web.json_response({'error': 'Invalid transaction id'}, status=400)
+        # The first lookup may index the whole chain, off the loop
+        found = await asyncio.to_thread(self.node.blockchain.find_transaction, transaction_id)
+        if found is None:
+            return web.json_response({'error': 'Transaction not found'}, status=404)
+        return web.json_response(located_transaction_dict(*found))
+
+    async def get_address_history(self, request):
+        public_key = request.match_info['public_key']
+        try:
+            offset = int(request.query.get('offset', 0))
+            limit = int(request.query.get('limit', 50))
+        except ValueError:
+            offset, limit = -1, 0
+        if offset < 0 or not 0 < limit <= 1000:
+            return web.json_response({'error': 'Invalid offset or limit'}, status=400)
+        page, total = await asyncio.to_thread(self.node.blockchain.address_history, public_key, offset, limit)
+        return web.json_response({
+            'address': public_key,
+            'total': total,
+            'offset': offset,
+            'limit': limit,
+            'transactions': [located_transaction_dict(*entry) for entry in page],
+        })
+
+    async def sync(self, request):
+        data = await self.read_payload(request)
+        try:
+            peer_url = data.get('address')
+            if not peer_url:
+                return web.json_response({'error': 'Missing peer address'}, status=400)
+
+            self.node.blockchain.replace_pool([TransactionRecord.from_dict(tx) for tx in data.get('transaction_pool', [])])
+            if await asyncio.to_thread(self.node.sync_with, peer_url, data.get('tip')):
+                self.block_producer.notify()
+                return web.json_response({'message': 'Blockchain synced', 'tip': self.node.tip()})
+            return web.json_response({'message': 'Blockchain already up to date', 'tip': self.node.tip()})
+        except Exception as e:
+            print(f"Failed to sync blockchain: {e}")
+            return web.json_response({'error': 'Internal server error'}, status=500)
+
+    async def update_blockchain(self, request):
+        blockchain = self.node.blockchain
+        try:
+            # Checked while it is read, an invalid chain is dropped at its first bad block
+            candidate_chain, data = await self.read_chain(request, 'blockchain_data')
+            if candidate_chain is None:
+                return web.json_response({'error': 'Received chain is invalid'}, status=400)
+            if not candidate_chain:
+                return web.json_response({'error': 'Invalid data received'}, status=400)
+
+            blockchain.replace_pool([TransactionRecord.from_dict(tx) for tx in data['transaction_pool']])
+            if await asyncio.to_thread(blockchain.replace_if_longer, candidate_chain):
+                return web.json_response({'message': 'Blockchain updated successfully', 'length': blockchain.view().height})
+            return web.json_response({'message': 'Received chain is not longer than the current chain'})
+        except StreamError as e:
+            return web.json_response({'error': str(e)}, status=400)
+        except Exception as e:
+            print(f"Failed to update blockchain: {e}")
+            return web.json_response({'error': 'Internal server error'}, status=500)
+
+    async def receive_nodes(self, request):
+        received_data = await self.read_payload(request)
+        try:
+            self.node.update_nodes(received_data)
+            return web.json_response({'message': 'Node updated successfully'})
+        except Exception as e:
+            print(f"Failed to receive node: {e}")
+            return web.json_response({'error': 'Internal server error'}, status=500)
+
+    async def broadcast_blockchain_endpoint(self, request):
+        node = self.node
+        peers = dict(list(node.peer_urls().items())[:-1])
+        body = node.chain_body('blockchain_data', {'transaction_pool': node.blockchain.pool_dicts()})
+        results = await node.broadcaster.post_all_async(peers, '/update_blockchain', None, body, 'application/json')
+        return web.json_response({'delivered': delivered(results), 'peers': list(results)})
+
+    async def start_test(self, request):
+        data = await request.json()
+        transactions_folder = data.get('transactions_folder')
+        if not transactions_folder:
+            return web.json_response({'error': 'Missing transactions_folder in JSON data'}, status=400)
+        node_id = self.node.get_node_id_by_public_key(self.node.wallet.public_key)
+        await asyncio.to_thread(self.node.start_transaction_test, transactions_folder, node_id, data.get('run_id'))
+        return web.json_response({'message': f'Transaction tests started for all nodes using folder {transactions_folder}'})
+
+    async def get_metrics(self, request):
+        return web.Response(body=metrics.metrics.render().encode(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+    def run(self, host, port):
+        """
+        Serve until interrupted.
+        """
+        web.run_app(self.app, host=host, port=port, print=None, access_log=None)
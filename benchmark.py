@@ -0,0 +1,1018 @@
+import argparse
+import base64
+import gc
+import hashlib
+import json
+import os
+import random
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Thread
+
+import numpy
+
+
+class SinkHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for a node endpoint: reads the body, waits, answers 200.
+    """
+    delay = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.delay:
+            time.sleep(self.delay)
+        body = b'{"message": "ok"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_sinks(count, delay):
+    handler = type('DelayedSinkHandler', (SinkHandler,), {'delay': delay})
+    servers = []
+    for _ in range(count):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        server.protocol_version = 'HTTP/1.1'
+        Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    peers = {i: f'http://127.0.0.1:{server.server_address[1]}' for i, server in enumerate(servers)}
+    return servers, peers
+
+
+def synthetic_transaction(sender, receiver, nonce):
+    message = ''.join(random.choice('abcdefghij ') for _ in range(random.randint(5, 30)))
+    return {
+        'sender_address': sender,
+        'receiver_address': receiver,
+        'type_of_transaction': 'message',
+        'amount': 0.0,
+        'message': message,
+        'nonce': nonce,
+        'transaction_id': hashlib.sha256(f'{sender}{receiver}{nonce}'.encode()).hexdigest(),
+        'signature': base64.b64encode(os.urandom(128)).decode(),
+    }
+
+
+def synthetic_keys(nodes):
+    return [base64.b64encode(os.urandom(294)).decode() for _ in range(nodes)]
+
+
+def synthetic_chain(length, capacity=5, nodes=10, keys=None):
+    """
+    A valid chain of message blocks between fake node keys, without signatures
+    that would verify. Good enough for hashing, serialization and memory tests.
+    """
+    from block import Block
+    from transaction import TransactionRecord
+
+    if keys is None:
+        keys = synthetic_keys(nodes)
+    chain = [Block(index=0, transactions=[], validator=keys[0], previous_hash='1', capacity=capacity)]
+    nonce = 0
+    for index in range(1, length):
+        transactions = []
+        for _ in range(capacity):
+            nonce += 1
+            transaction = synthetic_transaction(random.choice(keys), random.choice(keys), nonce)
+            transactions.append(TransactionRecord.from_dict(transaction))
+        chain.append(Block(index=index, transactions=transactions, validator=random.choice(keys),
+                           previous_hash=chain[-1].current_hash, capacity=capacity))
+    return chain
+
+
+def report(name, samples):
+    samples = numpy.array(samples) * 1000
+    print(f"{name:>12}: mean {samples.mean():8.2f} ms  p50 {numpy.percentile(samples, 50):8.2f} ms  p99 {numpy.percentile(samples, 99):8.2f} ms")
+
+
+def bench_broadcast(args):
+    """
+    Compare one requests.post per peer in sequence with the Broadcaster fan-out.
+    """
+    import requests
+    from broadcast import Broadcaster
+
+    servers, peers = start_sinks(args.nodes, args.delay)
+    payload = {'sender_address': 'x' * 400, 'receiver_address': 'y' * 400, 'amount': 0.0,
+               'type_of_transaction': 'message', 'message': 'hello', 'nonce': 1}
+
+    sequential = []
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        for peer_url in peers.values():
+            requests.post(peer_url + '/transactions/new', json=payload)
+        sequential.append(time.perf_counter() - start)
+
+    broadcaster = Broadcaster()
+    concurrent = []
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        broadcaster.post_all(peers, '/transactions/new', payload)
+        concurrent.append(time.perf_counter() - start)
+    broadcaster.close()
+
+    print(f"Broadcast to {args.nodes} peers, {args.rounds} rounds, {args.delay * 1000:.1f} ms handler delay")
+    report('sequential', sequential)
+    report('broadcaster', concurrent)
+
+    for server in servers:
+        server.shutdown()
+
+
+def bench_validate(args):
+    """
+    Single-process vs process-pool chain validation on synthetic chains.
+    """
+    from blockchain import Blockchain
+
+    from block import Block
+
+    blockchain = Blockchain(block_capacity=args.capacity)
+    for length in args.lengths:
+        wire_chain = [block.to_dict() for block in synthetic_chain(length, args.capacity)]
+        for workers in (1, args.workers):
+            # Fresh blocks, as received from a peer, with nothing cached yet
+            chain = [Block.from_dict(block_data) for block_data in wire_chain]
+            start = time.perf_counter()
+            valid = blockchain.validate_chain(chain, workers=workers)
+            elapsed = time.perf_counter() - start
+            if not valid:
+                raise RuntimeError(f"The synthetic chain of {length} blocks failed validation with {workers} worker(s)")
+            print(f"{length:>7} blocks, {workers} worker(s): {elapsed:8.3f} s ({length / elapsed:10.0f} blocks/s)")
+
+
+def bench_memory(args):
+    """
+    Bytes per transaction held as decoded JSON dicts vs as compact records.
+    Each dict is decoded from its own JSON text, as it would be when it comes
+    off the wire, so it owns its copies of the address strings.
+    """
+    from transaction import TransactionRecord
+
+    keys = synthetic_keys(args.nodes)
+    encoded = [json.dumps(synthetic_transaction(random.choice(keys), random.choice(keys), nonce))
+               for nonce in range(args.transactions)]
+
+    gc.collect()
+    tracemalloc.start()
+    dicts = [json.loads(text) for text in encoded]
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    gc.collect()
+    tracemalloc.start()
+    records = [TransactionRecord.from_dict(json.loads(text)) for text in encoded]
+    record_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f"{args.transactions} transactions between {args.nodes} nodes")
+    print(f"  dicts:   {dict_bytes / len(dicts):8.1f} bytes/transaction")
+    print(f"  records: {record_bytes / len(records):8.1f} bytes/transaction")
+
+
+def bench_wire(args):
+    """
+    JSON vs the binary wire format for /receive_block payloads: encode and
+    decode time and bytes per block.
+    """
+    import wire
+
+    keys = synthetic_keys(args.nodes)
+    wire_keys = wire.WireKeys(keys)
+    print(f"{args.blocks} blocks per capacity, {args.nodes} registered nodes")
+    for capacity in args.capacities:
+        payloads = [block.to_dict() for block in synthetic_chain(args.blocks + 1, capacity, keys=keys)[1:]]
+
+        start = time.perf_counter()
+        json_bodies = [json.dumps(payload).encode() for payload in payloads]
+        json_encode = time.perf_counter() - start
+        start = time.perf_counter()
+        json_decoded = [json.loads(body) for body in json_bodies]
+        json_decode = time.perf_counter() - start
+
+        start = time.perf_counter()
+        wire_bodies = [wire.encode(payload, wire_keys) for payload in payloads]
+        wire_encode = time.perf_counter() - start
+        start = time.perf_counter()
+        wire_decoded = [wire.decode(body, wire_keys) for body in wire_bodies]
+        wire_decode = time.perf_counter() - start
+
+        if wire_decoded != json_decoded:
+            raise RuntimeError(f"Blocks of capacity {capacity} decode differently from the binary format and from JSON")
+        for name, bodies, encode_time, decode_time in (('json', json_bodies, json_encode, json_decode),
+                                                       ('binary', wire_bodies, wire_encode, wire_decode)):
+            size = sum(len(body) for body in bodies) / len(bodies)
+            print(f"capacity {capacity:>2} {name:>6}: {size:8.0f} bytes/block  "
+                  f"encode {encode_time / len(bodies) * 1e6:7.1f} us  decode {decode_time / len(bodies) * 1e6:7.1f} us")
+
+
+def bench_store(args):
+    """
+    Node startup time from the on-disk block store, full replay vs replay
+    from the latest state snapshot.
+    """
+    import shutil
+    import tempfile
+
+    from blockchain import Blockchain
+    from store import BlockStore
+
+    directory = tempfile.mkdtemp(prefix='blockstore-')
+    try:
+        store = BlockStore(directory, snapshot_interval=args.snapshot_interval)
+        blockchain = Blockchain(block_capacity=args.capacity, store=store)
+        chain = synthetic_chain(args.blocks, args.capacity)
+        start = time.perf_counter()
+        # Writes every block and a snapshot at the tip
+        blockchain.replace_chain(chain)
+        print(f"Wrote {args.blocks} blocks in {time.perf_counter() - start:.2f} s")
+        store.close()
+
+        for name, keep_snapshot in (('full replay', False), ('from snapshot', True)):
+            if not keep_snapshot:
+                os.rename(store.snapshot_path, store.snapshot_path + '.bak')
+            elif os.path.exists(store.snapshot_path + '.bak'):
+                os.rename(store.snapshot_path + '.bak', store.snapshot_path)
+            start = time.perf_counter()
+            restored = Blockchain(block_capacity=args.capacity, store=BlockStore(directory))
+            restored.load()
+            elapsed = time.perf_counter() - start
+            if restored.ledger.committed != blockchain.ledger.committed:
+                raise RuntimeError(f"Restored balances differ from the stored ones ({name})")
+            print(f"{name:>14}: {elapsed:6.2f} s for {len(restored.chain)} blocks")
+            restored.store.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_stress(args):
+    """
+    Many threads submitting transactions while a minter commits blocks and
+    readers query balances, then check that the chain, the pool and every
+    view the readers took are consistent.
+    """
+    import contextlib
+    import io
+
+    from block import Block
+    from blockchain import Blockchain
+    from state import BalanceLedger
+    from transaction import TransactionRecord
+
+    keys = synthetic_keys(args.nodes)
+    for threads in args.threads:
+        blockchain = Blockchain(block_capacity=args.capacity, mempool_size=threads * args.transactions)
+        welcome = [TransactionRecord.from_dict(dict(synthetic_transaction(0, key, 0), type_of_transaction='Welcome!',
+                                                    amount=1000.0)) for key in keys]
+        genesis = Block(index=0, transactions=welcome, validator=keys[0], previous_hash='1', capacity=len(keys))
+        genesis.current_hash = genesis.calculate_hash()
+        with contextlib.redirect_stdout(io.StringIO()):
+            blockchain.add_block(genesis)
+
+        done = Event()
+        views = []
+
+        def submit(worker):
+            for nonce in range(args.transactions):
+                transaction = synthetic_transaction(random.choice(keys), random.choice(keys), worker * args.transactions + nonce + 1)
+                blockchain.add_transaction_to_pool(TransactionRecord.from_dict(transaction))
+
+        def mint():
+            while not done.is_set() or blockchain.pool_full():
+                if not blockchain.pool_full():
+                    time.sleep(0.0005)
+                    continue
+                with blockchain.lock:
+                    previous_block = blockchain.get_last_block()
+                    block = Block(index=len(blockchain.chain), transactions=blockchain.take_block_transactions(),
+                                  validator=keys[0], previous_hash=previous_block.current_hash, capacity=args.capacity)
+                    block.current_hash = block.calculate_hash()
+                    blockchain.add_block(block)
+
+        def read():
+            while not done.is_set():
+                view = blockchain.view()
+                for key in keys:
+                    view.balance(key)
+                views.append(view)
+                time.sleep(0.001)
+
+        submitters = [Thread(target=submit, args=(worker,)) for worker in range(threads)]
+        others = [Thread(target=mint)] + [Thread(target=read) for _ in range(args.readers)]
+        # The chain and pool prints would dominate the run
+        with contextlib.redirect_stdout(io.StringIO()):
+            for thread in others:
+                thread.start()
+            start = time.perf_counter()
+            for thread in submitters:
+                thread.start()
+            for thread in submitters:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            done.set()
+            for thread in others:
+                thread.join()
+
+        # Every transaction is either in a block or still in the pool, once
+        committed = [transaction.transaction_id for block in blockchain.chain[1:] for transaction in block.transactions]
+        pending = [transaction.transaction_id for transaction in blockchain.transaction_pool]
+        # Explicit checks rather than asserts, which python -O would skip
+        if len(committed) + len(pending) != threads * args.transactions:
+            raise RuntimeError(f"{len(committed)} committed and {len(pending)} pending transactions, "
+                               f"{threads * args.transactions} were submitted")
+        if len(set(committed) | set(pending)) != len(committed) + len(pending):
+            raise RuntimeError("A transaction is in the chain or the pool more than once")
+        for previous, block in zip(blockchain.chain, blockchain.chain[1:]):
+            if block.previous_hash != previous.current_hash:
+                raise RuntimeError(f"Block {block.index} does not build on block {previous.index}")
+
+        # The live state, and the state of every view a reader took, match a replay of the blocks they cover
+        ledger = BalanceLedger()
+        ledger.rebuild(blockchain.chain, blockchain.transaction_pool)
+        if ledger.state() != blockchain.ledger.state():
+            raise RuntimeError("The live ledger differs from a replay of the chain and the pool")
+        for view in random.sample(views, min(len(views), args.checked_views)):
+            ledger.rebuild(view.since(), [])
+            if ledger.committed != view.ledger_state[0]:
+                raise RuntimeError(f"A reader view at height {view.height} differs from a replay of its blocks")
+
+        total = threads * args.transactions
+        print(f"{threads:>3} threads: {total} transactions in {elapsed:6.2f} s, {total / elapsed:9.0f} tx/s, "
+              f"{len(blockchain.chain)} blocks, {len(views)} reader views, consistent")
+
+
+def start_node_server(kind, node, ingest_queue, block_producer, port=0):
+    """
+    Serve a node on a local port, a free one by default, with the Flask or
+    the asyncio stack, from a background thread.
+
+    :return: the base url and a function that stops the server.
+    """
+    if kind == 'flask':
+        from werkzeug.serving import make_server
+        import logging
+        import rest
+
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        rest.node, rest.ingest_queue, rest.block_producer = node, ingest_queue, block_producer
+        server = make_server('127.0.0.1', port, rest.app, threaded=True)
+        Thread(target=server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{server.server_port}', server.shutdown
+
+    import asyncio
+    from aiohttp import web
+    from async_rest import AsyncNodeServer
+
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(AsyncNodeServer(node, ingest_queue, block_producer).app, access_log=None)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', port)
+    loop.run_until_complete(site.start())
+    Thread(target=loop.run_forever, daemon=True).start()
+    port = runner.addresses[0][1]
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+    return f'http://127.0.0.1:{port}', stop
+
+
+def load(url, path, payloads, clients):
+    """
+    POST the payloads with the given number of concurrent clients.
+
+    :return: elapsed seconds, per-request latencies and the number of non-2xx answers.
+    """
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+
+    sessions = [requests.Session() for _ in range(clients)]
+    chunks = [payloads[i::clients] for i in range(clients)]
+
+    def run(session, chunk):
+        latencies, failures = [], 0
+        for payload in chunk:
+            start = time.perf_counter()
+            response = session.post(url + path, json=payload)
+            latencies.append(time.perf_counter() - start)
+            failures += response.status_code >= 300
+        return latencies, failures
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        results = list(executor.map(run, sessions, chunks))
+    elapsed = time.perf_counter() - start
+    for session in sessions:
+        session.close()
+    return elapsed, [latency for latencies, _ in results for latency in latencies], sum(failures for _, failures in results)
+
+
+def bench_servers(args):
+    """
+    Requests/sec and p99 latency of the Flask and the asyncio server, for the
+    workload of each cluster size: the transactions of the node's trans0.txt
+    on /transactions/new, and /broadcast_blockchain, whose handler fans out
+    to every peer. The peers are local sinks that answer after a delay.
+    """
+    import contextlib
+    import io
+
+    from blockchain import Blockchain
+    from ingest import IngestQueue
+    from node import Node
+    from producer import BlockProducer
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    print(f"{args.clients} clients, {args.delay * 1000:.1f} ms peer delay")
+    for nodes in args.nodes:
+        with open(os.path.join(script_dir, f'{nodes}_nodes', 'trans0.txt')) as trans_file:
+            messages = [line.strip().split(' ', 1)[1] for line in trans_file if ' ' in line.strip()]
+        servers, peers = start_sinks(nodes - 1, args.delay)
+        keys = synthetic_keys(nodes - 1)
+
+        for kind in ('flask', 'asyncio'):
+            with contextlib.redirect_stdout(io.StringIO()):
+                node = Node('127.0.0.1', 0, Blockchain(block_capacity=args.capacity), is_bootstrap=True, total_nodes=nodes)
+                for node_id, peer_url in peers.items():
+                    node.nodes[node_id + 1] = {'public_key': keys[node_id], 'address': peer_url}
+                block_producer = BlockProducer(node)
+                block_producer.start()
+                ingest_queue = IngestQueue(node, block_producer, maxsize=len(messages) * args.rounds)
+                ingest_queue.start()
+                url, stop = start_node_server(kind, node, ingest_queue, block_producer)
+
+                transactions = []
+                for nonce in range(len(messages) * args.rounds):
+                    transactions.append({
+                        'sender_address': node.wallet.public_key, 'receiver_address': random.choice(keys),
+                        'type_of_transaction': 'message', 'amount': 0, 'message': messages[nonce % len(messages)],
+                        'nonce': nonce + 1, 'private_key': node.wallet.private_key,
+                    })
+                transaction_run = load(url, '/transactions/new', transactions, args.clients)
+                broadcast_run = load(url, '/broadcast_blockchain', [{}] * args.broadcasts, args.clients)
+                stop()
+                block_producer.stop()
+
+            for endpoint, (elapsed, latencies, failures) in (('transactions', transaction_run),
+                                                             ('broadcast', broadcast_run)):
+                print(f"{nodes:>3} nodes {kind:>8} {endpoint:>12}: {len(latencies) / elapsed:8.0f} req/s  "
+                      f"p50 {numpy.percentile(latencies, 50) * 1000:7.2f} ms  "
+                      f"p99 {numpy.percentile(latencies, 99) * 1000:7.2f} ms  {failures} failed")
+
+        for server in servers:
+            server.shutdown()
+
+
+def bench_metrics(args):
+    """
+    Cost of the instrumentation: a timed stage on its own, and pool
+    insertions with the metrics recorded and switched off.
+    """
+    import contextlib
+    import io
+
+    from blockchain import Blockchain
+    from metrics import metrics
+    from transaction import TransactionRecord
+
+    for enabled in (True, False):
+        metrics.enabled = enabled
+        start = time.perf_counter()
+        for _ in range(args.operations):
+            with metrics.time_stage('benchmark'):
+                pass
+        stage_time = (time.perf_counter() - start) / args.operations
+
+        keys = synthetic_keys(10)
+        transactions = [TransactionRecord.from_dict(synthetic_transaction(random.choice(keys), random.choice(keys), nonce))
+                        for nonce in range(args.transactions)]
+        blockchain = Blockchain(mempool_size=args.transactions)
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            for transaction in transactions:
+                blockchain.add_transaction_to_pool(transaction)
+            insert_time = (time.perf_counter() - start) / args.transactions
+        print(f"metrics {'on ' if enabled else 'off'}: timed stage {stage_time * 1e6:6.2f} us, "
+              f"pool insert {insert_time * 1e6:6.2f} us")
+    metrics.enabled = True
+
+
+def bench_replay(args):
+    """
+    Throughput of a replay against one node: one /transactions/new request
+    per transaction, then batches on /transactions/batch with a growing
+    number in flight, against the node's own validation rate.
+    """
+    import contextlib
+    import io
+    import requests
+
+    from blockchain import Blockchain
+    from broadcast import BatchPipeline, Broadcaster
+    from ingest import IngestQueue
+    from metrics import metrics
+    from node import Node
+    from producer import BlockProducer
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        # Enough nodes for the bootstrap's funds to cover every message
+        node = Node('127.0.0.1', 0, Blockchain(block_capacity=args.capacity, mempool_size=10 ** 6),
+                    is_bootstrap=True, total_nodes=1000)
+        block_producer = BlockProducer(node)
+        ingest_queue = IngestQueue(node, block_producer, maxsize=args.queue_size)
+        ingest_queue.start()
+        url, stop = start_node_server(args.server, node, ingest_queue, block_producer)
+    nonces = iter(range(1, 10 ** 9))
+
+    def transactions(count):
+        return [{'sender_address': node.wallet.public_key, 'receiver_address': node.wallet.public_key,
+                 'type_of_transaction': 'message', 'amount': 0.0, 'message': 'Lunchtime doubly so.',
+                 'nonce': next(nonces), 'private_key': node.wallet.private_key} for _ in range(count)]
+
+    def wait_processed(target):
+        received = metrics.counter('transactions_received_total')
+        while received.value < target:
+            time.sleep(0.001)
+
+    results = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        # In the batches the ingest worker takes, so the node does the same work as when serving
+        pending = transactions(args.transactions)
+        start = time.perf_counter()
+        added = sum(node.receive_transactions(pending[offset:offset + ingest_queue.batch_size])
+                    for offset in range(0, len(pending), ingest_queue.batch_size))
+        results.append(('validation limit', time.perf_counter() - start, added))
+
+        received = metrics.counter('transactions_received_total')
+        session = requests.Session()
+        target = received.value + args.transactions
+        start = time.perf_counter()
+        for values in transactions(args.transactions):
+            while session.post(url + '/transactions/new', json=values).status_code == 429:
+                time.sleep(0.01)
+        wait_processed(target)
+        results.append(('per transaction', time.perf_counter() - start, args.transactions))
+
+        for in_flight in args.in_flight:
+            target = received.value + args.transactions
+            pipeline = BatchPipeline(Broadcaster(), {0: url}, '/transactions/batch', in_flight)
+            pending = transactions(args.transactions)
+            start = time.perf_counter()
+            for offset in range(0, len(pending), args.batch_size):
+                pipeline.submit({'transactions': pending[offset:offset + args.batch_size]})
+            pipeline.close()
+            wait_processed(target)
+            results.append((f'batch, {in_flight} in flight', time.perf_counter() - start, args.transactions))
+        stop()
+
+    limit = results[0][2] / results[0][1]
+    print(f"{args.transactions} transactions per run, batches of {args.batch_size}, {args.server} server")
+    for name, elapsed, count in results:
+        print(f"{name:>20}: {count / elapsed:8.0f} tx/s  {count / elapsed / limit:6.1%} of the validation limit")
+
+
+def bench_gossip(args):
+    """
+    Dissemination of transactions from one node to all of them, with the
+    origin posting to every node against gossip relaying along a tree.
+
+    The nodes are in-process HTTP servers running the real Gossip relay on a
+    stand-in node; each handler waits the given delay, as a node would while
+    taking a transaction. Origin CPU is the thread CPU time spent in the
+    origin's own posts.
+    """
+    from threading import Lock
+    from types import SimpleNamespace
+
+    import wire
+    from broadcast import Broadcaster
+    from gossip import Gossip
+
+    class CountingBroadcaster(Broadcaster):
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.cpu = 0.0
+            self.messages = 0
+            self.count_lock = Lock()
+
+        def post(self, peer_url, path, payload, body=None, content_type=wire.CONTENT_TYPE):
+            start = time.thread_time()
+            result = super().post(peer_url, path, payload, body, content_type)
+            with self.count_lock:
+                self.cpu += time.thread_time() - start
+                self.messages += 1
+            return result
+
+    class GossipHandler(SinkHandler):
+        """
+        A node endpoint: counts the message, and in gossip mode passes on
+        the ones it sees for the first time.
+        """
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if self.delay:
+                time.sleep(self.delay)
+            self.simulation.arrived(self.gossip, self.path, payload)
+            body = b'{"message": "ok"}'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    class Simulation:
+        def __init__(self, nodes):
+            self.nodes = nodes
+            self.lock = Lock()
+            self.messages = 0
+            self.reached = {}
+            self.done = {}
+
+        def expect(self, key):
+            with self.lock:
+                self.reached[key] = 0
+                self.done[key] = Event()
+            return self.done[key]
+
+        def arrived(self, gossip, path, payload):
+            key = payload['transaction_id']
+            with self.lock:
+                self.messages += 1
+            if gossip is not None:
+                if not gossip.first_seen(key):
+                    return
+                gossip.relay(path, payload)
+            with self.lock:
+                self.reached[key] += 1
+                if self.reached[key] == self.nodes:
+                    self.done[key].set()
+
+    def run(nodes, fanout):
+        simulation = Simulation(nodes)
+        servers, stand_ins = [], []
+        for node_id in range(nodes):
+            stand_in = SimpleNamespace(nodes={}, node_ids_by_key={}, wallet=SimpleNamespace(public_key=f'key{node_id}'),
+                                       broadcaster=CountingBroadcaster())
+            gossip = Gossip(stand_in, fanout=fanout) if fanout else None
+            handler = type('SimulatedNodeHandler', (GossipHandler,),
+                           {'delay': args.delay, 'simulation': simulation, 'gossip': gossip})
+            server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+            server.protocol_version = 'HTTP/1.1'
+            Thread(target=server.serve_forever, daemon=True).start()
+            stand_in.api_url = f'http://127.0.0.1:{server.server_address[1]}'
+            stand_in.gossip = gossip
+            servers.append(server)
+            stand_ins.append(stand_in)
+        roster = {str(node_id): {'address': stand_in.api_url, 'public_key': stand_in.wallet.public_key}
+                  for node_id, stand_in in enumerate(stand_ins)}
+        for stand_in in stand_ins:
+            stand_in.nodes = roster
+            stand_in.node_ids_by_key = {node_info['public_key']: node_id for node_id, node_info in roster.items()}
+
+        origin = stand_ins[0]
+        keys = synthetic_keys(2)
+        propagation = []
+        for nonce in range(1, args.messages + 1):
+            payload = synthetic_transaction(keys[0], keys[1], nonce)
+            done = simulation.expect(payload['transaction_id'])
+            start = time.perf_counter()
+            if origin.gossip is not None:
+                origin.gossip.originate('/transactions/new', payload)
+            else:
+                origin.broadcaster.post_all({node_id: node_info['address'] for node_id, node_info in roster.items()},
+                                            '/transactions/new', payload)
+            if not done.wait(timeout=30):
+                raise RuntimeError(f"Message {nonce} did not reach all {nodes} nodes")
+            propagation.append(time.perf_counter() - start)
+
+        for server in servers:
+            server.shutdown()
+        for stand_in in stand_ins:
+            stand_in.broadcaster.close()
+        return {
+            'origin_messages': origin.broadcaster.messages / args.messages,
+            'origin_cpu': origin.broadcaster.cpu / args.messages,
+            'messages': simulation.messages / args.messages,
+            'propagation': numpy.array(propagation),
+        }
+
+    print(f"{args.messages} messages from one node, {args.delay * 1000:.1f} ms handler delay, gossip fanout {args.fanout}")
+    print(f"{'nodes':>5} {'mode':>11} {'origin msgs':>11} {'origin cpu':>11} {'total msgs':>10} {'full p50':>9} {'full p99':>9}")
+    for nodes in args.nodes:
+        for mode, fanout in (('all-to-all', 0), ('gossip', args.fanout)):
+            result = run(nodes, fanout)
+            propagation = result['propagation'] * 1000
+            print(f"{nodes:>5} {mode:>11} {result['origin_messages']:>11.1f} {result['origin_cpu'] * 1000:>8.2f} ms "
+                  f"{result['messages']:>10.1f} {numpy.percentile(propagation, 50):>6.1f} ms "
+                  f"{numpy.percentile(propagation, 99):>6.1f} ms")
+
+
+def bench_bootstrap(args):
+    """
+    Time for a network of in-process nodes to come up: every node registers
+    with the bootstrap at once, and the network is up when every node has
+    the full roster and the bootstrap's tip. Node keys are generated before
+    the clock starts, the protocol is what is measured.
+    """
+    import contextlib
+    import io
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+
+    from blockchain import Blockchain
+    from cluster import free_port
+    from ingest import IngestQueue
+    from node import Node
+    from producer import BlockProducer
+
+    def bring_up(count):
+        nodes, stops = [], []
+        with contextlib.redirect_stdout(io.StringIO()):
+            for index in range(count):
+                node = Node('127.0.0.1', free_port(), Blockchain(block_capacity=args.capacity),
+                            is_bootstrap=index == 0, total_nodes=count)
+                block_producer = BlockProducer(node)
+                url, stop = start_node_server('asyncio', node, IngestQueue(node, block_producer), block_producer,
+                                              port=int(node.api_url.rsplit(':', 1)[1]))
+                nodes.append(node)
+                stops.append(stop)
+
+            def register(node):
+                requests.post(nodes[0].api_url + '/register',
+                              json={'public_key': node.wallet.public_key, 'node_address': node.api_url})
+
+            def up():
+                tip = nodes[0].tip()
+                return all(len(node.nodes) == count and node.tip() == tip for node in nodes)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.clients) as executor:
+                list(executor.map(register, nodes[1:]))
+            registered = time.perf_counter() - start
+            deadline = time.time() + 120
+            while not up():
+                if time.time() > deadline:
+                    raise RuntimeError(f"{count} nodes did not come up within 120 s")
+                time.sleep(0.005)
+            elapsed = time.perf_counter() - start
+            for stop in stops:
+                stop()
+        return registered, elapsed
+
+    print(f"In-process asyncio nodes, block capacity {args.capacity}, {args.clients} registering at a time")
+    for count in args.nodes:
+        registered, elapsed = bring_up(count)
+        print(f"{count:>5} nodes: all registered in {registered:6.2f} s, network up in {elapsed:6.2f} s")
+
+
+def bench_startup(args):
+    """
+    Node start-to-ready time with and without a keystore of pre-generated
+    wallet keys. Nodes are started one at a time first, each timed from
+    launch until it has registered and answers /tip, then a whole cluster is
+    started at once and timed until every node has the same tip.
+    """
+    import shutil
+    import tempfile
+
+    from cluster import Cluster, free_port
+    from keystore import KeyStore
+
+    directory = tempfile.mkdtemp(prefix='startup-')
+    keystore_dir = os.path.join(directory, 'keys')
+    for workers in (1, args.workers):
+        shutil.rmtree(keystore_dir, ignore_errors=True)
+        start = time.perf_counter()
+        KeyStore(keystore_dir).fill(args.nodes, workers)
+        print(f"Keystore of {args.nodes} keys with {workers or os.cpu_count()} workers: {time.perf_counter() - start:.2f} s")
+
+    print(f"{args.server} nodes, one at a time")
+    for keystore in (None, keystore_dir):
+        work_dir = tempfile.mkdtemp(dir=directory)
+        cluster = Cluster(args.nodes, 5, work_dir, server=args.server, keystore=keystore)
+        ready = []
+        try:
+            for index in range(args.nodes):
+                start = time.perf_counter()
+                cluster.launch(free_port(), is_bootstrap=index == 0)
+                cluster.wait_ready(cluster.urls[-1], cluster.processes[-1])
+                ready.append(time.perf_counter() - start)
+        finally:
+            cluster.stop()
+        joins = numpy.array(ready[1:]) * 1000
+        print(f"{'keystore' if keystore else 'new keys':>9}: bootstrap {ready[0] * 1000:6.0f} ms, others p50 "
+              f"{numpy.percentile(joins, 50):6.0f} ms, p90 {numpy.percentile(joins, 90):6.0f} ms, max {joins.max():6.0f} ms")
+
+    print(f"{args.server} cluster of {args.nodes}, all at once")
+    for keystore in (None, keystore_dir):
+        cluster = Cluster(args.nodes, 5, tempfile.mkdtemp(dir=directory), server=args.server, keystore=keystore)
+        try:
+            bring_up = cluster.start()
+        finally:
+            cluster.stop()
+        print(f"{'keystore' if keystore else 'new keys':>9}: up in {bring_up:6.2f} s")
+    shutil.rmtree(directory)
+
+
+def write_synthetic_chain_body(path, length, capacity, corrupt_at=None):
+    """
+    Write a synthetic chain as an /update_blockchain JSON body, one block at a
+    time so the chain is never held in memory.
+
+    :param corrupt_at: height of a block whose transactions are altered after
+        hashing, so its hash no longer matches.
+    """
+    from block import Block
+    from jsonstream import write_object
+    from transaction import TransactionRecord
+
+    keys = synthetic_keys(10)
+
+    def encoded_blocks():
+        previous = Block(index=0, transactions=[], validator=keys[0], previous_hash='1', capacity=capacity)
+        yield previous.to_json()
+        nonce = 0
+        for index in range(1, length):
+            transactions = []
+            for _ in range(capacity):
+                nonce += 1
+                transactions.append(TransactionRecord.from_dict(synthetic_transaction(random.choice(keys), random.choice(keys), nonce)))
+            block = Block(index=index, transactions=transactions, validator=random.choice(keys),
+                          previous_hash=previous.current_hash, capacity=capacity)
+            block_data = block.to_dict()
+            if index == corrupt_at:
+                block_data['transactions'][0] = dict(block_data['transactions'][0], message='altered')
+            yield json.dumps(block_data)
+            previous = block
+
+    with open(path, 'w') as body_file:
+        for fragment in write_object('blockchain_data', encoded_blocks(), {'transaction_pool': []}):
+            body_file.write(fragment)
+
+
+def bench_transfer(args):
+    """
+    Peak memory and time of a node taking a long chain on /update_blockchain,
+    for a valid chain and for one with a bad block early on. The node is a
+    rest.py process, its peak RSS read from /proc.
+    """
+    import subprocess
+    import sys
+    import tempfile
+    import requests
+
+    from cluster import free_port, process_usage
+
+    directory = tempfile.mkdtemp(prefix='transfer-')
+    node_script = args.node_script or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rest.py')
+    print(f"Receiving node: {node_script}, {args.server} server, block capacity {args.capacity}")
+    for length in args.blocks:
+        for name, corrupt_at in (('valid', None), ('bad block', length // 10)):
+            path = os.path.join(directory, f'chain{length}.json')
+            write_synthetic_chain_body(path, length, args.capacity, corrupt_at)
+            size = os.path.getsize(path)
+
+            port = free_port()
+            process = subprocess.Popen([sys.executable, node_script, '--host', '127.0.0.1', '--port', str(port),
+                                        '--is_bootstrap', '--total_nodes', '1', '--block_capacity', str(args.capacity),
+                                        '--server', args.server],
+                                       cwd=directory, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            url = f'http://127.0.0.1:{port}'
+            try:
+                while True:
+                    try:
+                        requests.get(url + '/tip', timeout=1)
+                        break
+                    except requests.exceptions.RequestException:
+                        time.sleep(0.1)
+                rss_before = process_usage(process.pid)[1]
+
+                start = time.perf_counter()
+                try:
+                    with open(path, 'rb') as body_file:
+                        status = requests.post(url + '/update_blockchain', data=body_file, timeout=3600,
+                                               headers={'Content-Type': 'application/json'}).status_code
+                except requests.exceptions.ConnectionError:
+                    # The node answered and closed the connection before the whole body was sent
+                    status = 'closed'
+                elapsed = time.perf_counter() - start
+                peak_rss = process_usage(process.pid)[1]
+                height = requests.get(url + '/tip', timeout=60).json()['height']
+            finally:
+                process.terminate()
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+                os.remove(path)
+
+            print(f"{length:>7} blocks, {name:>9}: body {size / 2 ** 20:7.1f} MB, answer {status} in {elapsed:6.2f} s, "
+                  f"height {height:>7}, peak RSS {peak_rss / 1024:7.1f} MB (+{(peak_rss - rss_before) / 1024:.1f} MB)")
+    os.rmdir(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BlockChat micro-benchmarks.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    broadcast_parser = subparsers.add_parser('broadcast', help='Sequential vs pooled concurrent broadcast')
+    broadcast_parser.add_argument('--nodes', type=int, default=10, help='Number of local peers')
+    broadcast_parser.add_argument('--rounds', type=int, default=200, help='Number of broadcasts to time')
+    broadcast_parser.add_argument('--delay', type=float, default=0.002, help='Simulated handler time in seconds')
+    broadcast_parser.set_defaults(func=bench_broadcast)
+
+    validate_parser = subparsers.add_parser('validate', help='Single-process vs parallel chain validation')
+    validate_parser.add_argument('--lengths', type=int, nargs='+', default=[1000, 10000, 100000], help='Chain lengths to validate')
+    validate_parser.add_argument('--capacity', type=int, default=5, help='Transactions per block')
+    validate_parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes for the parallel run')
+    validate_parser.set_defaults(func=bench_validate)
+
+    memory_parser = subparsers.add_parser('memory', help='Memory per transaction, dicts vs records')
+    memory_parser.add_argument('--transactions', type=int, default=100000, help='Number of transactions')
+    memory_parser.add_argument('--nodes', type=int, default=10, help='Number of distinct node keys')
+    memory_parser.set_defaults(func=bench_memory)
+
+    wire_parser = subparsers.add_parser('wire', help='JSON vs binary block encoding')
+    wire_parser.add_argument('--capacities', type=int, nargs='+', default=[5, 10, 20], help='Transactions per block')
+    wire_parser.add_argument('--blocks', type=int, default=2000, help='Blocks to encode per capacity')
+    wire_parser.add_argument('--nodes', type=int, default=10, help='Number of registered nodes')
+    wire_parser.set_defaults(func=bench_wire)
+
+    store_parser = subparsers.add_parser('store', help='Startup time from the on-disk block store')
+    store_parser.add_argument('--blocks', type=int, default=100000, help='Chain length')
+    store_parser.add_argument('--capacity', type=int, default=5, help='Transactions per block')
+    store_parser.add_argument('--snapshot_interval', type=int, default=1000, help='Blocks between state snapshots')
+    store_parser.set_defaults(func=bench_store)
+
+    stress_parser = subparsers.add_parser('stress', help='Concurrent submission, minting and reads, checked for consistency')
+    stress_parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8], help='Submitting thread counts to run')
+    stress_parser.add_argument('--transactions', type=int, default=2000, help='Transactions per submitting thread')
+    stress_parser.add_argument('--capacity', type=int, default=10, help='Transactions per block')
+    stress_parser.add_argument('--nodes', type=int, default=10, help='Number of distinct node keys')
+    stress_parser.add_argument('--readers', type=int, default=2, help='Threads reading balances meanwhile')
+    stress_parser.add_argument('--checked_views', type=int, default=20, help='Reader views replayed and checked')
+    stress_parser.set_defaults(func=bench_stress)
+
+    servers_parser = subparsers.add_parser('servers', help='Flask vs asyncio node server, requests/sec and p99 latency')
+    servers_parser.add_argument('--nodes', type=int, nargs='+', default=[5, 10], help='Cluster sizes, the workload comes from <n>_nodes')
+    servers_parser.add_argument('--clients', type=int, default=32, help='Concurrent client connections')
+    servers_parser.add_argument('--rounds', type=int, default=10, help='Times the trans0.txt workload is sent')
+    servers_parser.add_argument('--broadcasts', type=int, default=500, help='Number of /broadcast_blockchain requests')
+    servers_parser.add_argument('--delay', type=float, default=0.005, help='Simulated peer handler time in seconds')
+    servers_parser.add_argument('--capacity', type=int, default=5, help='Transactions per block')
+    servers_parser.set_defaults(func=bench_servers)
+
+    metrics_parser = subparsers.add_parser('metrics', help='Overhead of the stage timers and counters')
+    metrics_parser.add_argument('--operations', type=int, default=1000000, help='Timed empty stages')
+    metrics_parser.add_argument('--transactions', type=int, default=50000, help='Pool insertions')
+    metrics_parser.set_defaults(func=bench_metrics)
+
+    replay_parser = subparsers.add_parser('replay', help='Per-transaction vs batched pipelined submission against the validation limit')
+    replay_parser.add_argument('--transactions', type=int, default=2000, help='Transactions per run')
+    replay_parser.add_argument('--batch_size', type=int, default=50, help='Transactions per batch')
+    replay_parser.add_argument('--in_flight', type=int, nargs='+', default=[1, 4, 16], help='Batches queued ahead to run with')
+    replay_parser.add_argument('--queue_size', type=int, default=1000, help='Ingest queue size of the node')
+    replay_parser.add_argument('--capacity', type=int, default=50, help='Transactions per block')
+    replay_parser.add_argument('--server', choices=['flask', 'asyncio'], default='flask', help='HTTP server stack of the node')
+    replay_parser.set_defaults(func=bench_replay)
+
+    gossip_parser = subparsers.add_parser('gossip', help='All-to-all vs gossip dissemination, origin cost and time to reach every node')
+    gossip_parser.add_argument('--nodes', type=int, nargs='+', default=[10, 50, 100], help='Network sizes to simulate')
+    gossip_parser.add_argument('--fanout', type=int, default=3, help='Peers each node relays to')
+    gossip_parser.add_argument('--messages', type=int, default=50, help='Messages sent from the origin per run')
+    gossip_parser.add_argument('--delay', type=float, default=0.001, help='Seconds each node takes to handle a message')
+    gossip_parser.set_defaults(func=bench_gossip)
+
+    bootstrap_parser = subparsers.add_parser('bootstrap', help='Network bring-up time, registration to every node holding the roster and chain')
+    bootstrap_parser.add_argument('--nodes', type=int, nargs='+', default=[5, 10, 50, 100], help='Network sizes to bring up')
+    bootstrap_parser.add_argument('--capacity', type=int, default=5, help='Transactions per block')
+    bootstrap_parser.add_argument('--clients', type=int, default=16, help='Registrations in flight at once')
+    bootstrap_parser.set_defaults(func=bench_bootstrap)
+
+    startup_parser = subparsers.add_parser('startup', help='Node start-to-ready time with and without a keystore')
+    startup_parser.add_argument('--nodes', type=int, default=10, help='Nodes to start')
+    startup_parser.add_argument('--workers', type=int, help='Processes filling the keystore, one per CPU if unset')
+    startup_parser.add_argument('--server', choices=['flask', 'asyncio'], default='flask', help='HTTP server stack of the nodes')
+    startup_parser.set_defaults(func=bench_startup)
+
+    transfer_parser = subparsers.add_parser('transfer', help='Peak memory of a node taking a long chain on /update_blockchain')
+    transfer_parser.add_argument('--blocks', type=int, nargs='+', default=[10000, 100000], help='Chain lengths to send')
+    transfer_parser.add_argument('--capacity', type=int, default=5, help='Transactions per block')
+    transfer_parser.add_argument('--server', choices=['flask', 'asyncio'], default='flask', help='HTTP server stack of the node')
+    transfer_parser.add_argument('--node_script', type=str, help='rest.py to run the node from, such as an older checkout to compare with')
+    transfer_parser.set_defaults(func=bench_transfer)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,50 +2,129 @@ import time
 import hashlib
 import json
 
+from transaction import TransactionRecord
+
 class Block:
     def __init__(self, index, transactions, validator, previous_hash, capacity=5, timestamp=None, current_hash=None):
         self.index = index
         self.start_time = time.time()  # Record when block creation starts
         self.timestamp = round(timestamp if timestamp is not None else time.time(), 4)
-        self.transactions = transactions[:capacity]  # Limit transactions to capacity
+        self.records = transactions[:capacity]  # Limit transactions to capacity
+        # Blocks loaded from the store read their transactions from disk only
+        # when first needed
+        self.load_transactions = None
+        self.transaction_count = len(self.records)
         self.validator = validator
         self.previous_hash = previous_hash
         self.capacity = capacity
+        # Blocks are immutable once built, so their encodings are computed once and kept
+        self.hash_payload = None
+        self.wire_dict = None
+        self.encoded = None
         self.current_hash = current_hash if current_hash is not None else self.calculate_hash()
         self.end_time = time.time()  # Record when block creation ends
 
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Build a block from its wire form, turning its transactions into records.
+        """
+        fields = dict(data)
+        fields['transactions'] = [TransactionRecord.from_dict(tx) for tx in data['transactions']]
+        return cls(**fields)
+
+    @classmethod
+    def from_stored(cls, header, load_transactions):
+        """
+        Build a block from its header in the block store. The block was
+        validated before it was stored, so its hash is trusted, and its
+        transactions are read with load_transactions on first use.
+        """
+        block = cls(index=header['index'], transactions=[], validator=header['validator'],
+                    previous_hash=header['previous_hash'], capacity=header['capacity'],
+                    timestamp=header['timestamp'], current_hash=header['current_hash'])
+        block.records = None
+        block.load_transactions = load_transactions
+        block.transaction_count = header['transaction_count']
+        return block
+
+    def header(self):
+        """
+        Every field of the block but its transactions.
+        """
+        return {
+            'index': self.index,
+            'timestamp': self.timestamp,
+            'validator': self.validator,
+            'previous_hash': self.previous_hash,
+            'current_hash': self.current_hash,
+            'capacity': self.capacity,
+            'transaction_count': self.transaction_count,
+        }
+
+    @property
+    def transactions(self):
+        if self.records is None:
+            self.records = [TransactionRecord.from_dict(tx) for tx in self.load_transactions()]
+            self.load_transactions = None
+        return self.records
+
+    def __getstate__(self):
+        # The loader reads from the store of this process, send the records instead
+        state = dict(self.__dict__)
+        state['records'] = self.transactions
+        state['load_transactions'] = None
+        return state
+
     def block_creation_time(self):
         return self.end_time - self.start_time
-    
+
+    def transaction_dicts(self):
+        if self.records is None:
+            return self.load_transactions()
+        return [tx.to_dict() for tx in self.records]
+
     def serialize_for_hash(self):
         # Serialize block data in a consistent order
-        block_data = {
-            'index': self.index,
-            'transactions': [tx.to_dict() if hasattr(tx, 'to_dict') else tx for tx in self.transactions],            
-            'validator': self.validator,
-            'previous_hash': self.previous_hash
-        }
-        return json.dumps(block_data, sort_keys=True)
-    
+        if self.hash_payload is None:
+            block_data = {
+                'index': self.index,
+                'transactions': self.transaction_dicts(),
+                'validator': self.validator,
+                'previous_hash': self.previous_hash
+            }
+            self.hash_payload = json.dumps(block_data, sort_keys=True)
+        return self.hash_payload
+
     def calculate_hash(self):
         # Use serialized block data for hash calculation
         block_string = self.serialize_for_hash()
         return hashlib.sha256(block_string.encode()).hexdigest()
-    
+
     def to_dict(self):
-         
-        transactions_dict_list = [tx.to_dict() if hasattr(tx, 'to_dict') else tx for tx in self.transactions]
+        if self.wire_dict is None or self.wire_dict['current_hash'] != self.current_hash:
+            self.wire_dict = {
+                'index': self.index,
+                'timestamp': self.timestamp,
+                'transactions': self.transaction_dicts(),
+                'validator': self.validator,
+                'previous_hash': self.previous_hash,
+                'current_hash': self.current_hash,
+                'capacity': self.capacity
+            }
+            self.encoded = None
 
-        return {
-            'index': self.index,
-            'timestamp': self.timestamp,
-            'transactions': transactions_dict_list,
-            'validator': self.validator,
-            'previous_hash': self.previous_hash,
-            'current_hash': self.current_hash,
-            'capacity': self.capacity
-        }
+        # Shallow copy so callers can add or replace keys without touching the cache
+        return dict(self.wire_dict)
+
+    def to_json(self):
+        """
+        The block encoded as a JSON string, ready to be written to the wire.
+        """
+        if self.encoded is None or self.wire_dict['current_hash'] != self.current_hash:
+            self.encoded = json.dumps(self.to_dict())
+        return self.encoded
 
 
     def __repr__(self):
-        return f"Block(Index: {self.index}, Hash: {self.current_hash}, Prev Hash: {self.previous_hash}, Transactions: {len(self.transactions)})"
\ No newline at end of file
+        return f"Block(Index: {self.index}, Hash: {self.current_hash}, Prev Hash: {self.previous_hash}, Transactions: {self.transaction_count})"
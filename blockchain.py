@@ -1,34 +1,317 @@
-import random
+import os
+from collections import deque
+from threading import RLock
+from concurrent.futures import ProcessPoolExecutor
 
-from flask.json import jsonify
 from block import Block
+from mempool import Mempool
+from metrics import metrics
+from state import BalanceLedger, NonceTracker, StakeRegistry, TransactionIndex
 
 import time
 import hashlib
 
+# Below this many blocks the hashes are checked in-process, the round trip to
+# the worker processes costs more than it saves
+PARALLEL_VALIDATION_THRESHOLD = 256
+
+# Blocks of a chain being received whose hashes are checked together
+CHAIN_CHECK_BATCH = 1024
+
+validation_pool = None
+
+
+def block_hash_matches(block):
+    """
+    Recompute the hash of a block and compare it with the stored one.
+    """
+    recalculated_hash = hashlib.sha256(block.serialize_for_hash().encode()).hexdigest()
+    return recalculated_hash == block.current_hash
+
+
+def check_block_hashes(blocks, workers=None):
+    """
+    Check the hash of every block, across a process pool for long chains.
+    The checks are independent of each other, only the links between blocks
+    need to be checked in order.
+
+    :return: list of booleans, one per block.
+    """
+    global validation_pool
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(blocks) < PARALLEL_VALIDATION_THRESHOLD:
+        return [block_hash_matches(block) for block in blocks]
+
+    if validation_pool is None:
+        validation_pool = ProcessPoolExecutor(max_workers=workers)
+    chunksize = max(1, len(blocks) // (workers * 4))
+    return list(validation_pool.map(block_hash_matches, blocks, chunksize=chunksize))
+
+
+class ChainBuilder:
+    """
+    Validates a chain while it is received, so a transfer can be dropped at
+    the first bad block instead of after the whole chain was built.
+
+    Every block must link to the one before it. Hashes are checked in runs
+    of batch blocks, across the process pool as in validate_chain, so a bad
+    hash is found within a run of where it is. As in validate_chain, the
+    hash of the first block is not checked.
+    """
+    def __init__(self, batch=CHAIN_CHECK_BATCH, workers=None):
+        self.batch = batch
+        self.workers = workers
+        self.blocks = []
+        self.unchecked = 0
+        self.valid = True
+
+    def add(self, block):
+        """
+        :return: False if the chain is invalid up to this block.
+        """
+        if not self.valid:
+            return False
+        if self.blocks and block.previous_hash != self.blocks[-1].current_hash:
+            print("Blockchain integrity compromised at Block", block.index)
+            self.valid = False
+            return False
+        self.blocks.append(block)
+        if len(self.blocks) == 1:
+            return True
+        self.unchecked += 1
+        if self.unchecked >= self.batch:
+            return self.check_hashes()
+        return True
+
+    def extend(self, blocks):
+        return all(self.add(block) for block in blocks)
+
+    def check_hashes(self):
+        run = self.blocks[len(self.blocks) - self.unchecked:]
+        self.unchecked = 0
+        for block, matches in zip(run, check_block_hashes(run, self.workers)):
+            if not matches:
+                print("Block hash calculation mismatch at Block", block.index)
+                self.valid = False
+                return False
+        return True
+
+    def finish(self):
+        """
+        :return: the validated blocks, or None if the chain is invalid.
+        """
+        if self.valid and self.unchecked:
+            self.check_hashes()
+        return self.blocks if self.valid else None
+
+
+def located_transaction_dict(transaction, block, position):
+    """
+    A committed transaction with the block it is in, for the lookup endpoints.
+    """
+    return dict(transaction.to_dict(), height=block.index, position=position, block_hash=block.current_hash)
+
+
+class ChainView:
+    """
+    Read-only view of the chain and of the balances and stakes derived from
+    it, as they were at one point in time.
+
+    The chain list is only ever appended to, or replaced by a new list, so
+    its first height blocks never change. The state dicts are never changed
+    in place either, a writer swaps in new ones.
+    """
+    __slots__ = ('blocks', 'height', 'ledger', 'ledger_state', 'stake_registry', 'stake_state')
+
+    def __init__(self, blockchain):
+        self.blocks = blockchain.chain
+        self.height = len(self.blocks)
+        self.ledger = blockchain.ledger
+        self.ledger_state = blockchain.ledger.state()
+        self.stake_registry = blockchain.stake_registry
+        self.stake_state = blockchain.stake_registry.state()
+
+    def tip(self):
+        return self.blocks[self.height - 1] if self.height else None
+
+    def since(self, start=0):
+        return self.blocks[start:self.height]
+
+    def balance(self, public_key):
+        return self.ledger.balance(public_key, self.ledger_state)
+
+    def stake(self, public_key):
+        return self.stake_registry.stake(public_key, self.stake_state)
+
+
 class Blockchain:
-    def __init__(self, block_capacity=5):
+    """
+    The chain, the transaction pool and the state derived from them.
+
+    Changes go through one writer at a time, under self.lock, and each change
+    ends by publishing a new ChainView. Readers take the current view with
+    view() and never wait for the lock.
+    """
+    def __init__(self, block_capacity=5, store=None, mempool_size=10000):
+        self.lock = RLock()
         self.chain = []
-        self.transaction_pool = []
-        self.stakes = {} 
+        self.store = store
+        self.transaction_pool = Mempool(max_size=mempool_size)
+        # When each transaction was first seen, and how long the most recent
+        # ones waited until a block included them
+        self.first_seen = {}
+        self.first_seen_limit = 10 * mempool_size
+        self.inclusion_latencies = deque(maxlen=100000)
+        # Latencies recorded so far, including those dropped from the deque
+        self.inclusion_latency_count = 0
         self.block_capacity = block_capacity
-    
+        self.ledger = BalanceLedger()
+        self.stake_registry = StakeRegistry()
+        self.nonces = NonceTracker()
+        self.transaction_index = TransactionIndex(self.view)
+        # State derived from the chain and pool, updated in step with them
+        self.indexes = [self.ledger, self.stake_registry, self.nonces, self.transaction_index]
+        self.current_view = ChainView(self)
+
+    def view(self):
+        return self.current_view
+
+    def publish(self):
+        self.current_view = ChainView(self)
+
     def add_transaction_to_pool(self, transaction):
-        self.transaction_pool.append(transaction)
+        """
+        :return: False if the transaction was already in the pool or did not fit in it.
+        """
+        with self.lock, metrics.time_stage('pool_insert'):
+            added, evicted = self.transaction_pool.add(transaction)
+            if not added:
+                print('Transaction not added to pool')
+                return False
+            for index in self.indexes:
+                if evicted is None:
+                    index.add_pending(transaction)
+                else:
+                    # The evicted transaction's pending balance, stake and
+                    # nonce must go with it, the pending state is rebuilt
+                    index.reset_pending(self.transaction_pool)
+            if transaction.transaction_id not in self.first_seen:
+                self.first_seen[transaction.transaction_id] = time.time()
+                # Forget the oldest entries of transactions that never made it into a block
+                while len(self.first_seen) > self.first_seen_limit:
+                    del self.first_seen[next(iter(self.first_seen))]
+            self.publish()
         print('Transaction added to pool')
-        return
+        return True
+
+    def reserve_nonce(self, address):
+        with self.lock:
+            return self.nonces.reserve(address)
+
+    def oldest_pending_time(self):
+        return self.transaction_pool.oldest_received()
+
+    def pool_full(self):
+        return len(self.transaction_pool) >= self.block_capacity
+
+    def take_block_transactions(self):
+        """
+        Remove the transactions of the next block from the pool and return
+        them. Any others stay in the pool for the following block.
+        """
+        with self.lock:
+            transactions = self.transaction_pool.take(self.block_capacity)
+            for index in self.indexes:
+                index.reset_pending(self.transaction_pool)
+            self.publish()
+        return transactions
+
+    def pool_dicts(self):
+        return [transaction.to_dict() for transaction in self.transaction_pool]
+
+    def replace_pool(self, transaction_pool):
+        with self.lock:
+            self.transaction_pool.replace(transaction_pool)
+            for index in self.indexes:
+                index.reset_pending(self.transaction_pool)
+            self.publish()
+
+    def replace_chain(self, chain):
+        """
+        Swap in a new chain and rebuild the state derived from it.
+        """
+        with self.lock:
+            # Always a new list, views of the old chain stay as they were
+            self.chain = list(chain)
+            # Transactions the new chain already holds would otherwise be minted again
+            pooled = {transaction.transaction_id for transaction in self.transaction_pool}
+            if pooled:
+                self.transaction_pool.discard([transaction for block in self.chain for transaction in block.transactions
+                                               if transaction.transaction_id in pooled])
+            for index in self.indexes:
+                index.rebuild(self.chain, self.transaction_pool)
+            if self.store is not None:
+                self.store.rewrite(self.chain)
+                self.save_snapshot()
+            self.publish()
+
+    def replace_if_longer(self, chain):
+        """
+        Replace the chain with a validated candidate chain if it is longer.
+
+        :return: False if the current chain is at least as long.
+        """
+        with self.lock:
+            if len(chain) <= len(self.chain):
+                return False
+            self.replace_chain(chain)
+            return True
+
+    def save_snapshot(self):
+        self.store.write_snapshot(len(self.chain), [index.snapshot() for index in self.indexes])
+
+    def load(self):
+        """
+        Rebuild the chain and its derived state from the block store. The state
+        is restored from the latest snapshot and only the blocks committed
+        after it are replayed.
+
+        :return: the number of blocks loaded.
+        """
+        if self.store is None:
+            return 0
+        with self.lock:
+            self.chain = self.store.blocks()
+            snapshot = self.store.read_snapshot()
+            if snapshot is None:
+                for index in self.indexes:
+                    index.rebuild(self.chain, self.transaction_pool)
+            else:
+                height, state = snapshot
+                for index, index_state in zip(self.indexes, state):
+                    index.restore(index_state)
+                for block in self.chain[height:]:
+                    for index in self.indexes:
+                        index.apply_block(block)
+                for index in self.indexes:
+                    index.reset_pending(self.transaction_pool)
+            self.publish()
+            return len(self.chain)
     
     def mint_bootstrap_block(self, validator):
         # Only create a new block if there are transactions in the pool
-        if len(self.transaction_pool) == self.block_capacity:
-            previous_block = self.chain[-1]
-            new_block = Block(index=len(self.chain), transactions=self.transaction_pool, validator=validator, previous_hash=previous_block.current_hash)
-            new_block.current_hash = new_block.calculate_hash()
-            self.add_block(new_block)
-            self.transaction_pool = []
-            print("Block added to the chain")
-        else:
-            print("Transaction pool not full")
+        with self.lock:
+            if self.pool_full():
+                previous_block = self.chain[-1]
+                new_block = Block(index=len(self.chain), transactions=self.take_block_transactions(), validator=validator,
+                                  previous_hash=previous_block.current_hash, capacity=self.block_capacity)
+                new_block.current_hash = new_block.calculate_hash()
+                self.add_block(new_block)
+                print("Block added to the chain")
+            else:
+                print("Transaction pool not full")
 
 
 
@@ -38,69 +321,149 @@ class Blockchain:
         
         :param block: The block to be added.
         """
-        # If it's the first block and the chain is empty, it's considered the Genesis block
-        if not self.chain:
-            if block.index != 0:
-                raise Exception("The first block must be the Genesis block with index 0")
-        else:
-            # Ensure the new block follows the last block on the chain
-            if block.previous_hash != self.chain[-1].current_hash:
-                raise Exception("The new block's previous hash must match the last block's hash")
-
-        self.chain.append(block)
-        print("New block added, current blockchain state:", self.chain)
+        with self.lock, metrics.time_stage('add_block'):
+            # If it's the first block and the chain is empty, it's considered the Genesis block
+            if not self.chain:
+                if block.index != 0:
+                    raise Exception("The first block must be the Genesis block with index 0")
+            else:
+                # Ensure the new block follows the last block on the chain
+                if block.previous_hash != self.chain[-1].current_hash:
+                    raise Exception("The new block's previous hash must match the last block's hash")
+
+            # Transactions of the block that are still waiting here are done
+            self.transaction_pool.discard(block.transactions)
+            included = time.time()
+            for transaction in block.transactions:
+                seen = self.first_seen.pop(transaction.transaction_id, None)
+                if seen is not None:
+                    self.inclusion_latencies.append(included - seen)
+                    self.inclusion_latency_count += 1
+                    metrics.observe('transaction_inclusion_seconds', included - seen)
+            for index in self.indexes:
+                index.apply_block(block)
+                index.reset_pending(self.transaction_pool)
+            if self.chain:
+                metrics.observe('block_interval_seconds', block.timestamp - self.chain[-1].timestamp)
+            metrics.inc('blocks_added_total')
+            self.chain.append(block)
+            if self.store is not None:
+                self.store.append(block)
+                if len(self.chain) % self.store.snapshot_interval == 0:
+                    self.save_snapshot()
+            self.publish()
+        print("New block added, height is now", len(self.chain))
         return "New block added", 200
         
-    def validate_chain(self):
+    def validate_chain(self, chain=None, workers=None):
         """
-        Validate the current blockchain to ensure integrity.
+        Validate the current blockchain, or the given candidate chain, to ensure integrity.
+
+        :param workers: number of processes for the hash checks, defaults to the number of cores.
         """
-        for i in range(1, len(self.chain)):
-            current_block = self.chain[i]
-            previous_block = self.chain[i-1]
+        if chain is None:
+            chain = self.chain
+
+        # Hash checks first, in parallel, then the cheap sequential link check
+        hashes_match = check_block_hashes(chain[1:], workers)
+
+        for i in range(1, len(chain)):
+            current_block = chain[i]
+            previous_block = chain[i-1]
 
             if current_block.previous_hash != previous_block.current_hash:
                 print("Blockchain integrity compromised at Block", current_block.index)
                 return False
             
-            recalculated_hash = hashlib.sha256(current_block.serialize_for_hash().encode()).hexdigest()
-            if recalculated_hash != current_block.current_hash:
+            if not hashes_match[i-1]:
                 print("Block hash calculation mismatch at Block", current_block.index)
                 return False
 
         print("Blockchain is valid.")
         return True
 
-<<<<<<< HEAD
 
-    def PoS_Choose_Minter(self):
+    def inclusion_latency_percentiles(self, percentiles=(50, 99)):
         """
-        Validate the block by selecting a validator based on their stake.
+        Percentiles of the time from a transaction entering the pool to its
+        block being added, in seconds, or None if no latency was recorded.
         """
+        if not self.inclusion_latencies:
+            return None
+        latencies = sorted(self.inclusion_latencies)
+        return [latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))] for percentile in percentiles]
 
-        total_stakes = sum(self.stakes.values())
-        if total_stakes == 0:
-            return False 
-
-        stake_target = random.uniform(0, total_stakes)
-        current = 0
-        for node_identifier, stake_amount in self.stakes.items():
-            current += stake_amount
-            if current >= stake_target:
-                validator = node_identifier
-                break
-        return validator
-    
+    def inclusion_latencies_since(self, mark):
+        """
+        Latencies recorded since inclusion_latency_count was mark, as far as
+        the deque still holds them.
+        """
+        with self.lock:
+            latencies = list(self.inclusion_latencies)
+            recorded = min(self.inclusion_latency_count - mark, len(latencies))
+        return latencies[len(latencies) - recorded:]
 
     def get_last_block(self):
         """
         Retrieve the last block in the blockchain.
         """
-        if self.chain:
-            return self.chain[-1]
-        else:
+        return self.view().tip()
+
+    def encoded_blocks(self, start=0, view=None):
+        """
+        JSON encodings of the blocks from the given height on, each computed
+        once per block and reused on every later request.
+        """
+        if view is None:
+            view = self.view()
+        return [block.to_json() for block in view.since(start)]
+
+    def find_transaction(self, transaction_id):
+        """
+        A committed transaction and where it is.
+
+        :param transaction_id: the transaction id, as bytes.
+        :return: (transaction, block, position), or None if it is not in the chain.
+        """
+        view = self.view()
+        location = self.transaction_index.locate(transaction_id, view)
+        if location is None:
             return None
+        block = view.blocks[location[0]]
+        return block.transactions[location[1]], block, location[1]
+
+    def address_history(self, address, offset=0, limit=50):
+        """
+        A page of the committed transactions sent or received by an address,
+        oldest first.
+
+        :return: list of (transaction, block, position), and the total number of them.
+        """
+        view = self.view()
+        locations, total = self.transaction_index.history(address, view, offset, limit)
+        page = []
+        for height, position in locations:
+            block = view.blocks[height]
+            page.append((block.transactions[position], block, position))
+        return page, total
+
+    def extend_chain(self, blocks):
+        """
+        Validate a run of blocks on top of the current tip and append them.
+
+        :param blocks: the blocks that follow the current last block, in order.
+        :return: False if the blocks do not extend the current tip or are invalid.
+        """
+        tip = self.view().tip()
+        if tip is None:
+            return False
+        if not self.validate_chain([tip] + blocks):
+            return False
+        with self.lock:
+            # Another writer may have moved the tip while the blocks were validated
+            if self.chain[-1] is not tip:
+                return False
+            for block in blocks:
+                self.add_block(block)
+        return True
     
-=======
-    
->>>>>>> b185acbf68f1004ecf70900319d7c317234e37d5
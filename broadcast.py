@@ -0,0 +1,324 @@
+import asyncio
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import aiohttp
+except ImportError:
+    # Only the asyncio server needs it
+    aiohttp = None
+
+import wire
+from metrics import metrics
+
+# Status codes worth another attempt: the peer is overloaded or briefly failing
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class Broadcaster:
+    """
+    Sends the same payload to many peers at once.
+
+    Every peer gets its own keep-alive session, so repeated broadcasts reuse
+    the same TCP connections. Each broadcast fans out on its own short-lived
+    thread pool: a node that receives a broadcast may broadcast in turn from
+    inside its handler, and a shared pool could be starved by such nested
+    calls.
+
+    With wire_keys set, payloads are sent in the binary wire format, and
+    again as JSON to any peer that answers 415 Unsupported Media Type.
+    """
+    def __init__(self, timeout=5, retries=2, backoff=0.05, max_workers=32, wire_keys=None):
+        self.wire_keys = wire_keys
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_workers = max_workers
+        self.sessions = {}
+        self.sessions_lock = Lock()
+
+    def session_for(self, peer_url):
+        with self.sessions_lock:
+            session = self.sessions.get(peer_url)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[peer_url] = session
+            return session
+
+    def encode(self, payload):
+        """
+        The payload in the binary wire format, or None to send it as JSON.
+        """
+        if self.wire_keys is None:
+            return None
+        return wire.encode(payload, self.wire_keys())
+
+    @staticmethod
+    def can_fall_back(payload, content_type):
+        """
+        Whether a body the peer refused with 415 can be sent again as JSON.
+        """
+        return content_type == wire.CONTENT_TYPE and payload is not None
+
+    def post(self, peer_url, path, payload, body=None, content_type=wire.CONTENT_TYPE):
+        """
+        POST a payload to one peer, retrying with exponential backoff on
+        connection errors, timeouts and retryable status codes.
+
+        :param body: the payload already encoded, if any.
+        :param content_type: the encoding of body, the binary wire format by default.
+
+        :return: dict with 'ok', 'status_code', 'error', 'attempts' and 'response'.
+        """
+        session = self.session_for(peer_url)
+        result = {'ok': False, 'status_code': None, 'error': None, 'attempts': 0, 'response': None}
+
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * (2 ** (attempt - 1)))
+            result['attempts'] = attempt + 1
+            try:
+                if body is not None:
+                    response = session.post(peer_url + path, data=body, timeout=self.timeout,
+                                            headers={'Content-Type': content_type})
+                    # Only the binary wire format has a JSON form to fall back to, a
+                    # refused JSON body is a failure like any other
+                    if response.status_code == 415 and self.can_fall_back(payload, content_type):
+                        body = None
+                        response = session.post(peer_url + path, json=payload, timeout=self.timeout)
+                else:
+                    response = session.post(peer_url + path, json=payload, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                result['error'] = str(e)
+                continue
+
+            result['status_code'] = response.status_code
+            result['response'] = response
+            result['error'] = None
+            if response.status_code in RETRY_STATUS_CODES:
+                result['error'] = f"Status code {response.status_code}"
+                continue
+            result['ok'] = response.status_code < 400
+            break
+
+        return result
+
+    def post_all(self, peers, path, payload, body=None, content_type=wire.CONTENT_TYPE):
+        """
+        POST a payload to every peer in parallel and wait for all of them.
+
+        :param peers: dict of node id to peer base url.
+        :param body: the payload already encoded, in the binary wire format
+            with wire_keys if not given.
+        :param content_type: the encoding of body.
+        :return: dict of node id to the result of post().
+        """
+        if not peers:
+            return {}
+
+        with metrics.time_stage('broadcast'):
+            # Encoded once, the same bytes go to every peer
+            if body is None:
+                body = self.encode(payload)
+            workers = min(len(peers), self.max_workers)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    node_id: executor.submit(self.post, peer_url, path, payload, body, content_type)
+                    for node_id, peer_url in peers.items()
+                }
+                results = {node_id: future.result() for node_id, future in futures.items()}
+        count_failures(path, results)
+        return results
+
+    def close(self):
+        with self.sessions_lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+class AsyncBroadcaster(Broadcaster):
+    """
+    Broadcaster whose POSTs run as coroutines on an asyncio event loop with
+    aiohttp, so a broadcast holds no thread per peer while it waits on the
+    network. Used by the asyncio server.
+
+    Coroutines on the loop await post_all_async; threads (the ingest worker,
+    the block producer, handlers moved off the loop) call post_all as before
+    and wait for the result. GET requests, such as the block fetch of a sync,
+    still go through the requests sessions.
+    """
+    def __init__(self, loop, **kwargs):
+        if aiohttp is None:
+            raise RuntimeError("AsyncBroadcaster needs the aiohttp package")
+        super().__init__(**kwargs)
+        self.loop = loop
+        self.client = None
+
+    def client_session(self):
+        # Created on first use, from the loop, as aiohttp requires
+        if self.client is None:
+            connector = aiohttp.TCPConnector(limit_per_host=self.max_workers)
+            self.client = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.client
+
+    async def request(self, url, payload, body, content_type=wire.CONTENT_TYPE):
+        client = self.client_session()
+        if body is not None:
+            async with client.post(url, data=body, headers={'Content-Type': content_type}) as response:
+                await response.read()
+                if response.status != 415 or not self.can_fall_back(payload, content_type):
+                    return response
+        async with client.post(url, json=payload) as response:
+            await response.read()
+            return response
+
+    async def post_async(self, peer_url, path, payload, body=None, content_type=wire.CONTENT_TYPE):
+        """
+        Same as post(), as a coroutine. The 'response' entry is the aiohttp
+        response, its body already read.
+        """
+        result = {'ok': False, 'status_code': None, 'error': None, 'attempts': 0, 'response': None}
+
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(self.backoff * (2 ** (attempt - 1)))
+            result['attempts'] = attempt + 1
+            try:
+                response = await self.request(peer_url + path, payload, body, content_type)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                result['error'] = str(e) or type(e).__name__
+                continue
+
+            result['status_code'] = response.status
+            result['response'] = response
+            result['error'] = None
+            if response.status in RETRY_STATUS_CODES:
+                result['error'] = f"Status code {response.status}"
+                continue
+            result['ok'] = response.status < 400
+            break
+
+        return result
+
+    async def post_all_async(self, peers, path, payload, body=None, content_type=wire.CONTENT_TYPE):
+        if not peers:
+            return {}
+        with metrics.time_stage('broadcast'):
+            if body is None:
+                body = self.encode(payload)
+            results = await asyncio.gather(*(self.post_async(peer_url, path, payload, body, content_type)
+                                             for peer_url in peers.values()))
+        results = dict(zip(peers, results))
+        count_failures(path, results)
+        return results
+
+    def post(self, peer_url, path, payload, body=None, content_type=wire.CONTENT_TYPE):
+        return self.run(self.post_async(peer_url, path, payload, body, content_type))
+
+    def post_all(self, peers, path, payload, body=None, content_type=wire.CONTENT_TYPE):
+        return self.run(self.post_all_async(peers, path, payload, body, content_type))
+
+    def run(self, coroutine):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            # Waiting here would block the loop the coroutine needs
+            coroutine.close()
+            raise RuntimeError("Blocking broadcast called from the event loop, await post_all_async instead")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def close_async(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+        self.close()
+
+
+class BatchPipeline:
+    """
+    Streams payloads to many peers without waiting for each one to be
+    delivered everywhere before sending the next.
+
+    Every peer gets a sender thread that posts the payloads in submission
+    order, which the receiving nodes' nonce check relies on, so peers are
+    served in parallel and a slow peer only holds back its own stream. Up to
+    in_flight payloads per peer may be queued ahead of the one being sent;
+    submit blocks once a peer is that far behind.
+    """
+    def __init__(self, broadcaster, peers, path, in_flight=4):
+        self.broadcaster = broadcaster
+        self.path = path
+        self.delivered = {node_id: 0 for node_id in peers}
+        self.failed = {node_id: 0 for node_id in peers}
+        self.queues = {}
+        self.senders = []
+        for node_id, peer_url in peers.items():
+            self.queues[node_id] = queue.Queue(maxsize=in_flight)
+            sender = Thread(target=self.send, args=(node_id, peer_url), daemon=True)
+            sender.start()
+            self.senders.append(sender)
+
+    def send(self, node_id, peer_url):
+        pending = self.queues[node_id]
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            payload, body = item
+            delay = self.broadcaster.backoff
+            while True:
+                result = self.broadcaster.post(peer_url, self.path, payload, body)
+                # A full queue on the peer is back pressure, wait for room rather than drop the batch
+                if result['status_code'] != 429:
+                    break
+                time.sleep(delay)
+                delay = min(2 * delay, 1.0)
+            if result['ok']:
+                self.delivered[node_id] += 1
+            else:
+                self.failed[node_id] += 1
+
+    def submit(self, payload):
+        # Encoded once, the same bytes go to every peer
+        body = self.broadcaster.encode(payload)
+        for pending in self.queues.values():
+            pending.put((payload, body))
+
+    def close(self):
+        """
+        Wait until every submitted payload was sent.
+
+        :return: dict of node id to the number of payloads the peer accepted.
+        """
+        for pending in self.queues.values():
+            pending.put(None)
+        for sender in self.senders:
+            sender.join()
+        failures = sum(self.failed.values())
+        if failures:
+            metrics.inc('broadcast_failures_total', failures, path=self.path)
+        return self.delivered
+
+
+def count_failures(path, results):
+    failures = len(results) - len(delivered(results))
+    if failures:
+        metrics.inc('broadcast_failures_total', failures, path=path)
+
+
+def delivered(results):
+    """
+    Node ids of the peers that accepted a broadcast.
+    """
+    return [node_id for node_id, result in results.items() if result['ok']]
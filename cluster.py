@@ -0,0 +1,260 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from keystore import KeyStore
+import results
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def process_usage(pid):
+    """
+    CPU seconds used so far and peak resident memory in kB of a process, read
+    from /proc, or (None, None) where /proc is not available.
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as stat_file:
+            # Fields after the command name, which may contain spaces
+            fields = stat_file.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/status') as status_file:
+            peak_rss = next((int(line.split()[1]) for line in status_file if line.startswith('VmHWM:')), None)
+    except OSError:
+        return None, None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK'), peak_rss
+
+
+class Cluster:
+    """
+    A whole BlockChat cluster on this machine: one rest.py process per node
+    on a local port, the bootstrap first, then every other node at once. Node
+    i replays trans{i}.txt of the workload folder. With a keystore, the node
+    launched i-th takes the key of slot i and registers as node i, so ids
+    and wallets are the same on every run; without one, ids follow the order
+    the registrations reach the bootstrap.
+    """
+    def __init__(self, nodes, capacity, work_dir, server='flask', max_block_latency=1.0, timeout=300,
+                 gossip_fanout=0, keystore=None):
+        self.nodes = nodes
+        self.capacity = capacity
+        self.work_dir = work_dir
+        self.server = server
+        self.max_block_latency = max_block_latency
+        self.timeout = timeout
+        self.gossip_fanout = gossip_fanout
+        self.keystore = keystore
+        self.processes = []
+        self.urls = []
+        self.session = requests.Session()
+
+    def launch(self, port, is_bootstrap):
+        command = [sys.executable, os.path.join(SCRIPT_DIR, 'rest.py'), '--host', '127.0.0.1', '--port', str(port),
+                   '--total_nodes', str(self.nodes), '--block_capacity', str(self.capacity),
+                   '--max_block_latency', str(self.max_block_latency), '--server', self.server,
+                   '--gossip_fanout', str(self.gossip_fanout)]
+        if is_bootstrap:
+            command.append('--is_bootstrap')
+        else:
+            command += ['--bootstrap_url', self.urls[0]]
+        if self.keystore:
+            command += ['--keystore', self.keystore, '--wallet_index', str(len(self.processes))]
+        log_file = open(os.path.join(self.work_dir, f'node{len(self.processes)}.log'), 'w')
+        # stdin stays open and unused, the node's CLI waits on it; metrics files land in work_dir
+        process = subprocess.Popen(command, cwd=self.work_dir, stdin=subprocess.PIPE, stdout=log_file,
+                                   stderr=subprocess.STDOUT)
+        self.processes.append(process)
+        self.urls.append(f'http://127.0.0.1:{port}')
+
+    def wait_ready(self, url, process):
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"Node at {url} exited with code {process.returncode}, see {self.work_dir}")
+            try:
+                if self.session.get(url + '/tip', timeout=1).status_code == 200:
+                    return
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError(f"Node at {url} did not start within {self.timeout} s")
+
+    def start(self):
+        """
+        Start the bootstrap, then all other nodes at once.
+
+        :return: seconds from the first launch until every node has the same tip.
+        """
+        start = time.time()
+        self.launch(free_port(), is_bootstrap=True)
+        self.wait_ready(self.urls[0], self.processes[0])
+        for _ in range(1, self.nodes):
+            self.launch(free_port(), is_bootstrap=False)
+        for url, process in zip(self.urls[1:], self.processes[1:]):
+            self.wait_ready(url, process)
+        # Every node has the full roster and the welcome blocks once the tips agree
+        return self.wait_quiet(settle=1.0) - start
+
+    def tips(self):
+        return [self.session.get(url + '/tip', timeout=5).json() for url in self.urls]
+
+    def wait_quiet(self, settle):
+        """
+        Wait until every node has the same tip and it has not moved for
+        settle seconds.
+
+        :return: the time the tip last moved.
+        """
+        deadline = time.time() + self.timeout
+        last_tips, changed = None, time.time()
+        while time.time() < deadline:
+            tips = self.tips()
+            if tips != last_tips:
+                last_tips, changed = tips, time.time()
+            elif len(set(tip['hash'] for tip in tips)) == 1 and time.time() - changed >= settle:
+                return changed
+            time.sleep(0.2)
+        raise RuntimeError(f"Cluster did not settle within {self.timeout} s: {self.describe_tips(last_tips)}")
+
+    def describe_tips(self, tips):
+        """
+        Which nodes are at which tip, the nodes off the most common one first.
+        """
+        if not tips:
+            return 'no tips read'
+        by_hash = {}
+        for node_index, tip in enumerate(tips):
+            by_hash.setdefault(tip['hash'], []).append(node_index)
+        groups = sorted(by_hash.items(), key=lambda item: len(item[1]))
+        return '; '.join(f"nodes {', '.join(str(node_index) for node_index in node_indexes)} at height "
+                         f"{tips[node_indexes[0]]['height']} ({tip_hash[:8]})" for tip_hash, node_indexes in groups)
+
+    def run_workload(self, workload_dir):
+        """
+        Replay trans{i}.txt on every node at once and wait until the last
+        block is out.
+
+        :return: dict of the run's results.
+        """
+        submitted = 0
+        for node_id in range(self.nodes):
+            with open(os.path.join(workload_dir, f'trans{node_id}.txt')) as trans_file:
+                submitted += sum(1 for line in trans_file if line.strip())
+
+        start_height = self.tips()[0]['height']
+        usage_before = [process_usage(process.pid) for process in self.processes]
+        start = time.time()
+        run_id = f'{self.nodes}nodes_capacity{self.capacity}_{int(start)}'
+        with ThreadPoolExecutor(max_workers=self.nodes) as executor:
+            list(executor.map(lambda url: self.session.post(url + '/start_test', json={'transactions_folder': workload_dir,
+                                                                                       'run_id': run_id},
+                                                            timeout=self.timeout), self.urls))
+        self.wait_quiet(settle=2 * self.max_block_latency + 1.0)
+        usage_after = [process_usage(process.pid) for process in self.processes]
+
+        blocks = self.session.get(self.urls[0] + '/blocks', params={'from': start_height}, timeout=30).json()['blocks']
+        committed = sum(1 for block in blocks for transaction in block['transactions']
+                        if transaction['type_of_transaction'] == 'message')
+        duration = (blocks[-1]['timestamp'] - start) if blocks else None
+        timestamps = [start] + [block['timestamp'] for block in blocks]
+        block_times = [later - earlier for earlier, later in zip(timestamps, timestamps[1:])]
+
+        per_node = []
+        for node_id, (before, after) in enumerate(zip(usage_before, usage_after)):
+            cpu = after[0] - before[0] if after[0] is not None else None
+            per_node.append({'node_id': node_id, 'url': self.urls[node_id], 'cpu_seconds': cpu, 'peak_rss_kb': after[1]})
+
+        return {
+            'run_id': run_id,
+            'nodes': self.nodes,
+            'capacity': self.capacity,
+            'server': self.server,
+            'gossip_fanout': self.gossip_fanout,
+            'transactions_submitted': submitted,
+            'transactions_committed': committed,
+            'blocks': len(blocks),
+            'duration': duration,
+            'throughput': committed / duration if duration else None,
+            'block_time': sum(block_times) / len(block_times) if block_times else None,
+            'per_node': per_node,
+        }
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the BlockChat workloads on a local cluster and collect the results.')
+    parser.add_argument('--nodes', type=int, nargs='+', default=[5, 10], help='Cluster sizes, the workload comes from <n>_nodes')
+    parser.add_argument('--capacities', type=int, nargs='+', default=[5, 10, 20], help='Block capacities to sweep')
+    parser.add_argument('--server', choices=['flask', 'asyncio'], default='flask', help='HTTP server stack of the nodes')
+    parser.add_argument('--gossip_fanout', type=int, default=0, help='Gossip fanout of the nodes, 0 for all-to-all')
+    parser.add_argument('--max_block_latency', type=float, default=1.0, help='Seconds before a partly filled block is minted')
+    parser.add_argument('--timeout', type=float, default=300, help='Seconds to wait for any one step')
+    parser.add_argument('--work_dir', type=str, help='Directory for node logs and metrics files, a new temporary one if unset')
+    parser.add_argument('--output', type=str, default='cluster_results.json', help='JSON file the results are written to')
+    parser.add_argument('--keystore', type=str, help='Directory of pre-generated wallet keys, filled up to the largest cluster size first')
+    args = parser.parse_args()
+
+    if args.keystore:
+        start = time.perf_counter()
+        generated = KeyStore(args.keystore).fill(max(args.nodes))
+        print(f"Keystore {args.keystore}: {generated} keys generated in {time.perf_counter() - start:.1f} s")
+
+    runs = []
+    for nodes in args.nodes:
+        for capacity in args.capacities:
+            work_dir = os.path.join(args.work_dir or tempfile.mkdtemp(prefix='cluster-'), f'{nodes}nodes_capacity{capacity}')
+            os.makedirs(work_dir, exist_ok=True)
+            cluster = Cluster(nodes, capacity, work_dir, server=args.server,
+                              max_block_latency=args.max_block_latency, timeout=args.timeout,
+                              gossip_fanout=args.gossip_fanout, keystore=args.keystore)
+            try:
+                bring_up = cluster.start()
+                result = cluster.run_workload(os.path.join(SCRIPT_DIR, f'{nodes}_nodes'))
+            except RuntimeError as e:
+                # Recorded, and the sweep goes on with the next configuration
+                print(f"{nodes:>3} nodes, capacity {capacity:>2}: failed, {e}")
+                result = {'nodes': nodes, 'capacity': capacity, 'error': str(e)}
+            finally:
+                cluster.stop()
+            result['work_dir'] = work_dir
+            runs.append(result)
+            if 'error' not in result:
+                result['bring_up'] = bring_up
+                throughput = f"{result['throughput']:.1f} tx/s" if result['throughput'] else 'n/a'
+                print(f"{nodes:>3} nodes, capacity {capacity:>2}: {result['transactions_committed']}/"
+                      f"{result['transactions_submitted']} committed, {throughput}, {result['blocks']} blocks, "
+                      f"up in {bring_up:.1f} s")
+
+            with open(args.output, 'w') as output_file:
+                json.dump({'runs': runs}, output_file, indent=2)
+
+    # The records the nodes wrote themselves, by configuration
+    node_runs = [run for result in runs for run in results.load_runs(os.path.join(result['work_dir'], results.RESULTS_DIR))]
+    for summary in results.aggregate(node_runs):
+        print(results.format_summary(summary))
+
+
+if __name__ == '__main__':
+    main()
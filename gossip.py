@@ -0,0 +1,149 @@
+import queue
+import time
+from threading import Lock, Thread
+
+from metrics import metrics
+from transaction import Transaction
+
+# Key of the payload field naming the node a gossiped message started from
+ORIGIN = 'gossip_origin'
+
+
+def transaction_key(values):
+    """
+    Id of the transaction a /transactions/new payload describes, the same id
+    every node computes for it.
+    """
+    return Transaction(
+        sender_address=values['sender_address'],
+        receiver_address=values['receiver_address'],
+        type_of_transaction=values['type_of_transaction'],
+        amount=values['amount'],
+        message=values['message'],
+        nonce=values['nonce'],
+    ).transaction_id.hexdigest()
+
+
+class Gossip:
+    """
+    Relays transactions and blocks hop by hop instead of having their origin
+    send them to every node.
+
+    Nodes forward along an f-ary tree rooted at the origin, laid over the
+    roster in node id order: the node at distance r from the origin forwards
+    to the nodes at distances r*f+1 to r*f+f. Every node is reached once in
+    about log_f(N) hops and the origin only sends to fanout nodes. When a
+    forward fails, the sender forwards to that node's children itself.
+
+    Every peer is sent to from one queue, in order, since the receiving nodes
+    reject a sender's transactions that arrive out of nonce order. A seen-set
+    of transaction ids and block hashes drops anything delivered twice.
+    """
+    def __init__(self, node, fanout=3, seen_limit=100000):
+        self.node = node
+        self.fanout = fanout
+        self.seen_limit = seen_limit
+        self.seen = {}
+        self.seen_lock = Lock()
+        self.streams = {}
+        self.streams_lock = Lock()
+
+    def first_seen(self, key):
+        """
+        Mark a message as seen.
+
+        :return: False if it had been seen already.
+        """
+        with self.seen_lock:
+            if key in self.seen:
+                return False
+            self.seen[key] = True
+            # Forget the oldest keys, a message that old is not in flight anymore
+            while len(self.seen) > self.seen_limit:
+                del self.seen[next(iter(self.seen))]
+            return True
+
+    def forget(self, key):
+        """
+        Unmark a message this node could not take, so a retry is not dropped.
+        """
+        with self.seen_lock:
+            self.seen.pop(key, None)
+
+    def roster(self):
+        return sorted(self.node.nodes, key=int)
+
+    def own_id(self):
+        return self.node.node_ids_by_key.get(self.node.wallet.public_key)
+
+    def children(self, origin, node_id):
+        """
+        Node ids a node forwards to, for a message that started at origin.
+        """
+        roster = self.roster()
+        positions = {str(roster_id): position for position, roster_id in enumerate(roster)}
+        if str(origin) not in positions or str(node_id) not in positions:
+            return []
+        size = len(roster)
+        distance = (positions[str(node_id)] - positions[str(origin)]) % size
+        first = distance * self.fanout + 1
+        return [roster[(positions[str(origin)] + child) % size] for child in range(first, min(first + self.fanout, size))]
+
+    def originate(self, path, payload):
+        """
+        Start disseminating a message from this node: deliver it to this node
+        first, whose handler relays it on.
+        """
+        return self.node.broadcaster.post(self.node.api_url, path, self.stamp(payload))
+
+    def stamp(self, payload):
+        """
+        The payload marked as starting from this node.
+        """
+        return dict(payload, **{ORIGIN: self.own_id()})
+
+    def relay(self, path, payload):
+        """
+        Forward a message received for the first time to this node's children.
+        """
+        origin = payload.get(ORIGIN)
+        if origin is None:
+            return
+        for child in self.children(origin, self.own_id()):
+            self.send(child, path, payload)
+
+    def send(self, node_id, path, payload):
+        with self.streams_lock:
+            stream = self.streams.get(node_id)
+            if stream is None:
+                stream = self.streams[node_id] = queue.Queue()
+                Thread(target=self.run_stream, args=(node_id, stream), daemon=True).start()
+        stream.put((path, payload))
+
+    def run_stream(self, node_id, stream):
+        while True:
+            path, payload = stream.get()
+            node_info = self.node.nodes.get(node_id, self.node.nodes.get(str(node_id)))
+            if node_info is None:
+                continue
+            try:
+                delivered = self.deliver(node_info['address'], path, payload)
+            except Exception as e:
+                print(f"Failed to gossip to node {node_id}: {e}")
+                delivered = False
+            metrics.inc('gossip_messages_total', path=path)
+            if not delivered:
+                metrics.inc('broadcast_failures_total', path=path)
+                # Take over the failed node's part of the tree
+                for child in self.children(payload[ORIGIN], node_id):
+                    self.send(child, path, payload)
+
+    def deliver(self, peer_url, path, payload):
+        delay = self.node.broadcaster.backoff
+        while True:
+            result = self.node.broadcaster.post(peer_url, path, payload)
+            # A full queue on the peer is back pressure, wait for room rather than drop the message
+            if result['status_code'] != 429:
+                return result['ok']
+            time.sleep(delay)
+            delay = min(2 * delay, 1.0)
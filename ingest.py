@@ -0,0 +1,72 @@
+import queue
+from threading import Lock, Thread
+
+
+class IngestQueue:
+    """
+    Bounded queue between the /transactions/new and /transactions/batch
+    handlers and the node.
+
+    The handler only does cheap checks and enqueues; a single worker thread
+    validates the queued transactions in batches, adds them to the pool and
+    hands over to the block producer. One worker keeps the transactions of a
+    sender in arrival order, which the nonce check relies on.
+    """
+    def __init__(self, node, producer, maxsize=1000, batch_size=50):
+        self.node = node
+        self.producer = producer
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.submit_lock = Lock()
+        self.worker = Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.worker.start()
+
+    def submit(self, values):
+        """
+        Queue a transaction for processing.
+
+        :return: False if the queue is full and the caller should back off.
+        """
+        with self.submit_lock:
+            try:
+                self.queue.put_nowait(values)
+                return True
+            except queue.Full:
+                return False
+
+    def submit_many(self, values_list):
+        """
+        Queue a batch of transactions, all of them or none.
+
+        :return: False if the batch does not fit and the caller should back off.
+        """
+        # Only the worker takes entries out, so the room checked here can only grow
+        with self.submit_lock:
+            if self.queue.maxsize and self.queue.qsize() + len(values_list) > self.queue.maxsize:
+                return False
+            for values in values_list:
+                self.queue.put_nowait(values)
+            return True
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                self.process(batch)
+            except Exception as e:
+                print(f"Failed to process transaction batch: {e}")
+
+    def process(self, batch):
+        if self.node.receive_transactions(batch):
+            self.producer.notify()
@@ -0,0 +1,179 @@
+import codecs
+import json
+
+# Bytes of a body read at a time
+CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = ' \t\n\r'
+
+
+class StreamError(ValueError):
+    """
+    A streamed body that is not the JSON object it should be.
+    """
+
+
+def write_object(name, encoded_items, extra):
+    """
+    Fragments of a JSON object whose list under name is made of pre-encoded
+    items, followed by a few extra fields. The list comes first, so a
+    reader can take its items while the rest is still on the way.
+    """
+    yield '{"' + name + '": ['
+    for i, encoded_item in enumerate(encoded_items):
+        yield encoded_item if i == 0 else ',' + encoded_item
+    yield ']'
+    for key, value in extra.items():
+        yield ', ' + json.dumps(key) + ': ' + json.dumps(value)
+    yield '}'
+
+
+class ObjectStream:
+    """
+    Incremental reader of a JSON object with one long list member, such as a
+    chain transfer.
+
+    Fed the body a chunk at a time, it hands out the items of the list as
+    soon as each one is complete and keeps the other members, so neither the
+    whole body nor the whole parsed list is ever held at once.
+    """
+    def __init__(self, list_key):
+        self.list_key = list_key
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.position = 0
+        self.state = 'start'
+        self.key = None
+        self.members = {}
+        self.ended = False
+
+    def feed(self, data):
+        """
+        Read the next chunk of the body.
+
+        :return: the list items completed by this chunk.
+        """
+        self.buffer = self.buffer[self.position:] + self.utf8.decode(data)
+        self.position = 0
+        items = []
+        while self.step(items):
+            pass
+        return items
+
+    def close(self):
+        """
+        End of the body.
+
+        :return: the members other than the list.
+        :raises StreamError: if the body is incomplete or malformed.
+        """
+        self.ended = True
+        self.feed(b'')
+        self.skip_whitespace()
+        if self.state != 'done' or self.position != len(self.buffer):
+            raise StreamError(f"Malformed JSON object, stopped in state {self.state}")
+        return self.members
+
+    def skip_whitespace(self):
+        while self.position < len(self.buffer) and self.buffer[self.position] in WHITESPACE:
+            self.position += 1
+
+    def next_char(self):
+        self.skip_whitespace()
+        return self.buffer[self.position] if self.position < len(self.buffer) else None
+
+    def value(self):
+        """
+        The complete JSON value at the current position, or None with the
+        position unchanged if the buffer ends before it does.
+        """
+        try:
+            value, end = self.decoder.raw_decode(self.buffer, self.position)
+        except json.JSONDecodeError:
+            # A value cut off by the end of the chunk, or a malformed body
+            # that close() refuses once no more data can come
+            if self.ended:
+                raise StreamError("Malformed JSON value")
+            return None
+        # A number at the very end of the buffer may go on in the next chunk
+        if end == len(self.buffer) and not self.ended:
+            return None
+        self.position = end
+        return (value,)
+
+    def expect(self, char, state):
+        found = self.next_char()
+        if found is None:
+            return False
+        if found != char:
+            raise StreamError(f"Expected {char!r}, found {found!r}")
+        self.position += 1
+        self.state = state
+        return True
+
+    def step(self, items):
+        """
+        Advance by one token.
+
+        :return: False if more data is needed, or the object is complete.
+        """
+        state = self.state
+        if state == 'done':
+            return False
+        if state == 'start':
+            return self.expect('{', 'first_key')
+
+        found = self.next_char()
+        if found is None:
+            return False
+
+        if state in ('first_key', 'key'):
+            if state == 'first_key' and found == '}':
+                self.position += 1
+                self.state = 'done'
+                return True
+            if found != '"':
+                raise StreamError(f"Expected a member name, found {found!r}")
+            key = self.value()
+            if key is None:
+                return False
+            self.key = key[0]
+            self.state = 'colon'
+            return True
+        if state == 'colon':
+            return self.expect(':', 'value')
+        if state == 'value':
+            if self.key == self.list_key and found == '[':
+                self.position += 1
+                self.state = 'first_item'
+                return True
+            value = self.value()
+            if value is None:
+                return False
+            self.members[self.key] = value[0]
+            self.state = 'member_end'
+            return True
+        if state == 'member_end':
+            if found == ',':
+                self.position += 1
+                self.state = 'key'
+                return True
+            return self.expect('}', 'done')
+        if state in ('first_item', 'item'):
+            if state == 'first_item' and found == ']':
+                self.position += 1
+                self.state = 'member_end'
+                return True
+            item = self.value()
+            if item is None:
+                return False
+            items.append(item[0])
+            self.state = 'item_end'
+            return True
+        # item_end
+        if found == ',':
+            self.position += 1
+            self.state = 'item'
+            return True
+        return self.expect(']', 'member_end')
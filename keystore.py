@@ -0,0 +1,103 @@
+import argparse
+import os
+import time
+from multiprocessing import Pool
+
+from Crypto.PublicKey import RSA
+
+from wallet import KEY_LENGTH, Wallet
+
+
+def write_key(path, pem):
+    """
+    Write a PEM key to path through a temporary file, so a reader never sees
+    half a key.
+    """
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as key_file:
+        key_file.write(pem.encode() if isinstance(pem, str) else pem)
+    os.replace(temporary_path, path)
+    return path
+
+
+def generate_key(path):
+    """
+    Generate one RSA key and write it to path in PEM.
+    """
+    return write_key(path, RSA.generate(KEY_LENGTH).export_key())
+
+
+def read_wallet(path):
+    """
+    Wallet of the PEM key at path, or None if there is no such file.
+    """
+    try:
+        with open(path) as key_file:
+            return Wallet(private_key=key_file.read())
+    except FileNotFoundError:
+        return None
+
+
+class KeyStore:
+    """
+    Directory of pre-generated wallet keys, one PEM file per slot.
+
+    Key generation is most of what a node does before it can register, and a
+    local test cluster starts many nodes at once. With a keystore the keys
+    are generated ahead of time, in parallel, and a node loads the key of the
+    slot it is given instead. Slot i always holds the same key, so the node
+    launched i-th gets the same wallet on every run.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, index):
+        return os.path.join(self.directory, f'wallet-{index:05d}.pem')
+
+    def size(self):
+        """
+        Number of filled slots counted from slot 0.
+        """
+        index = 0
+        while os.path.exists(self.path(index)):
+            index += 1
+        return index
+
+    def fill(self, count, workers=None):
+        """
+        Generate the keys of the first count slots that are still empty, on a
+        pool of workers processes, one per CPU if unset.
+
+        :return: number of keys generated.
+        """
+        missing = [self.path(index) for index in range(count) if not os.path.exists(self.path(index))]
+        if not missing:
+            return 0
+        with Pool(processes=workers) as pool:
+            for _ in pool.imap_unordered(generate_key, missing):
+                pass
+        return len(missing)
+
+    def wallet(self, index):
+        """
+        Wallet of slot index, or None if the slot is empty.
+        """
+        return read_wallet(self.path(index))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-generate wallet keys for local clusters.')
+    parser.add_argument('directory', type=str, help='Keystore directory')
+    parser.add_argument('--count', type=int, required=True, help='Number of slots to fill, existing keys are kept')
+    parser.add_argument('--workers', type=int, help='Processes generating keys, one per CPU if unset')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    generated = KeyStore(args.directory).fill(args.count, args.workers)
+    print(f"Generated {generated} keys in {time.perf_counter() - start:.2f} s, "
+          f"{args.count} slots filled in {args.directory}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import heapq
+import itertools
+import time
+
+from state import transaction_fee
+
+
+class Mempool:
+    """
+    Transactions waiting to be put in a block.
+
+    Transactions are indexed by id, so a transaction that arrives twice is
+    only kept once, and grouped by sender in nonce order. The next block takes
+    the highest paying transactions, but never a transaction of a sender ahead
+    of one of the same sender's with a lower nonce. Transactions left out of a
+    block stay in the pool for the next one.
+
+    Once the pool holds max_size transactions, a new transaction makes room
+    by evicting the last transaction, by nonce, of the sender of the lowest
+    paying one (the most recent on ties), or is refused if it pays no more
+    than that one or would itself come after the evicted transaction. A
+    sender's pending transactions are never left waiting on an evicted
+    predecessor, since the nonce checks would not let it be sent again.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.by_id = {}
+        self.by_sender = {}
+        self.arrival = {}
+        self.received = {}
+        self.counter = itertools.count()
+        # Lazy min-heap of (fee, -arrival, transaction_id) for eviction, entries
+        # of transactions no longer in the pool are skipped when popped
+        self.eviction_heap = []
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        # Arrival order (dicts keep insertion order), the order the state
+        # indexes replay the pool in
+        return iter(list(self.by_id.values()))
+
+    def __contains__(self, transaction):
+        return transaction.transaction_id in self.by_id
+
+    def add(self, transaction):
+        """
+        :return: whether the transaction was added, False if it is already in
+            the pool or the pool is full of better paying transactions, and
+            the transaction evicted to make room for it, or None.
+        """
+        transaction_id = transaction.transaction_id
+        if transaction_id in self.by_id:
+            return False, None
+
+        fee = transaction_fee(transaction)
+        arrival = next(self.counter)
+        evicted = None
+        if len(self.by_id) >= self.max_size:
+            lowest = self.lowest()
+            if lowest is None or (fee, -arrival) <= lowest[:2]:
+                return False, None
+            evicted = self.sender_queue(self.by_id[lowest[2]].sender_address)[-1]
+            if evicted.sender_address == transaction.sender_address and transaction.nonce > evicted.nonce:
+                return False, None
+            self.remove(evicted)
+
+        self.by_id[transaction_id] = transaction
+        self.arrival[transaction_id] = arrival
+        self.received[transaction_id] = time.time()
+        self.by_sender.setdefault(transaction.sender_address, {})[transaction_id] = transaction
+        heapq.heappush(self.eviction_heap, (fee, -arrival, transaction_id))
+        return True, evicted
+
+    def lowest(self):
+        while self.eviction_heap:
+            entry = self.eviction_heap[0]
+            if entry[2] in self.by_id and self.arrival[entry[2]] == -entry[1]:
+                return entry
+            heapq.heappop(self.eviction_heap)
+        return None
+
+    def remove(self, transaction):
+        transaction_id = transaction.transaction_id
+        if self.by_id.pop(transaction_id, None) is None:
+            return False
+        del self.arrival[transaction_id]
+        del self.received[transaction_id]
+        pending = self.by_sender[transaction.sender_address]
+        del pending[transaction_id]
+        if not pending:
+            del self.by_sender[transaction.sender_address]
+        return True
+
+    def discard(self, transactions):
+        """
+        Drop the given transactions if they are in the pool, such as the
+        transactions of a block that was just committed.
+        """
+        for transaction in transactions:
+            self.remove(transaction)
+        if len(self.eviction_heap) > 2 * len(self.by_id) + 64:
+            self.eviction_heap = [entry for entry in self.eviction_heap if entry[2] in self.by_id]
+            heapq.heapify(self.eviction_heap)
+
+    def oldest_received(self):
+        """
+        When the transaction that has waited longest entered the pool, or None
+        if the pool is empty.
+        """
+        # Dicts keep insertion order, the first entry is the oldest
+        return next(iter(self.received.values()), None)
+
+    def sender_queue(self, sender_address):
+        """
+        Pending transactions of one sender, lowest nonce first.
+        """
+        return sorted(self.by_sender[sender_address].values(),
+                      key=lambda transaction: (transaction.nonce, self.arrival[transaction.transaction_id]))
+
+    def select(self, count):
+        """
+        The next count transactions for a block, highest fee first, earliest
+        arrival on ties, in nonce order within each sender.
+        """
+        queues = {sender_address: self.sender_queue(sender_address) for sender_address in self.by_sender}
+        heads = []
+        for sender_address, queue in queues.items():
+            transaction = queue[0]
+            heads.append((-transaction_fee(transaction), self.arrival[transaction.transaction_id], 0, sender_address))
+        heapq.heapify(heads)
+
+        selected = []
+        while heads and len(selected) < count:
+            _, _, position, sender_address = heapq.heappop(heads)
+            queue = queues[sender_address]
+            selected.append(queue[position])
+            if position + 1 < len(queue):
+                transaction = queue[position + 1]
+                heapq.heappush(heads, (-transaction_fee(transaction), self.arrival[transaction.transaction_id],
+                                       position + 1, sender_address))
+        return selected
+
+    def take(self, count):
+        """
+        Remove and return the next count transactions for a block.
+        """
+        selected = self.select(count)
+        self.discard(selected)
+        return selected
+
+    def replace(self, transactions):
+        """
+        Swap the content of the pool for the given transactions.
+        """
+        self.by_id = {}
+        self.by_sender = {}
+        self.arrival = {}
+        self.received = {}
+        self.eviction_heap = []
+        for transaction in transactions:
+            self.add(transaction)
@@ -0,0 +1,236 @@
+import math
+import time
+from threading import Lock
+
+# Histogram buckets: SUB_BUCKETS per power of two from LOWEST seconds on, so
+# every bucket is at most 25% wide relative to its bounds whatever the scale
+LOWEST = 1e-6
+SUB_BUCKETS = 4
+OCTAVES = 28
+
+# Help text of the metrics the node records
+HELP = {
+    'stage_seconds': 'Time spent in each processing stage',
+    'transactions_received_total': 'Transactions received for validation',
+    'transactions_rejected_total': 'Transactions refused, by reason',
+    'transaction_inclusion_seconds': 'Time from a transaction entering the pool to its block being added',
+    'blocks_added_total': 'Blocks added to the chain',
+    'blocks_minted_total': 'Blocks minted by this node',
+    'block_interval_seconds': 'Time between the timestamps of consecutive blocks',
+    'broadcast_failures_total': 'Peers a broadcast did not reach, by path',
+    'gossip_messages_total': 'Messages forwarded to peers in gossip mode, by path',
+    'gossip_duplicates_total': 'Gossiped messages dropped as already seen, by path',
+    'chain_height': 'Number of blocks in the chain',
+    'pool_size': 'Transactions waiting for a block',
+    'ingest_queue_depth': 'Transactions waiting for validation',
+}
+
+
+def bucket_bounds():
+    bounds = [LOWEST]
+    for octave in range(OCTAVES):
+        for sub_bucket in range(SUB_BUCKETS):
+            bounds.append(LOWEST * 2 ** octave * (1 + (sub_bucket + 1) / SUB_BUCKETS))
+    return bounds
+
+
+BOUNDS = bucket_bounds()
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield name + format_labels(labels), self.value
+
+
+class Histogram:
+    """
+    Log-linear latency histogram in the style of HDR histograms: recording is
+    a constant-time bucket increment, and percentiles are read back to within
+    a bucket's width, from one microsecond to a few minutes.
+    """
+    def __init__(self):
+        self.counts = [0] * len(BOUNDS)
+        self.overflow = 0
+        self.count = 0
+        self.sum = 0.0
+        self.lock = Lock()
+
+    @staticmethod
+    def bucket(value):
+        if value <= LOWEST:
+            return 0
+        mantissa, exponent = math.frexp(value / LOWEST)
+        return (exponent - 1) * SUB_BUCKETS + int((2 * mantissa - 1) * SUB_BUCKETS) + 1
+
+    def observe(self, value):
+        index = self.bucket(value)
+        with self.lock:
+            if index < len(self.counts):
+                self.counts[index] += 1
+            else:
+                self.overflow += 1
+            self.count += 1
+            self.sum += value
+
+    def percentile(self, percentile):
+        """
+        Upper bound of the bucket holding the given percentile, or None if
+        nothing was recorded.
+        """
+        if not self.count:
+            return None
+        rank = math.ceil(self.count * percentile / 100) or 1
+        seen = 0
+        for bound, count in zip(BOUNDS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts, overflow, count, total = list(self.counts), self.overflow, self.count, self.sum
+        cumulative = 0
+        for bound, bucket_count in zip(BOUNDS, counts):
+            cumulative += bucket_count
+            yield name + '_bucket' + format_labels(labels + (('le', format_value(bound)),)), cumulative
+        yield name + '_bucket' + format_labels(labels + (('le', '+Inf'),)), cumulative + overflow
+        yield name + '_sum' + format_labels(labels), total
+        yield name + '_count' + format_labels(labels), count
+
+
+class Gauge:
+    """
+    Value read when the metrics are scraped, from a function of no arguments.
+    """
+    def __init__(self, read):
+        self.read = read
+
+    def samples(self, name, labels):
+        yield name + format_labels(labels), self.read()
+
+
+class Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Registry:
+    """
+    The metrics of a node, served in the Prometheus text format.
+
+    A metric is a family name plus optional label values, created on first
+    use and looked up in a dict afterwards. With enabled off, counters and
+    timers turn into no-ops and nothing is recorded.
+    """
+    def __init__(self, prefix='blockchat', enabled=True):
+        self.prefix = prefix
+        self.enabled = enabled
+        self.families = {}
+        self.stages = {}
+        self.lock = Lock()
+
+    def metric(self, kind, name, help_text, labels, factory):
+        family = self.families.get(name)
+        if family is None:
+            with self.lock:
+                family = self.families.setdefault(name, (kind, help_text or HELP.get(name, ''), {}))
+        metrics = family[2]
+        metric = metrics.get(labels)
+        if metric is None:
+            with self.lock:
+                metric = metrics.setdefault(labels, factory())
+        return metric
+
+    def counter(self, name, help_text='', **labels):
+        return self.metric('counter', name, help_text, tuple(sorted(labels.items())), Counter)
+
+    def histogram(self, name, help_text='', **labels):
+        return self.metric('histogram', name, help_text, tuple(sorted(labels.items())), Histogram)
+
+    def gauge(self, name, read, help_text=''):
+        return self.metric('gauge', name, help_text, (), lambda: Gauge(read))
+
+    def inc(self, name, amount=1, **labels):
+        if self.enabled:
+            self.counter(name, **labels).inc(amount)
+
+    def observe(self, name, value, **labels):
+        if self.enabled:
+            self.histogram(name, **labels).observe(value)
+
+    def time_stage(self, stage):
+        """
+        Context manager timing one stage of the hot path into the stage
+        latency histogram.
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = self.histogram('stage_seconds', stage=stage)
+        return Timer(histogram)
+
+    def render(self):
+        """
+        Every metric in the Prometheus text exposition format.
+        """
+        # Copied under the lock, metrics created meanwhile would break the iteration
+        with self.lock:
+            families = [(name, kind, help_text, list(metrics.items()))
+                        for name, (kind, help_text, metrics) in sorted(self.families.items())]
+        lines = []
+        for name, kind, help_text, metrics in families:
+            full_name = f'{self.prefix}_{name}'
+            if help_text:
+                lines.append(f'# HELP {full_name} {help_text}')
+            lines.append(f'# TYPE {full_name} {kind}')
+            for labels, metric in sorted(metrics, key=lambda item: item[0]):
+                for sample_name, value in metric.samples(full_name, labels):
+                    lines.append(f'{sample_name} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+metrics = Registry()
@@ -1,19 +1,26 @@
+import bisect
 import hashlib
+import itertools
 import json
 import os
 import time
+from threading import Lock
 import requests
 from wallet import Wallet
-from transaction import Transaction
+from transaction import Transaction, TransactionRecord, verify_transactions
 from block import Block
-from threading import Lock
+from blockchain import ChainBuilder
+from broadcast import BatchPipeline, Broadcaster, delivered
+from jsonstream import CHUNK_SIZE, ObjectStream, write_object
+import wire
+from metrics import metrics
+from gossip import transaction_key
+import results
 import random
 import numpy
 
-blockchain_lock = Lock()
-
 class Node:
-    def __init__(self, host, port, blockchain, is_bootstrap=False, nonce = 0, total_nodes=5):
+    def __init__(self, host, port, blockchain, is_bootstrap=False, nonce = 0, total_nodes=5, wallet=None):
         self.host = host
         self.port = port 
         self.total_nodes = total_nodes
@@ -21,18 +28,34 @@ class Node:
         self.api_url = f'http://{host}:{port}'
         self.blockchain = blockchain
         self.nonce = nonce
-        self.wallet = self.generate_wallet()
+        # A wallet loaded from a keystore, or a fresh one
+        self.wallet = wallet if wallet is not None else self.generate_wallet()
         self.node_id = 0 if is_bootstrap else None
-        self.total_transactions = 0
-        self.throughput = 0
-        longest_processing_time = 0
-        self.block_count = 0
-        self.block_count = 0
         self.nodes = {}
+        # Roster lookups, rebuilt whenever the roster changes
+        self.node_ids_by_key = {}
+        self.keys_by_address = {}
+        self.wire_keys_cache = wire.NO_REGISTRY
+        self.broadcaster = Broadcaster(wire_keys=self.wire_keys)
+        # Gossip relay of transactions and blocks, None to send them to every node directly
+        self.gossip = None
+        # Transactions per request and requests queued ahead per node when replaying a file
+        self.replay_batch_size = 50
+        self.replay_in_flight = 4
+        # Seconds a replay waits for its transactions to be committed before recording the run,
+        # and seconds without a new block after which the rest are taken as refused
+        self.inclusion_timeout = 60.0
+        self.inclusion_idle = 10.0
+        self.minter_weights_key = None
+        self.minter_weights = ([], [])
+        self.minter_cache = {}
         
+        # Registrations are handled concurrently, ids and welcome transfers are handed out under this lock
+        self.join_lock = Lock()
+        self.joined = False
+
         if is_bootstrap:
-            self.next_node_id = 1
-            self.nodes[self.node_id] = {'public_key': self.wallet.public_key, 'address': self.api_url}
+            self.add_node(self.node_id, self.wallet.public_key, self.api_url)
             self.initialize_genesis_block()
 
 
@@ -42,8 +65,44 @@ class Node:
             if node_id == self.node_id:
                 continue
             self.nodes[node_id] = node_info
+        self.index_nodes()
         print("Nodes updated successfully")
 
+    def add_node(self, node_id, public_key, address):
+        self.nodes[node_id] = {'public_key': public_key, 'address': address}
+        self.index_nodes()
+
+    def index_nodes(self):
+        """
+        Rebuild the public key and address lookups of the roster. Built aside
+        and swapped in, so lookups from other threads never see a half-built dict.
+        """
+        node_ids_by_key = {}
+        keys_by_address = {}
+        for node_id, node_info in self.nodes.items():
+            node_ids_by_key[node_info['public_key']] = node_id
+            keys_by_address[node_info['address']] = node_info['public_key']
+        self.node_ids_by_key = node_ids_by_key
+        self.keys_by_address = keys_by_address
+
+    def wire_keys(self):
+        """
+        Key ids for the binary wire format: the public keys of the registered
+        nodes in node id order, rebuilt only when the registry changes.
+        """
+        public_keys = [node_info['public_key'] for _, node_info in sorted(self.nodes.items(), key=lambda item: int(item[0]))]
+        if public_keys != self.wire_keys_cache.keys:
+            self.wire_keys_cache = wire.WireKeys(public_keys)
+        return self.wire_keys_cache
+
+    def decode_response(self, response):
+        """
+        Body of a peer's response, in whichever format the peer answered with.
+        """
+        if response.headers.get('Content-Type', '').startswith(wire.CONTENT_TYPE):
+            return wire.decode(response.content, self.wire_keys())
+        return response.json()
+
     def generate_wallet(self):
         return Wallet()
 
@@ -62,7 +121,7 @@ class Node:
             genesis_transaction.sign_transaction(self.wallet.private_key)
             genesis_block = Block(
                 index=0,
-                transactions=[genesis_transaction.to_dict()],
+                transactions=[genesis_transaction.to_record()],
                 validator=self.wallet.public_key,
                 previous_hash="1",
                 capacity=self.blockchain.block_capacity
@@ -72,82 +131,148 @@ class Node:
 
             temptrans.sign_transaction(self.wallet.private_key)
 
-            self.blockchain.add_transaction_to_pool(temptrans.to_dict())
+            self.blockchain.add_transaction_to_pool(temptrans.to_record())
 
             self.blockchain.mint_bootstrap_block(self.wallet.public_key) 
 
-    def update_blockchain(self, incoming_chain):
+    def adopt_chain(self, candidate_chain):
+        """
+        Replace the local chain with a candidate chain if it is valid and longer.
+        """
         try:
-            # Temporarily save the current blockchain
-            current_chain_backup = self.blockchain.chain
-
-            # Convert the incoming chain data into Block instances and set it as the current blockchain chain for validation
-            self.blockchain.chain = [Block(**block_data) for block_data in incoming_chain]
-
-            # Validate the temporarily set incoming chain
-            if self.blockchain.validate_chain():
-                current_len = len(current_chain_backup)
-                incoming_len = len(self.blockchain.chain)
-
-                # Check if the incoming chain is longer than the current chain
-                if incoming_len > current_len:
-                    # The incoming chain is valid and longer, keep it as the new chain
-                    print(f"Blockchain updated with a longer chain of length {incoming_len}.")
+            # Validate the incoming chain
+            if self.blockchain.validate_chain(candidate_chain):
+                # Compared and swapped under the writer lock, the chain may have
+                # grown while the candidate was validated
+                if self.blockchain.replace_if_longer(candidate_chain):
+                    print(f"Blockchain updated with a longer chain of length {len(candidate_chain)}.")
                     return True
                 else:
-                    # The incoming chain is valid but not longer, restore the original chain
-                    self.blockchain.chain = current_chain_backup
                     print("Received chain is not longer than the current chain.")
             else:
-                # The incoming chain is invalid, restore the original chain
-                self.blockchain.chain = current_chain_backup
                 print("Received chain is invalid.")
 
             return False
         except Exception as e:
             print(f"An error occurred during blockchain update: {e}")
-            self.blockchain.chain = current_chain_backup  # Restore the original chain in case of error
             return False
         
 
-    def register_with_bootstrap(self, bootstrap_url, public_key):
-        response = requests.post(bootstrap_url + '/register', json={'public_key': public_key, 'node_address': self.api_url})
-        if response.status_code == 200:
-            data = response.json()
-            if 'node_address' in data:
-                self.update_blockchain(data['blockchain'])
-                self.blockchain.transaction_pool = data['transaction_pool']
-                
-                temptrans = Transaction(self.wallet.public_key, 0, "Initial stake", 10, "", 1)
+    def register_with_bootstrap(self, bootstrap_url, public_key, node_id=None):
+        """
+        Ask the bootstrap for a node id, node_id if given, the next free one
+        otherwise. The roster, the chain and the pool follow on /join once
+        every node has registered.
+        """
+        values = {'public_key': public_key, 'node_address': self.api_url}
+        if node_id is not None:
+            values['node_id'] = node_id
+        response = requests.post(bootstrap_url + '/register', json=values)
+        if response.status_code != 200:
+            print(f"The bootstrap refused the registration: {response.status_code} {response.text.strip()}")
+            return False
+        data = response.json()
+        if 'node_id' not in data:
+            print('Error: node_id not found in the response.')
+            return False
+        print(f"Registered with the bootstrap node as node {data['node_id']}, waiting for the other nodes")
+        return True
 
-                temptrans.sign_transaction(self.wallet.private_key)
+    def register_node(self, public_key, address, node_id=None):
+        """
+        Bootstrap side of a registration: give the node the id it asks for,
+        or the lowest free one, and put its welcome transfer in the pool. A
+        node registering again, after a restart, keeps its id and gets no
+        second welcome transfer.
+
+        :return: the node id, None if the id is taken, out of range or not
+            the one the key registered under, and whether the network is to
+            be published, the roster being complete.
+        """
+        if node_id is not None and not 0 < node_id < self.total_nodes:
+            return None, False
+        with self.join_lock:
+            known_id = self.node_ids_by_key.get(public_key)
+            if known_id is not None:
+                if node_id not in (None, known_id):
+                    return None, False
+                self.add_node(known_id, public_key, address)
+                # Republished to everyone, the nodes that joined already acknowledge and ignore it
+                return known_id, len(self.nodes) == self.total_nodes
+            if node_id in self.nodes:
+                return None, False
+            if node_id is None:
+                node_id = next(free_id for free_id in itertools.count(1) if free_id not in self.nodes)
+            self.add_node(node_id, public_key, address)
+            # A key the chain already pays was welcomed before this bootstrap restarted
+            if public_key not in self.blockchain.ledger.committed:
+                self.transfer_bcc_to_new_node(public_key, 1000)
+            # Ids may arrive in any order, the roster is complete on the last registration whatever its id
+            return node_id, len(self.nodes) == self.total_nodes
+
+    def publish_network(self, timeout=60):
+        """
+        Send the roster, the chain and the pool to every other node at once,
+        after the last registration. Nodes that are not serving yet are
+        retried until timeout.
 
-                self.blockchain.add_transaction_to_pool(temptrans.to_dict())
+        :return: True if every node took them.
+        """
+        roster = {
+            str(node_id): {'address': node_info['address'], 'public_key': node_info['public_key']}
+            for node_id, node_info in self.nodes.items()
+        }
+        body = self.chain_body('blockchain', {'nodes': roster, 'transaction_pool': self.blockchain.pool_dicts()})
+        peers = {node_id: node_info['address'] for node_id, node_info in self.nodes.items() if node_id != self.node_id}
+
+        deadline = time.time() + timeout
+        delay = self.broadcaster.backoff
+        while peers:
+            results = self.broadcaster.post_all(peers, '/join', None, body, 'application/json')
+            peers = {node_id: peers[node_id] for node_id, result in results.items() if not result['ok']}
+            if peers and time.time() + delay > deadline:
+                print(f"Nodes {sorted(peers)} did not take the network state")
+                return False
+            time.sleep(delay if peers else 0)
+            delay = min(2 * delay, 1.0)
+        print(f"Network of {len(self.nodes)} nodes published")
+        return True
 
-                for node_id, node_info in data['nodes'].items():
-                    if node_id == "0":
-                        bootstrap_key = node_info['public_key']
+    def chain_body(self, name, extra):
+        """
+        The chain as a JSON object, its blocks under name and then the extra
+        fields, made of the JSON each block caches. Receivers read and check
+        the blocks as they arrive.
+        """
+        return ''.join(write_object(name, self.blockchain.encoded_blocks(), extra)).encode()
 
-                # self.blockchain.mint_bootstrap_block(bootstrap_key) 
+    def join_network(self, nodes, chain, transaction_pool):
+        """
+        Take the roster, the validated chain and the pool the bootstrap
+        publishes. A repeated delivery is acknowledged and ignored.
 
-                if self.validate_chain:
-                    print('Local blockchain initialized with the received state from the bootstrap node')
-                else:
-                    print("Invalid chain")
-                    return False
-                
-                for node_id, node_info in data['nodes'].items():
-                    if node_id == str(self.total_nodes-1):
-                        self.nodes = data['nodes']
-                print('Registered with the bootstrap node')
+        :return: False if the chain is neither longer than the local one nor
+            the same, as after a restart.
+        """
+        with self.join_lock:
+            if self.joined:
                 return True
-            else:
-                print('Error: node_address not found in the response.')
+            self.nodes = nodes
+            self.index_nodes()
+            # A node restarted on its block store staked when it first joined
+            restarted = bool(self.blockchain.chain)
+            if (not self.blockchain.replace_if_longer(chain)
+                    and self.blockchain.get_last_block().current_hash != chain[-1].current_hash):
                 return False
-        else:
-            return False
-
+            self.blockchain.replace_pool([TransactionRecord.from_dict(tx) for tx in transaction_pool])
 
+            if not restarted:
+                temptrans = Transaction(self.wallet.public_key, 0, "Initial stake", 10, "", 1)
+                temptrans.sign_transaction(self.wallet.private_key)
+                self.blockchain.add_transaction_to_pool(temptrans.to_record())
+            self.joined = True
+        print('Local blockchain initialized with the received state from the bootstrap node')
+        return True
 
     def transfer_bcc_to_new_node(self, recipient_public_key, amount):
 
@@ -161,44 +286,23 @@ class Node:
            
         transaction.sign_transaction(self.wallet.private_key)
         # Add the signed transaction to the transaction pool
-        self.blockchain.add_transaction_to_pool(transaction.to_dict())
+        self.blockchain.add_transaction_to_pool(transaction.to_record())
     
         self.blockchain.mint_bootstrap_block(self.wallet.public_key)
 
 
 
     def get_node_id_by_public_key(self, public_key):
-        for node_id, node_info in self.nodes.items():
-            if node_info['public_key'] == public_key:
-                print("Match found! Node ID:", node_id)
-                return node_id 
-        print("No match found.")
-        return None
+        node_id = self.node_ids_by_key.get(public_key)
+        if node_id is None:
+            print("No match found.")
+            return None
+        print("Match found! Node ID:", node_id)
+        return node_id
     
 
     def get_next_nonce(self):
-        max_nonce = 0
-        for block in self.blockchain.chain:
-            for transaction in block.transactions:
-                if isinstance(transaction, Transaction):
-                    sender_address = transaction.sender_address
-                    if sender_address == self.wallet.address:
-                        max_nonce = max(max_nonce, transaction.nonce)
-                elif isinstance(transaction, dict):
-                    sender_address = transaction['sender_address']
-                    if sender_address == self.wallet.address:
-                        max_nonce = max(max_nonce, transaction['nonce'])
-
-        for transaction in self.blockchain.transaction_pool:
-            if isinstance(transaction, Transaction):
-                sender_address = transaction.sender_address
-                if sender_address == self.wallet.address:
-                    max_nonce = max(max_nonce, transaction.nonce)
-            elif isinstance(transaction, dict):
-                sender_address = transaction['sender_address']
-                if sender_address == self.wallet.address:
-                    max_nonce = max(max_nonce, transaction['nonce'])
-        return max_nonce + 1
+        return self.blockchain.reserve_nonce(self.wallet.address)
 
     def stake(self, amount):
         if amount < 0:
@@ -210,33 +314,51 @@ class Node:
             'amount': amount,
             'type_of_transaction' : "stake",  
             'message': "",
-            'nonce': 1,
+            'nonce': self.get_next_nonce(),
             'private_key': self.wallet.private_key
         }
 
         self.broadcast_transaction(transaction)
 
     
-    def PoS_Choose_Minter(self,seed):
+    def stake_weights(self):
+        """
+        Public keys of all nodes and their cumulative stakes, in node order.
+        Recomputed only when the stakes or the set of nodes change.
+        """
+        public_keys = [node_info['public_key'] for node_info in self.nodes.values()]
+        weights_key = (self.blockchain.stake_registry.version, tuple(public_keys))
+        if weights_key != self.minter_weights_key:
+            cumulative_stakes = []
+            current = 0
+            for public_key in public_keys:
+                current += self.calculate_stakes(public_key)
+                cumulative_stakes.append(current)
+            self.minter_weights_key = weights_key
+            self.minter_weights = (public_keys, cumulative_stakes)
+            self.minter_cache = {}
+        return self.minter_weights
 
-        seed_hash = hashlib.sha256(seed.encode()).hexdigest()
-        seed_int = int(seed_hash, 16)
+    def PoS_Choose_Minter(self,seed):
+        public_keys, cumulative_stakes = self.stake_weights()
+        if seed in self.minter_cache:
+            return self.minter_cache[seed]
 
-        total_stakes = 0
-        for node_id, node_info in self.nodes.items():
-            total_stakes+= self.calculate_stakes(node_info['public_key'])
-        rng = numpy.random.default_rng(seed_int)
+        total_stakes = cumulative_stakes[-1] if cumulative_stakes else 0
         if total_stakes == 0:
             return False 
 
+        seed_hash = hashlib.sha256(seed.encode()).hexdigest()
+        seed_int = int(seed_hash, 16)
+        rng = numpy.random.default_rng(seed_int)
         stake_target = rng.uniform(0, total_stakes)
-        current = 0
 
-        for node_id, node_info in self.nodes.items():
-            current += self.calculate_stakes(node_info['public_key'])
-            if current >= stake_target:
-                validator = node_info['public_key']
-                break
+        # First node whose cumulative stake reaches the target
+        validator = public_keys[bisect.bisect_left(cumulative_stakes, stake_target)]
+
+        if len(self.minter_cache) >= 1024:
+            self.minter_cache = {}
+        self.minter_cache[seed] = validator
         return validator
 
     def validate_block(self, block):
@@ -245,21 +367,39 @@ class Node:
             return False, "Block Validator does not match the result of the pseudo-random generator"
 
         # Retrieve the previous block from the blockchain
-        previous_block = self.blockchain.chain[-1]
+        previous_block = self.blockchain.get_last_block()
 
         # Check if the previous hash in the block matches the hash of the previous block
         if block.previous_hash != previous_block.current_hash:
             return False, "Invalid previous hash"
 
+        # Check every transaction signature, across worker processes for large blocks
+        with metrics.time_stage('verify_block_signatures'):
+            signatures_valid = all(verify_transactions(block.transactions))
+        if not signatures_valid:
+            return False, "Invalid transaction signature"
+
         return True, "Block validated successfully"
     
 
     def validate_transaction(self, transaction):
-        sender_address = transaction.sender_address    
-        amount = transaction.amount
         # Verify the transaction signature
         if not transaction.verify_signature():
             return False
+        return self.check_transaction(transaction)
+
+    def check_transaction(self, transaction):
+        """
+        Check the nonce and the funds of a transaction whose signature was
+        already verified.
+        """
+        sender_address = transaction.sender_address    
+        amount = transaction.amount
+
+        # Reject replayed or out-of-order transactions from the same sender
+        if not self.blockchain.nonces.is_fresh(sender_address, transaction.nonce):
+            print("Duplicate or out-of-order nonce")
+            return False
 
         if transaction.type_of_transaction == "coin":
             if self.calculate_balance(sender_address) - self.calculate_stakes(sender_address) < 1.03*amount:
@@ -286,16 +426,74 @@ class Node:
             return False
 
 
+    def peer_urls(self):
+        return {node_id: node_info['address'] for node_id, node_info in self.nodes.items()}
+
+    def receive_transaction(self, values):
+        """
+        Build, sign and validate a transaction received from a peer and add it to the pool.
+        """
+        return self.receive_transactions([values]) == 1
+
+    def receive_transactions(self, values_list):
+        """
+        Build, sign and validate a batch of transactions received from a peer
+        and add the valid ones to the pool, in order. The signatures are
+        verified together, across worker processes for large batches.
+
+        :return: the number of transactions added to the pool.
+        """
+        metrics.inc('transactions_received_total', len(values_list))
+        records = []
+        with metrics.time_stage('sign'):
+            for values in values_list:
+                transaction = Transaction(
+                    sender_address=values['sender_address'],
+                    receiver_address=values['receiver_address'],
+                    type_of_transaction=values['type_of_transaction'],
+                    amount=values['amount'],
+                    message=values['message'],
+                    nonce=values['nonce'],
+                )
+                transaction.sign_transaction(values['private_key'])
+                records.append(transaction.to_record())
+        with metrics.time_stage('verify_signature'):
+            verified = verify_transactions(records)
+
+        added = 0
+        # The nonce and funds checks and the insertion are one step, so two
+        # transactions spending the same funds cannot both pass the checks
+        with self.blockchain.lock:
+            for record, signature_valid in zip(records, verified):
+                if not signature_valid:
+                    metrics.inc('transactions_rejected_total', reason='signature')
+                    print("Invalid transaction")
+                    continue
+                with metrics.time_stage('validate'):
+                    valid = self.check_transaction(record)
+                if not valid:
+                    metrics.inc('transactions_rejected_total', reason='invalid')
+                    print("Invalid transaction")
+                    continue
+                if self.blockchain.add_transaction_to_pool(record):
+                    added += 1
+        return added
+
     def broadcast_transaction(self, transaction):
-        for node_id, node_info in self.nodes.items():
-            node_url = node_info['address'] 
-            requests.post(node_url + '/transactions/new', json=transaction)
+        if self.gossip is not None:
+            return {self.node_id: self.gossip.originate('/transactions/new', transaction)}
+        results = self.broadcaster.post_all(self.peer_urls(), '/transactions/new', transaction)
+        accepted = delivered(results)
+        if len(accepted) < len(results):
+            print(f"Transaction accepted by {len(accepted)}/{len(results)} nodes")
+        return results
 
     def broadcast_block(self, block):
-        for node_id, node_info in self.nodes.items():
-            node_url = node_info['address'] 
-            requests.post(node_url + '/receive_block', json=block)
-        print('Block broadcasted to the network')
+        if self.gossip is not None:
+            return {self.node_id: self.gossip.originate('/receive_block', block)}
+        results = self.broadcaster.post_all(self.peer_urls(), '/receive_block', block)
+        print(f'Block broadcasted to {len(delivered(results))}/{len(results)} nodes')
+        return results
 
     def validate_chain(self):
         for block in self.blockchain.chain[1:]:  # Exclude the genesis block
@@ -306,50 +504,123 @@ class Node:
         return True, "Blockchain validation successful"
 
 
-    def broadcast_all(self):
-        # Data to be broadcasted: IP address, port, and public keys of all nodes
-        data_to_broadcast = {
-            node_id: {
-                'address': node_info['address'],
-                'public_key': node_info['public_key']
-            }
-            for node_id, node_info in self.nodes.items()
+    def tip(self):
+        """
+        Height and hash of the last block, advertised to peers for syncing.
+        """
+        view = self.blockchain.view()
+        last_block = view.tip()
+        return {
+            'height': view.height,
+            'hash': last_block.current_hash if last_block else None,
+        }
+
+    def catch_up(self, block):
+        """
+        Fetch the blocks missing below a block that arrived ahead of the tip
+        from its validator, which minted it on top of them. Blocks of
+        different validators travel over different connections, so a block
+        can arrive before its parent.
+
+        :return: True if blocks were added.
+        """
+        if block.index <= self.blockchain.view().height:
+            return False
+        node_id = self.node_ids_by_key.get(block.validator)
+        node_info = self.nodes.get(node_id) if node_id is not None else None
+        if node_info is None or node_info['address'] == self.api_url:
+            return False
+        print(f"Block {block.index} is ahead of the tip, syncing with its validator at {node_info['address']}")
+        return self.sync_with(node_info['address'])
+
+    def holds_block(self, block):
+        """
+        Whether the chain already has this block, such as one fetched by catch_up().
+        """
+        view = self.blockchain.view()
+        return block.index < view.height and view.blocks[block.index].current_hash == block.current_hash
+
+    def sync_with(self, peer_url, peer_tip=None):
+        """
+        Fetch only the blocks this node is missing from a peer and append them.
+        Falls back to a full chain transfer when the new blocks do not build on
+        the local tip, as the fork point is then unknown.
+        """
+        local_tip = self.blockchain.view()
+        local_height = local_tip.height
+        if peer_tip is not None and peer_tip['height'] <= local_height:
+            return False
+
+        session = self.broadcaster.session_for(peer_url)
+        headers = {
+            'Accept': f'{wire.CONTENT_TYPE}, application/json;q=0.5',
+            wire.KEYS_HEADER: self.wire_keys().digest.hex(),
         }
         try:
-            self.send_data(data_to_broadcast)
-        except Exception as e:
-            print(f"Failed to send data")
+            response = session.get(peer_url + '/blocks', params={'from': local_height}, headers=headers,
+                                   timeout=self.broadcaster.timeout)
+            if response.status_code != 200:
+                print(f"Failed to fetch blocks from {peer_url}. Status code: {response.status_code}")
+                return False
+            blocks = [Block.from_dict(block_data) for block_data in self.decode_response(response)['blocks']]
+            if not blocks:
+                return False
 
-        print("Broadcast completed to all nodes in the network.")
+            if local_height == 0:
+                return self.adopt_chain(blocks)
 
-    def send_data(self, data):
-        node_items = list(self.nodes.items())[:-1]
-        
-        for node_id, node_info in node_items:
-        
-            # Skip sending data if the current node is the node itself
-            if node_id == self.node_id:
-                continue
-            if node_id == self.total_nodes - 1:
-                continue
-            ip_address = node_info['address']
-            url = f"{ip_address}/receive_data"
+            if blocks[0].previous_hash == local_tip.tip().current_hash and self.blockchain.extend_chain(blocks):
+                print(f"Synced {len(blocks)} blocks from {peer_url}, height is now {self.blockchain.view().height}.")
+                return True
 
-            try:
-                response = requests.post(url, json=data)
-                if response.status_code == 200:
-                    print(f"Data successfully sent to node {node_id}.")
-                else:
-                    print(f"Failed to send data to node {node_id}. Status code: {response.status_code}")
-            except requests.exceptions.RequestException as e:
-                print(f"Failed to send data to node {node_id}: {e}")
+            # Another sync may have added some of them meanwhile, only the rest are needed
+            missing = [block for block in blocks if not self.holds_block(block)]
+            if not missing:
+                return True
+            if missing[0].previous_hash == self.blockchain.view().tip().current_hash and self.blockchain.extend_chain(missing):
+                print(f"Synced {len(missing)} blocks from {peer_url}, height is now {self.blockchain.view().height}.")
+                return True
+
+            print(f"Blocks from {peer_url} do not extend the local tip, fetching the full chain.")
+            return self.fetch_chain(peer_url)
+        except (requests.exceptions.RequestException, KeyError, TypeError, ValueError) as e:
+            print(f"Failed to sync with {peer_url}: {e}")
+            return False
+
+    def fetch_chain(self, peer_url):
+        """
+        Fetch a peer's full chain as JSON and adopt it if it is valid and
+        longer. The blocks are read and checked as they arrive, and the
+        transfer is dropped at the first invalid one.
+        """
+        session = self.broadcaster.session_for(peer_url)
+        with session.get(peer_url + '/blockchain', headers={'Accept': 'application/json'},
+                         timeout=self.broadcaster.timeout, stream=True) as response:
+            if response.status_code != 200:
+                return False
+            stream = ObjectStream('chain')
+            builder = ChainBuilder()
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if not builder.extend([Block.from_dict(block_data) for block_data in stream.feed(chunk)]):
+                    print(f"Received chain from {peer_url} is invalid.")
+                    return False
+            stream.close()
+        chain = builder.finish()
+        if chain is None:
+            print(f"Received chain from {peer_url} is invalid.")
+            return False
+        if self.blockchain.replace_if_longer(chain):
+            print(f"Blockchain updated with a longer chain of length {len(chain)}.")
+            return True
+        print("Received chain is not longer than the current chain.")
+        return False
 
     def view(self):
         """
         View last transactions: print the transactions contained in the last validated block
         of the BlockChat blockchain.
         """
-        last_block = self.blockchain.chain[-1]
+        last_block = self.blockchain.get_last_block()
         if last_block:
             transactions = last_block.transactions
             val_id = self.get_node_id_by_public_key(last_block.validator)
@@ -378,11 +649,7 @@ class Node:
             return
 
         # Find the recipient's public key using the recipient_address
-        recipient_public_key = None
-        for node_id, node_info in self.nodes.items():
-            if node_info['address'] == recipient_address:
-                recipient_public_key = node_info['public_key']
-                break
+        recipient_public_key = self.keys_by_address.get(recipient_address)
 
 
         transaction = {
@@ -395,105 +662,61 @@ class Node:
             'private_key': self.wallet.private_key
         }
 
-        self.broadcast_transaction(transaction)
+        results = self.broadcast_transaction(transaction)
 
-        return True
+        return len(delivered(results)) == len(results)
             
 
 
-    def mint_block(self):
-            currentValidator = self.PoS_Choose_Minter(self.blockchain.chain[-1].current_hash)
-            if len(self.blockchain.transaction_pool) == self.blockchain.block_capacity:
-                transactions = self.blockchain.transaction_pool
-                self.blockchain.transaction_pool = []
-                if self.wallet.public_key == currentValidator:
-                        previous_block = self.blockchain.chain[-1]
-
-                        # Handle both dict and Transaction instances in the transaction pool
-                        transactions_data = []
-                        for tx in transactions:
-                            if isinstance(tx, Transaction):
-                                transactions_data.append(tx.to_dict())
-                            elif isinstance(tx, dict):
-                                transactions_data.append(tx)  # tx is already a dict
-                            else:
-                                print("Unsupported transaction type in transaction pool")
-                                continue
-
-                        new_block_data = {
-                            'index': len(self.blockchain.chain),
-                            'transactions': transactions_data,
-                            'validator': currentValidator,
-                            'previous_hash': previous_block.current_hash
-                        }
-
-                        try: 
-                            self.broadcast_block(new_block_data)
-                            print("Block broadcasted")
-                        except Exception as e:
-                            print(f"Broadcast block failed: {e}")
-                            return False
-            else:
-                print("Transaction pool not full")
-
-
-
+    def mint_block(self, partial=False):
+        """
+        Mint the next block if this node is its validator. Other nodes keep the
+        transactions in their pool until the block reaches them.
 
+        :param partial: mint even if the pool does not hold a full block.
+        :return: True if a block was minted and delivered.
+        """
+        # The pool is taken under the writer lock, the broadcast happens
+        # outside it so transactions keep flowing in meanwhile
+        with self.blockchain.lock:
+            view = self.blockchain.view()
+            previous_block = view.tip()
+            currentValidator = self.PoS_Choose_Minter(previous_block.current_hash)
+            if not self.blockchain.transaction_pool or (not partial and not self.blockchain.pool_full()):
+                print("Transaction pool not full")
+                return False
+            if self.wallet.public_key != currentValidator:
+                return False
+            with metrics.time_stage('mint'):
+                transactions = self.blockchain.take_block_transactions()
+
+        new_block_data = {
+            'index': view.height,
+            'transactions': [tx.to_dict() for tx in transactions],
+            'validator': currentValidator,
+            'previous_hash': previous_block.current_hash
+        }
 
+        results = self.broadcast_block(new_block_data)
+        if not delivered(results):
+            print("Broadcast block failed")
+            return False
+        metrics.inc('blocks_minted_total')
+        return True
 
     def calculate_balance(self, public_key):
-        balance = 0
-
-        for block in self.blockchain.chain:
-            for transaction in block.transactions:
-                if transaction['receiver_address'] == public_key :
-                    balance += transaction['amount']
-                if transaction['sender_address'] == public_key and transaction['receiver_address'] != 0 and balance > 0 :
-                    if transaction['type_of_transaction'] == "Welcome!":
-                        balance -= transaction['amount']
-                    elif transaction['type_of_transaction'] == "coin":
-                        balance -= 1.03*transaction['amount'] 
-                    elif transaction['type_of_transaction'] == "message":    
-                        balance -= len(transaction['message'])
-
-        for transaction in self.blockchain.transaction_pool:
-                if transaction['receiver_address'] == public_key :
-                    balance += transaction['amount']
-                if transaction['sender_address'] == public_key and transaction['receiver_address'] != 0 and balance > 0:
-                    if transaction['type_of_transaction'] == "Welcome!":
-                        balance -= transaction['amount']
-                    elif transaction['type_of_transaction'] == "coin":
-                        balance -= 1.03*transaction['amount'] 
-                    elif transaction['type_of_transaction'] == "message":    
-                        balance -= len(transaction['message'])
-
-        if balance > 0:
-            return balance
-        else:
-            balance = 0 
-            return balance
+        return self.blockchain.view().balance(public_key)
 
     def calculate_stakes(self, public_key):
-        totstake = 10
-
-        for transaction in reversed(self.blockchain.transaction_pool):
-            if transaction['type_of_transaction'] == "stake" and transaction['sender_address'] == public_key:
-                totstake = transaction['amount']
-                break  
-
-        if totstake == 10: 
-            for block in reversed(self.blockchain.chain):  
-                for transaction in reversed(block.transactions):  
-                    if transaction['type_of_transaction'] == "stake" and transaction['sender_address'] == public_key:
-                        totstake = transaction['amount']
-                        return totstake  
-
-        return totstake
+        return self.blockchain.view().stake(public_key)
 
     def start_test_all_nodes(self, node_addresses, transactions_folder):
+        # One run id for all nodes, their records are aggregated together
+        run_id = self.default_run_id() + f'_{int(time.time())}'
         for node_address in node_addresses:
             try:
-                response = requests.post(node_address + '/start_test', json={'transactions_folder': transactions_folder})
+                response = requests.post(node_address + '/start_test', json={'transactions_folder': transactions_folder,
+                                                                             'run_id': run_id})
                 if response.status_code == 200:
                     print(f"Transaction test started successfully at {node_address}")
                 else:
@@ -502,19 +725,41 @@ class Node:
                 print(f"Error communicating with node at {node_address}: {e}")
 
 
-    def start_transaction_test(self, transactions_folder, node_id): 
+    def default_run_id(self):
+        """
+        Run id the nodes of a network agree on without being told: the
+        configuration and the genesis block hash.
+        """
+        genesis = self.blockchain.view().blocks[0]
+        return f'{self.total_nodes}nodes_capacity{self.blockchain.block_capacity}_{genesis.current_hash[:12]}'
+
+    def start_transaction_test(self, transactions_folder, node_id, run_id=None):
         self.node_id = node_id
         transactions_file_path = os.path.join(transactions_folder, f'trans{node_id}.txt')
         if not os.path.exists(transactions_file_path):
             print(f"Transaction file '{transactions_file_path}' does not exist.")
             return
-        self.load_and_process_transactions(transactions_file_path)
+        self.load_and_process_transactions(transactions_file_path, run_id or self.default_run_id())
 
-    def load_and_process_transactions(self, filepath):
+    def load_and_process_transactions(self, filepath, run_id=None):
+        """
+        Replay a transactions file: send its transactions to every node in
+        batches of replay_batch_size, with up to replay_in_flight batches
+        queued ahead per node instead of one round trip per transaction.
+        The run is recorded once the transactions are committed.
+        """
+        # Recipients are looked up by node id for every line
+        nodes_by_id = {str(node_id).strip(): node_info for node_id, node_info in self.nodes.items()}
+        # In gossip mode the batches go to this node only, which relays them
+        peers = {self.node_id: self.api_url} if self.gossip is not None else self.peer_urls()
+        pipeline = BatchPipeline(self.broadcaster, peers, '/transactions/batch', self.replay_in_flight)
         with open(filepath, 'r') as file:
             start_time = time.time()
+            height_start = self.blockchain.view().height
+            latency_mark = self.blockchain.inclusion_latency_count
             transaction_count = 0
-            node_transactions = 0
+            transaction_ids = []
+            batch = []
             for line in file:
                 parts = line.strip().split(' ', 1)
                 if len(parts) != 2:
@@ -527,30 +772,72 @@ class Node:
                     print(f"Could not extract recipient ID from: {node_id_part}")
                     continue
 
-                recipient_id = str(recipient_id) 
-
-                for node_id, node_info in self.nodes.items():
-                    node_id = str(node_id).strip()  
-                    if node_id == recipient_id:
-                        recipient_info = node_info
-                        break
-                else:
+                recipient_info = nodes_by_id.get(recipient_id)
+                if recipient_info is None:
                     print(f"Recipient node ID {recipient_id} not found in nodes dictionary.")
                     continue
 
-                recipient_address = recipient_info['address']
-
-                self.create_transaction(recipient_address, 0, message, "message")
+                values = {
+                    'sender_address': self.wallet.public_key,
+                    'receiver_address': recipient_info['public_key'],
+                    'amount': 0.0,
+                    'type_of_transaction': 'message',
+                    'message': message,
+                    'nonce': self.get_next_nonce(),
+                    'private_key': self.wallet.private_key
+                }
+                batch.append(values)
+                transaction_ids.append(bytes.fromhex(transaction_key(values)))
+                if len(batch) == self.replay_batch_size:
+                    pipeline.submit(self.batch_payload(batch))
+                    batch = []
 
                 transaction_count += 1
 
+            if batch:
+                pipeline.submit(self.batch_payload(batch))
+            batches = -(-transaction_count // self.replay_batch_size)
+            for node_id, delivered_batches in pipeline.close().items():
+                if delivered_batches < batches:
+                    print(f"Node {node_id} accepted {delivered_batches}/{batches} transaction batches")
+
             end_time = time.time()
-            processing_time = end_time - start_time
-            node_transactions += transaction_count
+            committed, committed_at = self.wait_for_inclusion(transaction_ids, self.inclusion_timeout, self.inclusion_idle)
+            if committed < transaction_count:
+                print(f"{committed}/{transaction_count} transactions committed")
+            self.save_metrics(run_id or self.default_run_id(), start_time, end_time, transaction_count, committed,
+                              committed_at, height_start, latency_mark)
 
-            metrics_filepath = f'metrics_{self.total_nodes}_nodes_capacity{self.blockchain.block_capacity}_for_node{self.node_id}.txt'
-            self.save_metrics(metrics_filepath, processing_time, node_transactions)
 
+    def wait_for_inclusion(self, transaction_ids, timeout, idle):
+        """
+        Wait until the given transactions are in the chain, for at most
+        timeout seconds. Transactions refused by the nodes, for lack of funds
+        say, never get there, so the wait also ends once no block was added
+        for idle seconds.
+
+        :return: how many of them are, and the timestamp of the latest block holding one, or None.
+        """
+        pending = set(transaction_ids)
+        committed_at = None
+        deadline = time.time() + timeout
+        height, grown = self.blockchain.view().height, time.time()
+        while True:
+            for transaction_id in list(pending):
+                found = self.blockchain.find_transaction(transaction_id)
+                if found is not None:
+                    pending.discard(transaction_id)
+                    committed_at = max(committed_at or 0, found[1].timestamp)
+            now = time.time()
+            if self.blockchain.view().height != height:
+                height, grown = self.blockchain.view().height, now
+            if not pending or now > deadline or now - grown > idle:
+                return len(transaction_ids) - len(pending), committed_at
+            time.sleep(0.1)
+
+    def batch_payload(self, batch):
+        payload = {'transactions': batch}
+        return self.gossip.stamp(payload) if self.gossip is not None else payload
 
     def count_blocks(self):
         if not self.blockchain.chain:
@@ -562,72 +849,43 @@ class Node:
             return block_count
 
     
-    def save_metrics(self, metrics_filename, processing_time, node_transactions):
+    def save_metrics(self, run_id, start_time, end_time, node_transactions, committed, committed_at,
+                     height_start, latency_mark):
+        """
+        Store this node's record of a transactions replay, see results.py.
+        """
         if node_transactions == 0:
             print("No transactions to calculate metrics.")
             return
-
-        # block_count = self.count_blocks()  
-        throughput = node_transactions / processing_time if processing_time > 0 else 0
-        # block_time = self.total_processing_time / block_count if block_count else 0
-
-        current_directory = os.getcwd()  # Get the current working directory
-        directory_path = os.path.join(current_directory, 'test_results')  # Form the path to the test_results directory
-        filepath = os.path.join(directory_path, metrics_filename)  # Form the full file path
-        
-        # Ensure the directory exists
-        os.makedirs(directory_path, exist_ok=True)  # Create the directory if it does not exist
-        
-        # Write the metrics to the file
+        view = self.blockchain.view()
+        record = {
+            'run_id': run_id,
+            'nodes': self.total_nodes,
+            'capacity': self.blockchain.block_capacity,
+            'node_id': self.node_id,
+            'transactions': node_transactions,
+            'started': start_time,
+            'finished': end_time,
+            'committed': committed,
+            'committed_at': committed_at if committed_at is not None else '',
+            'height_start': height_start,
+            'height_end': view.height,
+            'last_block_timestamp': view.tip().timestamp if view.height > height_start else '',
+        }
         try:
-            with open(filepath, 'w') as file:
-                file.write(f"Transactions: {node_transactions}\n")
-                file.write(f"Throughput: {throughput} transactions/second\n")
-                # file.write(f"Block Count: {block_count}\n")
-                # file.write(f"Average Block Time: {block_time} seconds/block\n")
-        except Exception as e:
+            results.save_node_record(record, self.blockchain.inclusion_latencies_since(latency_mark))
+        except OSError as e:
             print(f"Failed to save metrics: {e}")
 
-        self.aggregate_metrics(total_nodes = self.total_nodes, folder_path='test_results/', output_filename=f'metrics_{self.total_nodes}_nodes_capacity{self.blockchain.block_capacity}.txt')
-
-    def aggregate_metrics(self, total_nodes, folder_path, output_filename):
-    
-        files = [f for f in os.listdir(folder_path) if os.path.isfile(os.path.join(folder_path, f))]
-        
-        # Check if the number of metric files matches the total number of nodes
-        if len(files) == total_nodes:
-            longest_processing_time = 0
-            self.total_transactions=0
-            self.throughput=0
-            self.block_count=0
-            self.block_time=0
-            # Iterate through each file and aggregate the metrics
-            for file in files:
-                with open(os.path.join(folder_path, file), 'r') as f:
-                    for line in f:
-                        if "Transactions" in line:
-                            self.total_transactions += int(line.split(":")[1].strip())
-                        elif "Throughput" in line:
-                            processing_time = float(line.split(":")[1].strip().split()[0])  
-                            longest_processing_time = max(longest_processing_time, processing_time)
-  
-            # Calculate new aggregated metrics
-            self.throughput = self.total_transactions / longest_processing_time if longest_processing_time > 0 else 0
-            self.block_count = self.count_blocks()  
-            self.block_time = processing_time / self.block_count if self.block_count else 0
-
-            output_filepath = os.path.join(folder_path, output_filename)
-            with open(output_filepath, 'w') as output_file:
-                output_file.write(f"Total Transactions: {self.total_transactions}\n")
-                output_file.write(f"Total Throughput: {self.throughput} transactions/second\n")
-                output_file.write(f"Total Block Count: {self.block_count}\n")
-                output_file.write(f"Average Block Time: {self.block_time} seconds/block\n")
-            
-            print(f"Aggregated metrics saved to {output_filepath}")
-
     def take_metrics(self):
-        print(f"Total Transactions: {self.total_transactions}\n")
-        print(f"Total Throughput: {self.throughput} transactions/second\n")
-        print(f"Total Block Count: {self.block_count}\n")
-        print(f"Average Block Time: {self.block_time} seconds/block\n")
+        """
+        Print the figures of the runs recorded in this node's results
+        directory for its configuration.
+        """
+        summaries = [summary for summary in results.aggregate(results.load_runs())
+                     if summary['nodes'] == self.total_nodes and summary['capacity'] == self.blockchain.block_capacity]
+        if not summaries:
+            print(f"No runs recorded in {results.RESULTS_DIR}")
+        for summary in summaries:
+            print(results.format_summary(summary))
 
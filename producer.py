@@ -0,0 +1,64 @@
+import time
+from threading import Event, Thread
+
+
+class BlockProducer:
+    """
+    Background thread that mints a block as soon as the pool holds a full
+    block, or once the oldest waiting transaction has waited max_latency
+    seconds, whichever comes first. A partly filled block is only minted on
+    the deadline.
+
+    Nothing is minted on a deadline until every node has joined, the
+    bootstrap node fills its first blocks itself while nodes register.
+    """
+    def __init__(self, node, max_latency=5.0):
+        self.node = node
+        self.max_latency = max_latency
+        # A deadline that passed while another node was the validator is not
+        # retried before this, the block is expected from that node meanwhile
+        self.retry_at = 0
+        self.wakeup = Event()
+        self.stopped = Event()
+        self.worker = Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.worker.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+    def notify(self):
+        """
+        Tell the producer the pool has changed.
+        """
+        self.wakeup.set()
+
+    def next_deadline(self):
+        received = self.node.blockchain.oldest_pending_time()
+        if received is None:
+            return None
+        return max(received + self.max_latency, self.retry_at)
+
+    def run(self):
+        while not self.stopped.is_set():
+            deadline = self.next_deadline()
+            timeout = None if deadline is None else max(0.0, deadline - time.time())
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+            if self.stopped.is_set():
+                break
+            try:
+                self.produce()
+            except Exception as e:
+                print(f"Failed to produce block: {e}")
+
+    def produce(self):
+        blockchain = self.node.blockchain
+        while blockchain.pool_full() and self.node.mint_block():
+            pass
+        deadline = self.next_deadline()
+        if deadline is not None and time.time() >= deadline:
+            if len(self.node.nodes) < self.node.total_nodes or not self.node.mint_block(partial=True):
+                self.retry_at = time.time() + self.max_latency
@@ -2,12 +2,22 @@ import json
 import logging
 from threading import Thread, Event
 from flask.logging import default_handler
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import requests
 from block import Block
+from broadcast import delivered
+from gossip import Gossip, transaction_key
+from ingest import IngestQueue
+from jsonstream import CHUNK_SIZE, ObjectStream, StreamError, write_object
+import metrics
+from producer import BlockProducer
+import wire
+from wire import WireError
 from node import Node  # Assuming your Node class is inside a folder named 'network'
-from blockchain import Blockchain
-from transaction import Transaction
+from blockchain import Blockchain, ChainBuilder, located_transaction_dict
+from keystore import KeyStore, read_wallet, write_key
+from store import BlockStore
+from transaction import Transaction, TransactionRecord
 from uuid import uuid4
 import os 
 
@@ -23,10 +33,57 @@ logger.addHandler(default_handler)
 shutdown_event = Event()
 
 node = None
+ingest_queue = None
+block_producer = None
 # Unique identifier for this node in the network
 node_identifier = str(uuid4()).replace('-', '')
 
 
+def read_payload():
+    """
+    Body of the request, in the binary wire format or as JSON.
+    """
+    if request.mimetype == wire.CONTENT_TYPE:
+        return wire.decode(request.get_data(), node.wire_keys())
+    return request.get_json()
+
+def read_chain(list_key):
+    """
+    Read a payload carrying a chain under list_key, checking the blocks as
+    they arrive. A JSON body is parsed a chunk at a time and the read stops
+    at the first invalid block; a binary one is decoded whole.
+
+    :return: the validated blocks, or None if the chain is invalid, and the other fields of the payload.
+    """
+    builder = ChainBuilder()
+    if request.mimetype == wire.CONTENT_TYPE:
+        fields = read_payload()
+        blocks = [Block.from_dict(block_data) for block_data in fields.pop(list_key, [])]
+        return (builder.finish() if builder.extend(blocks) else None), fields
+
+    stream = ObjectStream(list_key)
+    for chunk in iter(lambda: request.stream.read(CHUNK_SIZE), b''):
+        if not builder.extend([Block.from_dict(block_data) for block_data in stream.feed(chunk)]):
+            return None, {}
+    fields = stream.close()
+    return builder.finish(), fields
+
+def wants_binary():
+    return request.accept_mimetypes.best_match(['application/json', wire.CONTENT_TYPE]) == wire.CONTENT_TYPE
+
+def response_keys():
+    """
+    Key ids for a binary response, none unless the requester has the same registry.
+    """
+    keys = node.wire_keys()
+    return keys if request.headers.get(wire.KEYS_HEADER) == keys.digest.hex() else wire.NO_REGISTRY
+
+@app.errorhandler(WireError)
+def unsupported_payload(e):
+    # The sender falls back to JSON on 415
+    return jsonify({'error': str(e)}), 415
+
+
 @app.route('/register', methods=['POST'])
 def register():
     try:
@@ -39,85 +96,107 @@ def register():
         # Validate the incoming data
         if not public_key or not node_address:
             return jsonify({'message': 'Missing public key or node address'}), 400
-        
-        
-        assigned_node_id = node.next_node_id
-        print(f"Current node: {assigned_node_id}")
-        
-        # Use public_key as the unique identifier for simplicity
-        if public_key in node.nodes:
-            print(f"Node with public key {public_key} is already registered.")
-            return False, None
-        
-        node.nodes[assigned_node_id] = {'public_key': public_key, 'address': node_address}
-        node.next_node_id += 1
-
-        print(f"Node {assigned_node_id} registered.")
-
-        node.transfer_bcc_to_new_node(public_key, 1000)
-
-        print(f"Total nodes: {node.total_nodes}")
 
-        blockchain_data = []
-        for block in node.blockchain.chain:
-            block_dict = block.to_dict()  # Assuming Block has a to_dict method
-            block_dict['transactions'] = [tx.to_dict() if hasattr(tx, 'to_dict') else tx for tx in block.transactions]
-            blockchain_data.append(block_dict)
+        # A node started from a keystore slot asks for the id of that slot
+        requested_node_id = values.get('node_id')
+        if requested_node_id is not None and not isinstance(requested_node_id, int):
+            return jsonify({'message': 'The node id must be an integer'}), 400
 
+        assigned_node_id, complete = node.register_node(public_key, node_address, requested_node_id)
+        if assigned_node_id is None:
+            print(f"Node with public key {public_key} is already registered, or node id {requested_node_id} is not free.")
+            return jsonify({'message': 'Node already registered or node id not free'}), 400
+        print(f"Node {assigned_node_id} registered.")
 
-        broadcast_blockchain()
-
-        if node.next_node_id == node.total_nodes:
-            node.broadcast_all()
-        
-        nodes_data = {
-            node_id: {
-                'address': node_info['address'],
-                'public_key': node_info['public_key']
-            }
-            for node_id, node_info in node.nodes.items()
-        }
+        # The roster and the chain go out to everyone once, after the last
+        # registration, from a thread so the last node gets its answer first
+        if complete:
+            Thread(target=node.publish_network, daemon=True).start()
 
         response = {
             'message': 'New node registered successfully',
             'node_id': assigned_node_id,  # Include the node ID in the response
             'node_address': node_address,
-            'total_nodes': [node_info['address'] for node_info in node.nodes.values()],
-            'blockchain': blockchain_data,
-            'transaction_pool': node.blockchain.transaction_pool,
-            'nodes': nodes_data
         }
         return jsonify(response), 200
     except Exception as e:
         logger.exception("Failed to register node: %s", e)
         return jsonify({'error': 'Internal server error'}), 500    
 
+@app.route('/join', methods=['POST'])
+def join():
+    try:
+        chain, data = read_chain('blockchain')
+        if not chain or not node.join_network(data['nodes'], chain, data['transaction_pool']):
+            return jsonify({'error': 'Received chain is invalid'}), 400
+        # Welcome transfers left in the pool may fill a block
+        block_producer.notify()
+        return jsonify({'message': 'Joined the network', 'tip': node.tip()}), 200
+    except StreamError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.exception("Failed to join the network: %s", e)
+        return jsonify({'error': 'Internal server error'}), 500
+
 @app.route('/transactions/new', methods=['POST'])
 def new_transaction():
-    values = request.get_json()
-
-    new_transaction = Transaction(
-                sender_address=values['sender_address'],
-                receiver_address=values['receiver_address'],
-                type_of_transaction=values['type_of_transaction'],
-                amount=values['amount'],  
-                message=values['message'],
-                nonce=values['nonce'],
-            )
+    values = read_payload() if request.mimetype == wire.CONTENT_TYPE else request.get_json(silent=True)
+
+    required_fields = ['sender_address', 'receiver_address', 'type_of_transaction', 'amount', 'message', 'nonce', 'private_key']
+    if not values or any(field not in values for field in required_fields):
+        return jsonify({'error': 'Missing transaction fields'}), 400
+
+    key = transaction_key(values) if node.gossip is not None else None
+    if key is not None and not node.gossip.first_seen(key):
+        metrics.metrics.inc('gossip_duplicates_total', path='/transactions/new')
+        return jsonify({'message': 'Transaction already seen'}), 200
+
+    # Validation, pool insertion and minting happen on the ingest worker
+    if not ingest_queue.submit(values):
+        if key is not None:
+            node.gossip.forget(key)
+        return jsonify({'error': 'Transaction queue full, retry later'}), 429
+    if key is not None:
+        node.gossip.relay('/transactions/new', values)
+    return jsonify({'message': 'Transaction queued'}), 202
     
-    new_transaction.sign_transaction(values['private_key'])
 
-    if node.validate_transaction(new_transaction):
-        node.blockchain.add_transaction_to_pool(new_transaction.to_dict())
-        node.mint_block()
-        return jsonify({'error': 'Transaction broadcasted'}), 200
-    else:
-        return jsonify({'error': 'Invalid transaction'}), 400
-    
+@app.route('/transactions/batch', methods=['POST'])
+def new_transactions():
+    values = read_payload() if request.mimetype == wire.CONTENT_TYPE else request.get_json(silent=True)
+    transactions = values.get('transactions') if isinstance(values, dict) else None
+
+    required_fields = ['sender_address', 'receiver_address', 'type_of_transaction', 'amount', 'message', 'nonce', 'private_key']
+    if not isinstance(transactions, list) or any(not isinstance(tx, dict) or any(field not in tx for field in required_fields)
+                                                 for tx in transactions):
+        return jsonify({'error': 'Missing transaction fields'}), 400
+    if len(transactions) > ingest_queue.queue.maxsize:
+        return jsonify({'error': 'Batch larger than the transaction queue'}), 413
+
+    keys = []
+    if node.gossip is not None:
+        # Only the transactions this node has not seen are queued and passed on
+        unseen = []
+        for transaction in transactions:
+            key = transaction_key(transaction)
+            if node.gossip.first_seen(key):
+                keys.append(key)
+                unseen.append(transaction)
+        metrics.metrics.inc('gossip_duplicates_total', len(transactions) - len(unseen), path='/transactions/batch')
+        transactions = unseen
+
+    # Queued whole or not at all, so a retried batch is never partly duplicated
+    if not ingest_queue.submit_many(transactions):
+        for key in keys:
+            node.gossip.forget(key)
+        return jsonify({'error': 'Transaction queue full, retry later'}), 429
+    if transactions and node.gossip is not None:
+        node.gossip.relay('/transactions/batch', dict(values, transactions=transactions))
+    return jsonify({'message': 'Transactions queued', 'queued': len(transactions)}), 202
 
 @app.route('/receive_block', methods=['POST'])
 def new_block():
-    values = request.get_json()
+    values = read_payload()
 
     # Log the received values for debugging purposes
     print("Received data for new block:", values)
@@ -125,53 +204,129 @@ def new_block():
     # Instantiate the Block here
     new_block = Block(
         index=values['index'],
-        transactions=values['transactions'],
+        transactions=[TransactionRecord.from_dict(tx) for tx in values['transactions']],
         validator=values['validator'],
         previous_hash=values['previous_hash'],
         capacity = node.blockchain.block_capacity
     )
 
-    if node.validate_block(new_block):
-        node.blockchain.add_block(new_block)
+    if node.gossip is not None:
+        if not node.gossip.first_seen(new_block.current_hash):
+            metrics.metrics.inc('gossip_duplicates_total', path='/receive_block')
+            return jsonify({'message': 'Block already seen'}), 200
+        # Passed on before validating, a node that is behind and rejects the
+        # block must not cut off the nodes below it; each of them validates too
+        node.gossip.relay('/receive_block', values)
+
+    is_valid, message = node.validate_block(new_block)
+    if not is_valid and node.catch_up(new_block):
+        if node.holds_block(new_block):
+            block_producer.notify()
+            return jsonify({'message': 'Block added while catching up'}), 200
+        is_valid, message = node.validate_block(new_block)
+    if is_valid:
+        try:
+            node.blockchain.add_block(new_block)
+        except Exception as e:
+            # Another block took the tip after this one was validated
+            print(e)
+            return jsonify({'error': 'Invalid block'}), 400
+        # The next validator may be this node, and leftovers may fill a block
+        block_producer.notify()
         return jsonify({'message': 'Block added and broadcasted'}), 200
     else:
+        print(message)
         return jsonify({'error': 'Invalid block'}), 400
     
     
 @app.route('/blockchain', methods=['GET'])
 def get_full_chain():
-    chain_data = [block.to_dict() for block in node.blockchain.chain]  # Convert each block to a dictionary
-    response = {
-        'chain': chain_data,
-        'length': len(chain_data),
-    }
-    return jsonify(response), 200
+    view = node.blockchain.view()
+    if wants_binary():
+        chain = [block.to_dict() for block in view.since()]
+        body = wire.encode({'chain': chain, 'length': len(chain)}, response_keys())
+        return Response(body, mimetype=wire.CONTENT_TYPE)
+    encoded_blocks = node.blockchain.encoded_blocks(view=view)
+    return Response(write_object('chain', encoded_blocks, {'length': len(encoded_blocks)}), mimetype='application/json')
+
+@app.route('/tip', methods=['GET'])
+def get_tip():
+    return jsonify(node.tip()), 200
+
+@app.route('/blocks', methods=['GET'])
+def get_blocks():
+    start = request.args.get('from', default=0, type=int)
+    if start < 0:
+        return jsonify({'error': 'Invalid height'}), 400
+    # One view for the blocks and the height, so they agree while blocks keep arriving
+    view = node.blockchain.view()
+    height = view.height
+    if wants_binary():
+        blocks = [block.to_dict() for block in view.since(start)]
+        return Response(wire.encode({'blocks': blocks, 'height': height}, response_keys()), mimetype=wire.CONTENT_TYPE)
+    encoded_blocks = node.blockchain.encoded_blocks(start, view)
+    return Response(write_object('blocks', encoded_blocks, {'height': height}), mimetype='application/json')
+
+@app.route('/tx/<transaction_id>', methods=['GET'])
+def get_transaction(transaction_id):
+    try:
+        found = node.blockchain.find_transaction(bytes.fromhex(transaction_id))
+    except ValueError:
+        return jsonify({'error': 'Invalid transaction id'}), 400
+    if found is None:
+        return jsonify({'error': 'Transaction not found'}), 404
+    return jsonify(located_transaction_dict(*found)), 200
+
+@app.route('/address/<path:public_key>/history', methods=['GET'])
+def get_address_history(public_key):
+    offset = request.args.get('offset', default=0, type=int)
+    limit = request.args.get('limit', default=50, type=int)
+    if offset < 0 or not 0 < limit <= 1000:
+        return jsonify({'error': 'Invalid offset or limit'}), 400
+    page, total = node.blockchain.address_history(public_key, offset, limit)
+    return jsonify({
+        'address': public_key,
+        'total': total,
+        'offset': offset,
+        'limit': limit,
+        'transactions': [located_transaction_dict(*entry) for entry in page],
+    }), 200
+
+@app.route('/sync', methods=['POST'])
+def sync():
+    data = read_payload()
+    try:
+        peer_url = data.get('address')
+        if not peer_url:
+            return jsonify({'error': 'Missing peer address'}), 400
+
+        node.blockchain.replace_pool([TransactionRecord.from_dict(tx) for tx in data.get('transaction_pool', [])])
+        if node.sync_with(peer_url, data.get('tip')):
+            block_producer.notify()
+            return jsonify({'message': 'Blockchain synced', 'tip': node.tip()}), 200
+        return jsonify({'message': 'Blockchain already up to date', 'tip': node.tip()}), 200
+    except Exception as e:
+        logger.exception("Failed to sync blockchain: %s", e)
+        return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/update_blockchain', methods=['POST'])
 def update_blockchain():
     try:
-        data = request.get_json()
-        incoming_chain = data['blockchain_data']
-
-        if not incoming_chain:
+        # Checked while it is read, an invalid chain is dropped at its first bad block
+        candidate_chain, data = read_chain('blockchain_data')
+        if candidate_chain is None:
+            return jsonify({'error': 'Received chain is invalid'}), 400
+        if not candidate_chain:
             return jsonify({'error': 'Invalid data received'}), 400
 
-        current_chain_backup = node.blockchain.chain
-        node.blockchain.chain = [Block(**block_data) for block_data in incoming_chain]
-        node.blockchain.transaction_pool = data['transaction_pool']
-        if node.blockchain.validate_chain():
-            current_len = len(current_chain_backup)
-            incoming_len = len(node.blockchain.chain)
-
-            if incoming_len > current_len:
-                updated_chain = [block.to_dict() for block in node.blockchain.chain]  
-                return jsonify({'message': 'Blockchain updated successfully', 'new_chain': updated_chain}), 200
-            else:
-                node.blockchain.chain = current_chain_backup
-                return jsonify({'message': 'Received chain is not longer than the current chain'}), 200
+        node.blockchain.replace_pool([TransactionRecord.from_dict(tx) for tx in data['transaction_pool']])
+        if node.blockchain.replace_if_longer(candidate_chain):
+            # Only the new height, echoing the chain back would double the memory it takes
+            return jsonify({'message': 'Blockchain updated successfully', 'length': node.blockchain.view().height}), 200
         else:
-            node.blockchain.chain = current_chain_backup
-            return jsonify({'error': 'Received chain is invalid'}), 400
+            return jsonify({'message': 'Received chain is not longer than the current chain'}), 200
+    except StreamError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.exception("Failed to update blockchain: %s", str(e))
         return jsonify({'error': 'Internal server error'}), 500
@@ -179,8 +334,8 @@ def update_blockchain():
 
 @app.route('/receive_data', methods=['POST'])
 def receive_nodes():
+    received_data = read_payload()
     try:
-        received_data = request.get_json()
         node.update_nodes(received_data)
         return jsonify({'message': 'Node updated successfully'}), 200
     except Exception as e:
@@ -188,36 +343,38 @@ def receive_nodes():
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/broadcast_blockchain', methods=['POST'])
+def broadcast_blockchain_endpoint():
+    results = broadcast_blockchain()
+    return jsonify({'delivered': delivered(results), 'peers': list(results)}), 200
+
 def broadcast_blockchain():
-    node_addresses = [node_info["address"] for node_id, node_info in node.nodes.items()]
-    
-    # Convert each block to a dictionary, including converting each transaction to a dictionary
-    blockchain_data = []
-    for block in node.blockchain.chain:
-        block_dict = block.to_dict()  # Assuming Block has a to_dict method
-        # Check if each transaction is a dict or needs conversion
-        block_dict['transactions'] = [tx if isinstance(tx, dict) else tx.to_dict() for tx in block.transactions]
-        blockchain_data.append(block_dict)
-
-    for node_address in node_addresses[:-1]:
-        try:
-            # Send the serialized blockchain data
-            response = requests.post(f"{node_address}/update_blockchain", json={'blockchain_data': blockchain_data, 'transaction_pool': node.blockchain.transaction_pool})
-            if response.status_code == 200:
-                print(f"Successfully broadcasted blockchain to {node_address}.")
-            else:
-                print(f"Failed to broadcast blockchain to {node_address}. Status Code: {response.status_code}")
-        except requests.exceptions.RequestException as e:
-            print(f"Error broadcasting blockchain to {node_address}: {e}")
+    # JSON made of the encodings cached on the blocks, the receivers check the blocks as they read them
+    body = node.chain_body('blockchain_data', {'transaction_pool': node.blockchain.pool_dicts()})
+
+    peers = dict(list(node.peer_urls().items())[:-1])
+    results = node.broadcaster.post_all(peers, '/update_blockchain', None, body, 'application/json')
+    for node_id, result in results.items():
+        node_address = peers[node_id]
+        if result['ok']:
+            print(f"Successfully broadcasted blockchain to {node_address}.")
+        elif result['status_code'] is not None:
+            print(f"Failed to broadcast blockchain to {node_address}. Status Code: {result['status_code']}")
+        else:
+            print(f"Error broadcasting blockchain to {node_address}: {result['error']}")
+    return results
 from flask import request
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route('/start_test', methods=['POST'])
 def start_test():
     data = request.get_json()
     transactions_folder = data.get('transactions_folder')
     node_id = node.get_node_id_by_public_key(node.wallet.public_key)
     if transactions_folder:
-        node.start_transaction_test(transactions_folder, node_id)
+        node.start_transaction_test(transactions_folder, node_id, data.get('run_id'))
         return jsonify({'message': f'Transaction tests started for all nodes using folder {transactions_folder}'}), 200
     else:
         return jsonify({'error': 'Missing transactions_folder in JSON data'}), 400
@@ -233,19 +390,72 @@ if __name__ == '__main__':
     parser.add_argument('--bootstrap_url', type=str, help='URL of the bootstrap node for registration')
     parser.add_argument('--block_capacity', type=int, default=5, help='Block capacity for the blockchain')
     parser.add_argument('--total_nodes', type=int, default=5, help='Total number of nodes in the network')
+    parser.add_argument('--ingest_queue_size', type=int, default=1000, help='Maximum number of transactions waiting for validation')
+    parser.add_argument('--mempool_size', type=int, default=10000, help='Maximum number of transactions waiting for a block')
+    parser.add_argument('--max_block_latency', type=float, default=5.0, help='Seconds a transaction may wait before a partly filled block is minted')
+    parser.add_argument('--server', choices=['flask', 'asyncio'], default='flask', help='HTTP server stack, asyncio needs aiohttp')
+    parser.add_argument('--replay_batch_size', type=int, default=50, help='Transactions per request when replaying a transactions file')
+    parser.add_argument('--replay_in_flight', type=int, default=4, help='Replay requests queued ahead per node')
+    parser.add_argument('--disable_metrics', action='store_true', help='Do not record the timers, counters and histograms served on /metrics')
+    parser.add_argument('--gossip_fanout', type=int, default=0, help='Relay transactions and blocks through this many peers per node instead of sending them to all, 0 for all-to-all')
+    parser.add_argument('--data_dir', type=str, help='Directory of the on-disk block store and of the node\'s wallet, the chain is kept in memory only if unset; '
+                                                     'restart a node with the same directory to resume it')
+    parser.add_argument('--keystore', type=str, help='Directory of pre-generated wallet keys, see keystore.py; a new key is generated if unset')
+    parser.add_argument('--wallet_index', type=int, help='Keystore slot of this node\'s wallet, also its node id; 0 for the bootstrap')
 
     args = parser.parse_args()
-
-    # Initialize Blockchain with specified block capacity
-    blockchain = Blockchain(block_capacity=args.block_capacity)
+    wallet_index = args.wallet_index if args.wallet_index is not None else (0 if args.is_bootstrap else None)
+    if args.keystore and wallet_index is None:
+        parser.error('--wallet_index is required with --keystore, except for the bootstrap')
+
+    # Initialize Blockchain with specified block capacity, restoring any stored chain
+    store = BlockStore(args.data_dir) if args.data_dir else None
+    blockchain = Blockchain(block_capacity=args.block_capacity, store=store, mempool_size=args.mempool_size)
+    if blockchain.load():
+        print(f"Loaded {len(blockchain.chain)} blocks from {args.data_dir}")
+
+    # The stored chain pays the wallet the node had when it was written, so a
+    # node restarted on its data_dir takes that wallet back. A restarted node
+    # registers again and the bootstrap answers with its id, without a second
+    # welcome transfer. The roster is not stored: a restarted bootstrap only
+    # learns the others again once they are restarted too.
+    wallet_path = os.path.join(args.data_dir, 'wallet.pem') if args.data_dir else None
+    wallet = read_wallet(wallet_path) if wallet_path else None
+    if wallet is not None:
+        print(f"Loaded the wallet of {args.data_dir}")
+    elif args.keystore:
+        wallet = KeyStore(args.keystore).wallet(wallet_index)
+        if wallet is None:
+            print(f"No key in slot {wallet_index} of {args.keystore}, generating a new one")
 
     # Initialize Node with specified total nodes and blockchain instance
-    node = Node(host=args.host, port=args.port, blockchain=blockchain, is_bootstrap=args.is_bootstrap, total_nodes=args.total_nodes)
+    node = Node(host=args.host, port=args.port, blockchain=blockchain, is_bootstrap=args.is_bootstrap, total_nodes=args.total_nodes,
+                wallet=wallet)
+    if wallet_path and not os.path.exists(wallet_path):
+        write_key(wallet_path, node.wallet.private_key)
+
+    node.replay_batch_size = args.replay_batch_size
+    node.replay_in_flight = args.replay_in_flight
+    if args.gossip_fanout > 0:
+        node.gossip = Gossip(node, fanout=args.gossip_fanout)
+
+    block_producer = BlockProducer(node, max_latency=args.max_block_latency)
+    block_producer.start()
+
+    ingest_queue = IngestQueue(node, block_producer, maxsize=args.ingest_queue_size)
+    ingest_queue.start()
+
+    metrics.metrics.enabled = not args.disable_metrics
+    metrics.metrics.gauge('chain_height', lambda: blockchain.view().height)
+    metrics.metrics.gauge('pool_size', lambda: len(blockchain.transaction_pool))
+    metrics.metrics.gauge('ingest_queue_depth', ingest_queue.queue.qsize)
 
     
     # Node registration logic
     if not args.is_bootstrap and args.bootstrap_url:
-        success = node.register_with_bootstrap(args.bootstrap_url, node.wallet.public_key)
+        # With a keystore the node id is the slot, the same on every run whatever order the nodes register in
+        success = node.register_with_bootstrap(args.bootstrap_url, node.wallet.public_key,
+                                               wallet_index if args.keystore else None)
         if success:
             print("Registration with the bootstrap node was successful.")
         else:
@@ -257,9 +467,13 @@ if __name__ == '__main__':
     cli_thread.start()
 
     try:
-        app.run(host=args.host, port=args.port)
+        if args.server == 'asyncio':
+            from async_rest import AsyncNodeServer
+            AsyncNodeServer(node, ingest_queue, block_producer).run(args.host, args.port)
+        else:
+            app.run(host=args.host, port=args.port)
     finally:
-        # This is executed when app.run() exits
+        # This is executed when the server exits
         shutdown_event.set()  # Signal CLI thread to shut down
         cli_thread.join()  # Wait for the CLI thread to exit
-        print("Flask app and CLI have shut down.")
\ No newline at end of file
+        print("Server and CLI have shut down.")
\ No newline at end of file
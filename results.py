@@ -0,0 +1,196 @@
+import argparse
+import csv
+import glob
+import os
+
+import numpy
+
+RESULTS_DIR = 'test_results'
+
+# Columns of the record every node writes at the end of a transactions replay
+NODE_FIELDS = [
+    'run_id', 'nodes', 'capacity', 'node_id', 'transactions', 'started', 'finished', 'committed',
+    'committed_at', 'height_start', 'height_end', 'last_block_timestamp',
+]
+
+LATENCY_PERCENTILES = (50, 90, 99)
+
+
+def mean_and_std(values):
+    """
+    Mean and standard deviation of the values that are not NaN, NaN if none is.
+    """
+    values = values[~numpy.isnan(values)]
+    if not len(values):
+        return numpy.nan, numpy.nan
+    return numpy.mean(values), numpy.std(values)
+
+
+def run_directory(run_id, results_dir=RESULTS_DIR):
+    return os.path.join(results_dir, run_id)
+
+
+def write_records(path, fields, rows):
+    """
+    Write rows, dicts or sequences in the order of fields, to a CSV file
+    with a header line.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow([row[field] for field in fields] if isinstance(row, dict) else row)
+    # Written aside and renamed, a reader never sees a partial record
+    os.replace(temporary_path, path)
+
+
+def save_node_record(record, latencies, results_dir=RESULTS_DIR):
+    """
+    Store one node's record of a run and the inclusion latencies it saw, in
+    files of their own under the run's directory, so the nodes of a cluster
+    sharing a working directory never write to the same file.
+
+    :param record: dict with the NODE_FIELDS.
+    :param latencies: inclusion latencies in seconds.
+    """
+    directory = run_directory(record['run_id'], results_dir)
+    write_records(os.path.join(directory, f"node{record['node_id']}.csv"), NODE_FIELDS, [record])
+    write_records(os.path.join(directory, f"latencies{record['node_id']}.csv"), ['latency'],
+                  [(latency,) for latency in latencies])
+
+
+def read_columns(paths, fields):
+    """
+    The given columns of a set of CSV files as float arrays, one row per
+    record over all files.
+    """
+    columns = {field: [] for field in fields}
+    for path in paths:
+        with open(path, newline='') as csv_file:
+            for row in csv.DictReader(csv_file):
+                for field in fields:
+                    value = row.get(field)
+                    columns[field].append(float(value) if value not in (None, '') else numpy.nan)
+    return {field: numpy.array(values, dtype=float) for field, values in columns.items()}
+
+
+def load_runs(results_dir=RESULTS_DIR):
+    """
+    Per-run figures of every run stored under results_dir.
+
+    A run's duration is from the first node starting its replay to the last
+    of the replayed transactions being committed. Throughput is the
+    committed transactions over that duration, and block time is the time
+    from the start to the last block any node saw, over the blocks added
+    meanwhile.
+
+    :return: list of dicts, one per run, with the run's latencies as an array.
+    """
+    runs = []
+    for directory in sorted(glob.glob(os.path.join(results_dir, '*', ''))):
+        node_paths = sorted(glob.glob(os.path.join(directory, 'node*.csv')))
+        if not node_paths:
+            continue
+        with open(node_paths[0], newline='') as csv_file:
+            run_id = next(csv.DictReader(csv_file))['run_id']
+        columns = read_columns(node_paths, NODE_FIELDS[1:])
+        latencies = read_columns(glob.glob(os.path.join(directory, 'latencies*.csv')), ['latency'])['latency']
+
+        started = numpy.min(columns['started'])
+        # NaN for nodes that had nothing committed or saw no block, the comparisons below drop them
+        committed_at = numpy.max(columns['committed_at'], initial=-numpy.inf, where=~numpy.isnan(columns['committed_at']))
+        duration = committed_at - started
+        committed = numpy.sum(columns['committed'])
+        blocks = numpy.max(columns['height_end']) - numpy.min(columns['height_start'])
+        last_block = numpy.max(columns['last_block_timestamp'], initial=-numpy.inf,
+                               where=~numpy.isnan(columns['last_block_timestamp']))
+        runs.append({
+            'run_id': run_id,
+            'nodes': int(columns['nodes'][0]),
+            'capacity': int(columns['capacity'][0]),
+            'reported': len(node_paths),
+            'transactions': int(numpy.sum(columns['transactions'])),
+            'committed': int(committed),
+            'send_time': numpy.max(columns['finished']) - started,
+            'duration': duration if duration > 0 else numpy.nan,
+            'throughput': committed / duration if duration > 0 else numpy.nan,
+            'blocks': int(blocks),
+            'block_time': (last_block - started) / blocks if blocks > 0 and last_block > started else numpy.nan,
+            'latencies': latencies,
+        })
+    return runs
+
+
+def aggregate(runs):
+    """
+    Figures of each configuration, the runs with the same number of nodes and
+    block capacity: mean and standard deviation of throughput and block time
+    over the runs, and latency percentiles over all of their transactions.
+
+    :return: list of dicts sorted by nodes then capacity.
+    """
+    if not runs:
+        return []
+    configurations = numpy.array([(run['nodes'], run['capacity']) for run in runs])
+    throughputs = numpy.array([run['throughput'] for run in runs])
+    block_times = numpy.array([run['block_time'] for run in runs])
+    keys, groups = numpy.unique(configurations, axis=0, return_inverse=True)
+    groups = numpy.ravel(groups)
+
+    summaries = []
+    for group, (nodes, capacity) in enumerate(keys):
+        members = numpy.flatnonzero(groups == group)
+        latencies = numpy.concatenate([runs[member]['latencies'] for member in members])
+        percentiles = numpy.percentile(latencies, LATENCY_PERCENTILES) if len(latencies) else [numpy.nan] * len(LATENCY_PERCENTILES)
+        throughput_mean, throughput_std = mean_and_std(throughputs[members])
+        block_time_mean, block_time_std = mean_and_std(block_times[members])
+        summaries.append({
+            'nodes': int(nodes),
+            'capacity': int(capacity),
+            'runs': len(members),
+            'transactions': sum(runs[member]['transactions'] for member in members),
+            'committed': sum(runs[member]['committed'] for member in members),
+            'throughput_mean': throughput_mean,
+            'throughput_std': throughput_std,
+            'block_time_mean': block_time_mean,
+            'block_time_std': block_time_std,
+            **{f'latency_p{percentile}': value for percentile, value in zip(LATENCY_PERCENTILES, percentiles)},
+        })
+    return summaries
+
+
+SUMMARY_FIELDS = [
+    'nodes', 'capacity', 'runs', 'transactions', 'committed', 'throughput_mean', 'throughput_std',
+    'block_time_mean', 'block_time_std',
+] + [f'latency_p{percentile}' for percentile in LATENCY_PERCENTILES]
+
+
+def format_summary(summary):
+    latencies = ', '.join(f"p{percentile} {summary[f'latency_p{percentile}']:.3f} s" for percentile in LATENCY_PERCENTILES)
+    return (f"{summary['nodes']:>3} nodes, capacity {summary['capacity']:>2}: {summary['runs']} runs, "
+            f"{summary['committed']}/{summary['transactions']} committed, throughput {summary['throughput_mean']:.1f} "
+            f"+/- {summary['throughput_std']:.1f} tx/s, block time {summary['block_time_mean']:.3f} "
+            f"+/- {summary['block_time_std']:.3f} s, inclusion latency {latencies}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Aggregate the per-node records of benchmark runs by configuration.')
+    parser.add_argument('results_dirs', type=str, nargs='*', default=[RESULTS_DIR], help='Directories holding one subdirectory per run')
+    parser.add_argument('--output', type=str, help='CSV file the per-configuration figures are written to')
+    args = parser.parse_args()
+
+    runs = [run for results_dir in args.results_dirs for run in load_runs(results_dir)]
+    for run in runs:
+        if run['reported'] != run['nodes']:
+            print(f"Run {run['run_id']}: {run['reported']} of {run['nodes']} nodes reported")
+    summaries = aggregate(runs)
+    for summary in summaries:
+        print(format_summary(summary))
+    if args.output:
+        write_records(args.output, SUMMARY_FIELDS, summaries)
+
+
+if __name__ == '__main__':
+    main()
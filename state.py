@@ -0,0 +1,352 @@
+import bisect
+from threading import Lock
+
+
+def transaction_cost(transaction):
+    """
+    Amount debited from the sender of a transaction, or None if the
+    transaction type does not debit the sender.
+    """
+    type_of_transaction = transaction.type_of_transaction
+    if type_of_transaction == "Welcome!":
+        return transaction.amount
+    elif type_of_transaction == "coin":
+        return 1.03*transaction.amount
+    elif type_of_transaction == "message":
+        return len(transaction.message)
+    return None
+
+
+def transaction_fee(transaction):
+    """
+    Part of the cost of a transaction that goes beyond the amount transferred,
+    used to order the transactions waiting for a block.
+    """
+    type_of_transaction = transaction.type_of_transaction
+    if type_of_transaction == "coin":
+        return 0.03*transaction.amount
+    elif type_of_transaction == "message":
+        return len(transaction.message)
+    return 0
+
+
+class BalanceLedger:
+    """
+    Balances keyed by public key, kept up to date as blocks are committed and
+    transactions enter the pool, so that a balance lookup is O(1) instead of a
+    walk over the whole chain.
+
+    The committed balances cover the chain only. The pending balances cover the
+    chain plus the transaction pool and only hold the keys touched by the pool.
+    """
+    def __init__(self):
+        self.committed = {}
+        self.pending = {}
+
+    def apply(self, balances, transaction, base=None):
+        receiver_address = transaction.receiver_address
+        sender_address = transaction.sender_address
+
+        # Seed the pending balances from the committed ones on first touch
+        if base is not None:
+            for address in (receiver_address, sender_address):
+                if address not in balances:
+                    balances[address] = base.get(address, 0)
+
+        balances[receiver_address] = balances.get(receiver_address, 0) + transaction.amount
+
+        # Same rule as the old chain walk: stakes are not debited and an empty
+        # account is never debited
+        if receiver_address != 0 and balances.get(sender_address, 0) > 0:
+            cost = transaction_cost(transaction)
+            if cost is not None:
+                balances[sender_address] -= cost
+
+    def apply_block(self, block, balances=None):
+        if balances is None:
+            # Copied, changed and swapped in, so readers holding the previous
+            # dict keep a consistent state; there is a key per node only
+            balances = dict(self.committed)
+            for transaction in block.transactions:
+                self.apply(balances, transaction)
+            self.committed = balances
+            return
+        for transaction in block.transactions:
+            self.apply(balances, transaction)
+
+    def add_pending(self, transaction):
+        pending = dict(self.pending)
+        self.apply(pending, transaction, base=self.committed)
+        self.pending = pending
+
+    def reset_pending(self, transaction_pool):
+        # Built aside and swapped in whole, so lock-free readers never see a
+        # half-built state; the same goes for rebuild and the other indexes
+        pending = {}
+        for transaction in transaction_pool:
+            self.apply(pending, transaction, base=self.committed)
+        self.pending = pending
+
+    def rebuild(self, chain, transaction_pool):
+        """
+        Recompute every balance from scratch, used when the chain is replaced.
+        """
+        committed = {}
+        for block in chain:
+            self.apply_block(block, committed)
+        self.committed = committed
+        self.reset_pending(transaction_pool)
+
+    def snapshot(self):
+        return list(self.committed.items())
+
+    def restore(self, snapshot):
+        self.committed = dict((address, balance) for address, balance in snapshot)
+        self.pending = {}
+
+    def state(self):
+        return self.committed, self.pending
+
+    def balance(self, public_key, state=None):
+        committed, pending = state if state is not None else self.state()
+        if public_key in pending:
+            balance = pending[public_key]
+        else:
+            balance = committed.get(public_key, 0)
+        return balance if balance > 0 else 0
+
+
+DEFAULT_STAKE = 10
+
+
+class StakeRegistry:
+    """
+    Latest stake of every public key, kept up to date as stake transactions
+    are committed or enter the pool.
+
+    The version counter changes whenever a stake may have changed, so callers
+    can cache anything derived from the stakes (such as the minter election
+    weights) and know when to recompute it.
+    """
+    def __init__(self):
+        self.committed = {}
+        self.pending = {}
+        self.version = 0
+
+    def apply(self, stakes, transaction):
+        if transaction.type_of_transaction == "stake":
+            stakes[transaction.sender_address] = transaction.amount
+            self.version += 1
+
+    def apply_block(self, block, stakes=None):
+        if stakes is None:
+            stakes = dict(self.committed)
+            for transaction in block.transactions:
+                self.apply(stakes, transaction)
+            self.committed = stakes
+            return
+        for transaction in block.transactions:
+            self.apply(stakes, transaction)
+
+    def add_pending(self, transaction):
+        if transaction.type_of_transaction == "stake":
+            pending = dict(self.pending)
+            self.apply(pending, transaction)
+            self.pending = pending
+
+    def reset_pending(self, transaction_pool):
+        if self.pending:
+            self.version += 1
+        pending = {}
+        for transaction in transaction_pool:
+            self.apply(pending, transaction)
+        self.pending = pending
+
+    def rebuild(self, chain, transaction_pool):
+        committed = {}
+        for block in chain:
+            self.apply_block(block, committed)
+        self.committed = committed
+        # The new chain may differ from the old one without any stake
+        # transaction being applied here, so cached weights are always stale
+        self.version += 1
+        self.reset_pending(transaction_pool)
+
+    def snapshot(self):
+        return list(self.committed.items())
+
+    def restore(self, snapshot):
+        self.committed = dict((address, stake) for address, stake in snapshot)
+        self.pending = {}
+        self.version += 1
+
+    def state(self):
+        return self.committed, self.pending
+
+    def stake(self, public_key, state=None):
+        committed, pending = state if state is not None else self.state()
+        # A pending stake equal to the default falls through to the chain, as
+        # the old pool-then-chain scan did
+        pending_stake = pending.get(public_key)
+        if pending_stake is not None and pending_stake != DEFAULT_STAKE:
+            return pending_stake
+        return committed.get(public_key, DEFAULT_STAKE)
+
+
+class NonceTracker:
+    """
+    Highest nonce seen from every sender, across the chain and every
+    transaction that entered the pool.
+
+    The pool is emptied when a block is minted, before the block arrives, so
+    the tracker only moves forward on pool changes and is recomputed from
+    scratch only when the chain is replaced.
+
+    Nonces handed out for this node's own transactions are reserved
+    separately: they are only seen once the receiving nodes have processed
+    the transaction, and a second call must not hand out the same nonce.
+    """
+    def __init__(self):
+        self.highest = {}
+        self.reserved = {}
+
+    def observe(self, transaction, highest=None):
+        if highest is None:
+            highest = self.highest
+        sender_address = transaction.sender_address
+        nonce = transaction.nonce
+        if sender_address not in highest or nonce > highest[sender_address]:
+            highest[sender_address] = nonce
+
+    def apply_block(self, block, highest=None):
+        for transaction in block.transactions:
+            self.observe(transaction, highest)
+
+    def add_pending(self, transaction):
+        self.observe(transaction)
+
+    def reset_pending(self, transaction_pool):
+        for transaction in transaction_pool:
+            self.observe(transaction)
+
+    def rebuild(self, chain, transaction_pool):
+        highest = {}
+        for block in chain:
+            self.apply_block(block, highest)
+        for transaction in transaction_pool:
+            self.observe(transaction, highest)
+        self.highest = highest
+
+    def snapshot(self):
+        return list(self.highest.items())
+
+    def restore(self, snapshot):
+        self.highest = dict((address, nonce) for address, nonce in snapshot)
+
+    def next_nonce(self, address):
+        return max(self.highest.get(address, 0), self.reserved.get(address, 0)) + 1
+
+    def reserve(self, address):
+        nonce = self.next_nonce(address)
+        self.reserved[address] = nonce
+        return nonce
+
+    def is_fresh(self, address, nonce):
+        """
+        Check that a nonce is newer than anything already seen from the sender,
+        which rejects both replayed and out-of-order transactions.
+        """
+        return address not in self.highest or nonce > self.highest[address]
+
+
+class TransactionIndex:
+    """
+    Where every committed transaction is, by transaction id, and the
+    committed transactions of every address, in chain order.
+
+    The index is built lazily: a restart or a replaced chain only resets it,
+    and the first lookup indexes the chain up to the current tip. From then
+    on every added block is indexed as it is committed. Entries are only
+    ever added, so a lookup made against a view ignores the entries of
+    blocks past the view's height instead of copying anything.
+    """
+    def __init__(self, current_view):
+        self.current_view = current_view
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        # (height, position) by transaction id, and those of each address
+        self.locations = {}
+        self.histories = {}
+        self.height = 0
+        # The chain list indexed, once known
+        self.chain = None
+
+    def index_block(self, block):
+        for position, transaction in enumerate(block.transactions):
+            location = (block.index, position)
+            self.locations[transaction.transaction_id] = location
+            self.histories.setdefault(transaction.sender_address, []).append(location)
+            if transaction.receiver_address != transaction.sender_address:
+                self.histories.setdefault(transaction.receiver_address, []).append(location)
+        self.height = block.index + 1
+
+    def apply_block(self, block):
+        with self.lock:
+            # Blocks before the catch-up point are indexed on the next lookup
+            if block.index == self.height:
+                self.index_block(block)
+
+    def add_pending(self, transaction):
+        pass
+
+    def reset_pending(self, transaction_pool):
+        pass
+
+    def rebuild(self, chain, transaction_pool):
+        with self.lock:
+            self.reset()
+            self.chain = chain
+
+    def snapshot(self):
+        # Rebuilt from the stored blocks on demand rather than saved
+        return None
+
+    def restore(self, snapshot):
+        with self.lock:
+            self.reset()
+
+    def catch_up(self, view):
+        if self.height >= view.height:
+            return
+        with self.lock:
+            current = self.current_view()
+            if self.chain is not None and current.blocks is not self.chain:
+                # The chain is being replaced and the new one not published yet
+                return
+            self.chain = current.blocks
+            for height in range(self.height, current.height):
+                self.index_block(current.blocks[height])
+
+    def locate(self, transaction_id, view):
+        """
+        Height and position of a transaction in the view's chain, or None.
+        """
+        self.catch_up(view)
+        location = self.locations.get(transaction_id)
+        if location is None or location[0] >= view.height:
+            return None
+        return location
+
+    def history(self, address, view, offset=0, limit=None):
+        """
+        Locations of a page of the address's transactions in the view's chain,
+        oldest first, and how many there are in total.
+        """
+        self.catch_up(view)
+        locations = self.histories.get(address, [])
+        # Entries of blocks past the view sort after (view.height,)
+        total = bisect.bisect_left(locations, (view.height,))
+        end = total if limit is None else min(total, offset + limit)
+        return locations[offset:end], total
@@ -0,0 +1,221 @@
+import gc
+import json
+import mmap
+import os
+import struct
+from functools import partial
+from threading import Lock
+
+from block import Block
+
+# Height index entry: segment number, offset and length of the block record
+INDEX_ENTRY = struct.Struct('>IQI')
+# A record is the length of the header, the header, then the transactions
+HEADER_LENGTH = struct.Struct('>I')
+
+SEGMENT_BYTES = 64 * 1024 * 1024
+
+
+class BlockStore:
+    """
+    Append-only log of committed blocks on disk.
+
+    Blocks are written to numbered segment files, a new segment is started
+    once the current one passes segment_bytes. Each record holds the block
+    header and its transactions as two JSON documents, so a restart decodes
+    only the headers and the transactions are read back through mmap when a
+    block is first used. A separate index file holds one fixed-size entry per
+    height pointing at the record, so any block is found without scanning.
+
+    The derived state (balances, stakes, nonces) is snapshotted next to the
+    log every snapshot_interval blocks, so a restart only replays the blocks
+    committed after the latest snapshot.
+    """
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, snapshot_interval=1000):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.snapshot_interval = snapshot_interval
+        self.lock = Lock()
+        self.maps = {}
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, 'index.bin')
+        self.snapshot_path = os.path.join(directory, 'snapshot.json')
+        self.entries = self.read_index()
+        self.recover()
+        self.index_file = open(self.index_path, 'ab')
+        self.segment = None
+        self.segment_file = None
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f'segment-{segment:06d}.log')
+
+    def read_index(self):
+        if not os.path.exists(self.index_path):
+            return []
+        with open(self.index_path, 'rb') as index_file:
+            data = index_file.read()
+        # A partial entry at the end is an interrupted write, drop it
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        return [INDEX_ENTRY.unpack_from(data, offset) for offset in range(0, usable, INDEX_ENTRY.size)]
+
+    def recover(self):
+        """
+        Bring the index and the segments back in line after a crash: drop index
+        entries whose record was not fully written and cut any record written
+        after the last index entry.
+        """
+        valid = 0
+        for segment, offset, length in self.entries:
+            path = self.segment_path(segment)
+            if not os.path.exists(path) or os.path.getsize(path) < offset + length:
+                break
+            valid += 1
+        self.entries = self.entries[:valid]
+
+        with open(self.index_path, 'ab') as index_file:
+            index_file.truncate(valid * INDEX_ENTRY.size)
+
+        last_segment, end = 0, 0
+        if self.entries:
+            last_segment, offset, length = self.entries[-1]
+            end = offset + length
+        for name in os.listdir(self.directory):
+            if not name.startswith('segment-'):
+                continue
+            segment = int(name[len('segment-'):-len('.log')])
+            if segment > last_segment:
+                os.remove(os.path.join(self.directory, name))
+            elif segment == last_segment and os.path.getsize(self.segment_path(segment)) > end:
+                with open(self.segment_path(segment), 'ab') as segment_file:
+                    segment_file.truncate(end)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def append(self, block):
+        """
+        Write a block at the next height.
+        """
+        self.append_record(self.encode(block))
+
+    def append_record(self, record):
+        with self.lock:
+            if self.segment_file is None:
+                self.segment = self.entries[-1][0] if self.entries else 0
+                self.segment_file = open(self.segment_path(self.segment), 'ab')
+            offset = self.segment_file.tell()
+            if offset and offset + len(record) > self.segment_bytes:
+                self.segment_file.close()
+                self.segment += 1
+                self.segment_file = open(self.segment_path(self.segment), 'ab')
+                offset = 0
+            self.segment_file.write(record)
+            self.segment_file.flush()
+            entry = (self.segment, offset, len(record))
+            self.index_file.write(INDEX_ENTRY.pack(*entry))
+            self.index_file.flush()
+            self.entries.append(entry)
+
+    @staticmethod
+    def encode(block):
+        header = json.dumps(block.header()).encode()
+        transactions = json.dumps(block.transaction_dicts()).encode()
+        return HEADER_LENGTH.pack(len(header)) + header + transactions
+
+    def map_for(self, segment, end):
+        segment_map = self.maps.get(segment)
+        if segment_map is None or len(segment_map) < end:
+            if segment_map is not None:
+                segment_map.close()
+            with open(self.segment_path(segment), 'rb') as segment_file:
+                segment_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = segment_map
+        return segment_map
+
+    def read_header(self, height):
+        with self.lock:
+            segment, offset, length = self.entries[height]
+            segment_map = self.map_for(segment, offset + length)
+            header_start = offset + HEADER_LENGTH.size
+            header_end = header_start + HEADER_LENGTH.unpack_from(segment_map, offset)[0]
+            return json.loads(segment_map[header_start:header_end])
+
+    def read_transactions(self, height):
+        with self.lock:
+            segment, offset, length = self.entries[height]
+            segment_map = self.map_for(segment, offset + length)
+            header_end = offset + HEADER_LENGTH.size + HEADER_LENGTH.unpack_from(segment_map, offset)[0]
+            return json.loads(segment_map[header_end:offset + length])
+
+    def blocks(self, start=0):
+        """
+        The stored blocks from the given height on, with only their headers
+        decoded.
+        """
+        blocks = []
+        # Everything decoded here lives as long as the chain, the cyclic
+        # collector would only rescan it over and over
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for height in range(start, len(self.entries)):
+                blocks.append(Block.from_stored(self.read_header(height), partial(self.read_transactions, height)))
+        finally:
+            if gc_enabled:
+                gc.enable()
+        return blocks
+
+    def rewrite(self, chain):
+        """
+        Replace the whole log, used when the chain is replaced by a peer's.
+        """
+        # Encode first, stored blocks of the chain read their transactions from the old log
+        records = [self.encode(block) for block in chain]
+        with self.lock:
+            self.close_files()
+            for name in os.listdir(self.directory):
+                if name.startswith('segment-') or name in ('index.bin', 'snapshot.json'):
+                    os.remove(os.path.join(self.directory, name))
+            self.entries = []
+            self.index_file = open(self.index_path, 'ab')
+        for record in records:
+            self.append_record(record)
+
+    def write_snapshot(self, height, state):
+        """
+        Save the state derived from the first height blocks, atomically.
+        """
+        temporary_path = self.snapshot_path + '.tmp'
+        with open(temporary_path, 'w') as snapshot_file:
+            json.dump({'height': height, 'state': state}, snapshot_file)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, self.snapshot_path)
+
+    def read_snapshot(self):
+        """
+        The latest snapshot as (height, state), or None if there is no usable one.
+        """
+        if not os.path.exists(self.snapshot_path):
+            return None
+        try:
+            with open(self.snapshot_path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except (OSError, ValueError):
+            return None
+        if snapshot['height'] > len(self.entries):
+            return None
+        return snapshot['height'], snapshot['state']
+
+    def close_files(self):
+        for segment_map in self.maps.values():
+            segment_map.close()
+        self.maps = {}
+        if self.segment_file is not None:
+            self.segment_file.close()
+            self.segment_file = None
+        self.index_file.close()
+
+    def close(self):
+        with self.lock:
+            self.close_files()
@@ -0,0 +1,49 @@
+from argparse import Namespace
+from types import SimpleNamespace
+
+import benchmark
+from gossip import Gossip
+
+
+def gossip_over(nodes, fanout):
+    roster = {str(node_id): {'address': f'http://node{node_id}', 'public_key': f'key{node_id}'} for node_id in range(nodes)}
+    node = SimpleNamespace(nodes=roster, node_ids_by_key={f'key{node_id}': str(node_id) for node_id in range(nodes)},
+                           wallet=SimpleNamespace(public_key='key0'))
+    return Gossip(node, fanout=fanout)
+
+
+def test_seen_message_is_dropped():
+    gossip = gossip_over(3, 2)
+    assert gossip.first_seen('tx')
+    assert not gossip.first_seen('tx')
+    gossip.forget('tx')
+    assert gossip.first_seen('tx')
+
+
+def test_seen_set_is_bounded():
+    gossip = gossip_over(3, 2)
+    gossip.seen_limit = 2
+    for key in ('a', 'b', 'c'):
+        gossip.first_seen(key)
+    assert list(gossip.seen) == ['b', 'c']
+
+
+def test_tree_reaches_every_node_once():
+    nodes, fanout = 13, 3
+    gossip = gossip_over(nodes, fanout)
+    for origin in map(str, range(nodes)):
+        reached, frontier = [origin], [origin]
+        while frontier:
+            children = [child for node_id in frontier for child in gossip.children(origin, node_id)]
+            assert len(children) <= fanout * len(frontier)
+            reached += children
+            frontier = children
+        assert sorted(reached, key=int) == [str(node_id) for node_id in range(nodes)]
+
+
+def test_gossip_benchmark_runs(capsys):
+    # Runs both modes through the benchmark's Broadcaster override, which
+    # has to keep up with the signature post_all calls post with
+    benchmark.bench_gossip(Namespace(nodes=[4], fanout=2, messages=2, delay=0))
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split()[1] for line in lines[2:]] == ['all-to-all', 'gossip']
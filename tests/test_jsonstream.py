@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from jsonstream import ObjectStream, StreamError, write_object
+
+ITEMS = [{'index': 1, 'hash': 'ab' * 8, 'amount': 12.5}, {'index': 2, 'message': 'καλημέρα', 'amount': 1000}]
+EXTRA = {'transaction_pool': [{'nonce': 3}], 'height': 12345}
+
+
+def body():
+    return ''.join(write_object('blocks', [json.dumps(item) for item in ITEMS], EXTRA)).encode()
+
+
+def read(chunks):
+    stream = ObjectStream('blocks')
+    items = []
+    for chunk in chunks:
+        items.extend(stream.feed(chunk))
+    return items, stream.close()
+
+
+def test_whole_body():
+    assert read([body()]) == (ITEMS, EXTRA)
+
+
+def test_split_at_every_byte():
+    # Cuts fall inside names, numbers, strings and multi-byte characters
+    data = body()
+    for cut in range(1, len(data)):
+        assert read([data[:cut], data[cut:]]) == (ITEMS, EXTRA), cut
+
+
+def test_one_byte_at_a_time():
+    data = body()
+    assert read([data[i:i + 1] for i in range(len(data))]) == (ITEMS, EXTRA)
+
+
+def test_items_are_handed_out_before_the_end():
+    data = body()
+    stream = ObjectStream('blocks')
+    first_item_end = data.index(b'}') + 2
+    assert stream.feed(data[:first_item_end]) == ITEMS[:1]
+
+
+def test_empty_list():
+    assert read([b'{"blocks": [], "height": 0}']) == ([], {'height': 0})
+
+
+@pytest.mark.parametrize('data', [b'{"blocks": [{"index": 1}', b'{"blocks": [1 2]}', b'["blocks"]', b'{"blocks": []} x'])
+def test_malformed_body(data):
+    with pytest.raises(StreamError):
+        read([data])
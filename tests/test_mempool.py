@@ -0,0 +1,61 @@
+from benchmark import synthetic_keys, synthetic_transaction
+from mempool import Mempool
+from transaction import TransactionRecord
+
+SENDER, OTHER, RECEIVER = synthetic_keys(3)
+
+
+def message(sender, nonce, fee):
+    # A message pays a fee of its length
+    return TransactionRecord.from_dict(dict(synthetic_transaction(sender, RECEIVER, nonce), message='x' * fee))
+
+
+def pool_of(*transactions, max_size):
+    pool = Mempool(max_size=max_size)
+    for transaction in transactions:
+        assert pool.add(transaction) == (True, None)
+    return pool
+
+
+def test_duplicate_is_kept_once():
+    transaction = message(SENDER, 1, 5)
+    pool = pool_of(transaction, max_size=10)
+    assert pool.add(transaction) == (False, None)
+    assert len(pool) == 1
+
+
+def test_lowest_paying_is_evicted():
+    low, high = message(SENDER, 1, 2), message(OTHER, 1, 8)
+    pool = pool_of(low, high, max_size=2)
+    new = message(OTHER, 2, 5)
+    assert pool.add(new) == (True, low)
+    assert list(pool) == [high, new]
+
+
+def test_paying_no_more_than_the_lowest_is_refused():
+    pool = pool_of(message(SENDER, 1, 5), message(OTHER, 1, 8), max_size=2)
+    assert pool.add(message(OTHER, 2, 5)) == (False, None)
+    assert len(pool) == 2
+
+
+def test_sender_last_nonce_is_evicted_first():
+    # The sender's first transaction pays least, but evicting it would leave
+    # the second waiting on a nonce that can never be sent again
+    first, second, other = message(SENDER, 1, 2), message(SENDER, 2, 9), message(OTHER, 1, 6)
+    pool = pool_of(first, second, other, max_size=3)
+    new = message(OTHER, 2, 7)
+    assert pool.add(new) == (True, second)
+    assert [transaction.nonce for transaction in pool.sender_queue(SENDER)] == [1]
+
+
+def test_same_sender_after_the_evicted_one_is_refused():
+    pool = pool_of(message(SENDER, 1, 2), message(SENDER, 2, 9), max_size=2)
+    assert pool.add(message(SENDER, 3, 20)) == (False, None)
+    assert [transaction.nonce for transaction in pool.sender_queue(SENDER)] == [1, 2]
+
+
+def test_blocks_take_each_sender_in_nonce_order():
+    first, second, other = message(SENDER, 1, 2), message(SENDER, 2, 9), message(OTHER, 1, 6)
+    pool = pool_of(second, other, first, max_size=10)
+    assert pool.take(3) == [other, first, second]
+    assert len(pool) == 0
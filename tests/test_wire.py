@@ -0,0 +1,32 @@
+import pytest
+
+import wire
+from benchmark import synthetic_chain, synthetic_keys
+
+
+def test_block_round_trip():
+    keys = synthetic_keys(3)
+    payload = {'blocks': [block.to_dict() for block in synthetic_chain(3, capacity=2, keys=keys)], 'height': 3}
+    assert wire.decode(wire.encode(payload)) == payload
+
+
+def test_registry_keys_round_trip():
+    keys = synthetic_keys(3)
+    registry = wire.WireKeys(keys)
+    payload = {'sender_address': keys[1], 'receiver_address': keys[2], 'amount': 1.5, 'nonce': 7, 'message': None}
+    encoded = wire.encode(payload, registry)
+    assert len(encoded) < len(wire.encode(payload))
+    assert wire.decode(encoded, registry) == payload
+
+
+def test_other_registry_is_refused():
+    keys = synthetic_keys(2)
+    encoded = wire.encode({'key': keys[0]}, wire.WireKeys(keys))
+    with pytest.raises(wire.WireError):
+        wire.decode(encoded, wire.WireKeys(list(reversed(keys))))
+
+
+def test_truncated_message_is_refused():
+    encoded = wire.encode({'values': list(range(10)), 'text': 'hello'})
+    with pytest.raises(wire.WireError):
+        wire.decode(encoded[:-3])
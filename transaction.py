@@ -1,6 +1,11 @@
 import base64
 import hashlib
 import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from threading import Lock
 import Crypto
 import jsonpickle
 from Crypto.PublicKey import RSA
@@ -8,6 +13,155 @@ from Crypto.Signature import pkcs1_15
 from Crypto.Signature import PKCS1_v1_5
 from Crypto.Hash import SHA256
 
+# Below this many transactions a batch is verified in-process, the round trip to
+# the worker processes costs more than it saves
+PARALLEL_VERIFY_THRESHOLD = 64
+
+verify_pool = None
+
+
+@lru_cache(maxsize=256)
+def signer_for(private_key):
+    """
+    Signer for a PEM private key, parsed once and reused.
+    """
+    return pkcs1_15.new(RSA.import_key(private_key))
+
+
+@lru_cache(maxsize=256)
+def verifier_for(sender_address):
+    """
+    Verifier for a base64 encoded public key, parsed once and reused.
+    """
+    return PKCS1_v1_5.new(RSA.import_key(base64.b64decode(sender_address)))
+
+
+def verify_record(record):
+    """
+    Verify the signature of a transaction record, and that its id is the hash
+    the signature covers: the pool, gossip and the transaction index are all
+    keyed by that id.
+    """
+    try:
+        tx = Transaction(
+            sender_address=record.sender_address,
+            receiver_address=record.receiver_address,
+            type_of_transaction=record.type_of_transaction,
+            amount=record.amount,
+            message=record.message,
+            nonce=record.nonce,
+        )
+        if tx.transaction_id.digest() != record.transaction_id:
+            return False
+        tx.signature = record.signature
+        return tx.verify_signature()
+    except (TypeError, ValueError):
+        return False
+
+
+def verify_transactions(transactions, workers=None):
+    """
+    Verify the signatures of many transaction records, across a process pool
+    when the batch is large enough and more than one core is available.
+
+    :return: list of booleans, one per transaction.
+    """
+    global verify_pool
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(transactions) < PARALLEL_VERIFY_THRESHOLD:
+        return [verify_record(transaction) for transaction in transactions]
+
+    if verify_pool is None:
+        verify_pool = ProcessPoolExecutor(max_workers=workers)
+    chunksize = max(1, len(transactions) // (workers * 4))
+    return list(verify_pool.map(verify_record, transactions, chunksize=chunksize))
+
+
+class KeyTable:
+    """
+    Every distinct address seen by this process, stored once.
+
+    Records keep a reference to the shared address instead of their own copy
+    of the base64 key, and each address gets a small integer id.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.keys = []
+        self.lock = Lock()
+
+    def intern(self, address):
+        key_id = self.ids.get(address)
+        if key_id is None:
+            with self.lock:
+                key_id = self.ids.get(address)
+                if key_id is None:
+                    key_id = len(self.keys)
+                    self.keys.append(address)
+                    self.ids[address] = key_id
+        return self.keys[key_id]
+
+    def id_of(self, address):
+        self.intern(address)
+        return self.ids[address]
+
+    def key_of(self, key_id):
+        return self.keys[key_id]
+
+
+key_table = KeyTable()
+
+
+class TransactionRecord:
+    """
+    Compact in-memory form of a signed transaction, as held in the pool and in
+    blocks. Addresses are shared through the key table and the id and
+    signature are kept as raw bytes. to_dict() gives the wire form.
+    """
+    __slots__ = ('sender_address', 'receiver_address', 'type_of_transaction', 'amount',
+                 'message', 'nonce', 'transaction_id', 'signature')
+
+    def __init__(self, sender_address, receiver_address, type_of_transaction, amount, message, nonce, transaction_id, signature):
+        self.sender_address = key_table.intern(sender_address)
+        self.receiver_address = key_table.intern(receiver_address)
+        self.type_of_transaction = sys.intern(type_of_transaction)
+        self.amount = amount
+        self.message = message
+        self.nonce = nonce
+        self.transaction_id = transaction_id
+        self.signature = signature
+
+    @classmethod
+    def from_dict(cls, data):
+        signature = data['signature']
+        return cls(
+            data['sender_address'],
+            data['receiver_address'],
+            data['type_of_transaction'],
+            data['amount'],
+            data['message'],
+            data['nonce'],
+            bytes.fromhex(data['transaction_id']),
+            base64.b64decode(signature) if signature is not None else None,
+        )
+
+    def to_dict(self):
+        return {
+            'sender_address': self.sender_address,
+            'receiver_address': self.receiver_address,
+            'type_of_transaction': self.type_of_transaction,
+            'amount': self.amount,
+            'message': self.message,
+            'nonce': self.nonce,
+            'transaction_id': self.transaction_id.hex(),
+            'signature': base64.b64encode(self.signature).decode() if self.signature is not None else None,
+        }
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
 class Transaction:
     def __init__(self, sender_address, receiver_address, type_of_transaction, amount, message=None, nonce=0, signature = None):
         self.sender_address = sender_address
@@ -59,16 +213,19 @@ class Transaction:
             'transaction_id' : self.transaction_id.hexdigest(),
             'signature': base64.b64encode(self.signature).decode() if self.signature and isinstance(self.signature, bytes) else self.signature,
         }
+
+    def to_record(self):
+        """
+        The signed transaction in the compact form kept in the pool and in blocks.
+        """
+        return TransactionRecord.from_dict(self.to_dict())
         
     def sign_transaction(self, sender_private_key):
         """
         Sign transaction with private key
         """
-        signer = pkcs1_15.new(RSA.import_key(sender_private_key))
-        self.signature = signer.sign(self.transaction_id)
+        self.signature = signer_for(sender_private_key).sign(self.transaction_id)
         return self.signature
     
     def verify_signature(self):
-            pk = RSA.import_key(base64.b64decode(self.sender_address))
-            verifier = PKCS1_v1_5.new(pk)
-            return verifier.verify(self.transaction_id, self.signature)
\ No newline at end of file
+            return verifier_for(self.sender_address).verify(self.transaction_id, self.signature)
\ No newline at end of file
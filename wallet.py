@@ -4,11 +4,20 @@ from Crypto.PublicKey import RSA
 import base64
 from Crypto.Signature import pkcs1_15
 from Crypto.Hash import SHA256
+from transaction import signer_for
+
+KEY_LENGTH = 1024
+
 
 class Wallet:
-    def __init__(self):
-        key_length = 1024  
-        rsaKeys = RSA.generate(key_length)
+    def __init__(self, private_key=None):
+        """
+        :param private_key: PEM of an existing key to use, a new key is generated if None.
+        """
+        if private_key is None:
+            rsaKeys = RSA.generate(KEY_LENGTH)
+        else:
+            rsaKeys = RSA.import_key(private_key)
         self.private_key = rsaKeys.export_key().decode('utf-8') 
         self.public_key = base64.b64encode(rsaKeys.publickey().export_key()).decode('utf-8')  
         self.address = self.public_key  
@@ -21,9 +30,7 @@ class Wallet:
         # transaction_string = json.dumps(transaction, sort_keys=True)
         # transaction_bytes = transaction_string.encode('utf-8')
         # transaction_hash = SHA256.new(transaction_bytes)
-        private_key = RSA.import_key(self.private_key)
-        signer = pkcs1_15.new(private_key)
-        signature = signer.sign(transaction['transaction_id'])
+        signature = signer_for(self.private_key).sign(transaction['transaction_id'])
         transaction['signature'] = base64.b64encode(signature).decode('utf-8')
         return transaction
 
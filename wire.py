@@ -0,0 +1,219 @@
+import base64
+import binascii
+import hashlib
+import json
+import re
+import struct
+
+# Content type of the binary encoding, JSON stays the default and the fallback
+CONTENT_TYPE = 'application/x-blockchat'
+# Request header carrying the hex digest of the requester's registry, so a
+# binary response only uses key ids the requester can resolve
+KEYS_HEADER = 'X-Wire-Keys'
+
+MAGIC = b'BC\x01'
+NO_KEYS = bytes(8)
+
+# Strings at least this long are tried as base64 (public keys, signatures)
+BASE64_MIN_LENGTH = 64
+
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+INT64 = struct.Struct('>q')
+DOUBLE = struct.Struct('>d')
+LENGTH = struct.Struct('>I')
+KEY_ID = struct.Struct('>H')
+
+
+class WireError(ValueError):
+    """
+    A binary message that cannot be decoded, or that refers to key ids the
+    receiving node does not know.
+    """
+
+
+class WireKeys:
+    """
+    Public keys of the node registry in node id order. An address found here
+    travels as its two byte index instead of the full base64 key.
+
+    The digest identifies the registry, a message using key ids carries the
+    digest of the sender's registry and is refused if it differs from ours.
+    """
+    def __init__(self, public_keys=()):
+        self.keys = list(public_keys)
+        self.ids = {public_key: key_id for key_id, public_key in enumerate(self.keys)}
+        self.digest = hashlib.sha256('\n'.join(self.keys).encode()).digest()[:8] if self.keys else NO_KEYS
+
+
+NO_REGISTRY = WireKeys()
+
+HEX = re.compile(r'(?:[0-9a-f]{2})+')
+
+
+def is_hex(value):
+    return HEX.fullmatch(value) is not None
+
+
+def as_base64(value):
+    """
+    The bytes behind a base64 string, or None if the string does not come back
+    unchanged from a decode and re-encode.
+    """
+    try:
+        raw = base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    if base64.b64encode(raw).decode() != value:
+        return None
+    return raw
+
+
+class Encoder:
+    def __init__(self, keys):
+        self.keys = keys
+        self.parts = []
+        self.uses_keys = False
+
+    def string(self, tag, raw):
+        self.parts.append(tag + LENGTH.pack(len(raw)))
+        self.parts.append(raw)
+
+    def value(self, value):
+        parts = self.parts
+        if value is None:
+            parts.append(b'N')
+        elif value is True:
+            parts.append(b'T')
+        elif value is False:
+            parts.append(b'F')
+        elif isinstance(value, int):
+            if INT64_MIN <= value <= INT64_MAX:
+                parts.append(b'i' + INT64.pack(value))
+            else:
+                self.string(b'I', str(value).encode())
+        elif isinstance(value, float):
+            parts.append(b'd' + DOUBLE.pack(value))
+        elif isinstance(value, str):
+            self.text(value)
+        elif isinstance(value, bytes):
+            self.string(b'y', value)
+        elif isinstance(value, dict):
+            parts.append(b'm' + LENGTH.pack(len(value)))
+            for key, item in value.items():
+                # Keys become strings, as they would in JSON
+                self.value(key if isinstance(key, str) else json.dumps(key))
+                self.value(item)
+        elif isinstance(value, (list, tuple)):
+            parts.append(b'l' + LENGTH.pack(len(value)))
+            for item in value:
+                self.value(item)
+        elif hasattr(value, 'to_dict'):
+            self.value(value.to_dict())
+        else:
+            raise WireError(f"Cannot encode {type(value).__name__}")
+
+    def text(self, value):
+        # Known addresses, then hashes and ids as raw bytes, then base64 as raw bytes
+        key_id = self.keys.ids.get(value)
+        if key_id is not None and key_id <= 0xffff:
+            self.uses_keys = True
+            self.parts.append(b'k' + KEY_ID.pack(key_id))
+        elif is_hex(value):
+            self.string(b'x', bytes.fromhex(value))
+        elif len(value) >= BASE64_MIN_LENGTH and (raw := as_base64(value)) is not None:
+            self.string(b'b', raw)
+        else:
+            self.string(b's', value.encode())
+
+
+def encode(payload, keys=NO_REGISTRY):
+    """
+    Encode a JSON-like payload (dicts, lists, strings, numbers, booleans,
+    None, and records with to_dict) in the binary wire format.
+    """
+    encoder = Encoder(keys)
+    encoder.value(payload)
+    digest = keys.digest if encoder.uses_keys else NO_KEYS
+    return b''.join([MAGIC, digest] + encoder.parts)
+
+
+class Decoder:
+    def __init__(self, data, keys, offset=0):
+        self.data = bytes(data)
+        self.keys = keys
+        self.offset = offset
+        self.readers = {
+            b'N'[0]: lambda: None,
+            b'T'[0]: lambda: True,
+            b'F'[0]: lambda: False,
+            b'i'[0]: lambda: self.unpack(INT64),
+            b'I'[0]: lambda: int(self.raw().decode()),
+            b'd'[0]: lambda: self.unpack(DOUBLE),
+            b's'[0]: lambda: self.raw().decode(),
+            b'x'[0]: lambda: self.raw().hex(),
+            b'b'[0]: lambda: base64.b64encode(self.raw()).decode(),
+            b'y'[0]: self.raw,
+            b'k'[0]: self.key,
+            b'm'[0]: self.map,
+            b'l'[0]: lambda: [self.value() for _ in range(self.unpack(LENGTH))],
+        }
+
+    def unpack(self, layout):
+        if self.offset + layout.size > len(self.data):
+            raise WireError("Truncated message")
+        value = layout.unpack_from(self.data, self.offset)[0]
+        self.offset += layout.size
+        return value
+
+    def raw(self):
+        size = self.unpack(LENGTH)
+        end = self.offset + size
+        if end > len(self.data):
+            raise WireError("Truncated message")
+        chunk = self.data[self.offset:end]
+        self.offset = end
+        return chunk
+
+    def key(self):
+        key_id = self.unpack(KEY_ID)
+        if key_id >= len(self.keys.keys):
+            raise WireError(f"Unknown key id {key_id}")
+        return self.keys.keys[key_id]
+
+    def map(self):
+        result = {}
+        for _ in range(self.unpack(LENGTH)):
+            key = self.value()
+            result[key] = self.value()
+        return result
+
+    def value(self):
+        if self.offset >= len(self.data):
+            raise WireError("Truncated message")
+        tag = self.data[self.offset]
+        self.offset += 1
+        reader = self.readers.get(tag)
+        if reader is None:
+            raise WireError(f"Unknown tag {bytes([tag])!r}")
+        return reader()
+
+
+def decode(data, keys=NO_REGISTRY):
+    """
+    Decode a binary message back into the payload that was encoded.
+
+    :raises WireError: if the message is malformed or uses key ids from a
+        registry other than ours.
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise WireError("Not a binary message")
+    digest = bytes(data[len(MAGIC):len(MAGIC) + 8])
+    if digest != NO_KEYS and digest != keys.digest:
+        raise WireError("Message uses a different node registry")
+    decoder = Decoder(data, keys, offset=len(MAGIC) + 8)
+    payload = decoder.value()
+    if decoder.offset != len(decoder.data):
+        raise WireError("Trailing data after message")
+    return payload